@@ -19,21 +19,113 @@ __copyright__ = ('Copyright 2012, Australia Indonesia Facility for '
 
 import os
 import sys
+import cPickle
+import time
 import logging
+from collections import deque
+from subprocess import Popen
 from urllib2 import URLError
 from zipfile import BadZipfile
 
 from ftp_client import FtpClient
 from sftp_client import SFtpClient
-from utils import setupLogger, dataDir, is_event_id
+from utils import (setupLogger, dataDir, shakemapDataDir,
+                   shakemapExtractDir, is_event_id)
 from shake_event import ShakeEvent
+from rt_exceptions import MapComposerError
 # Loading from package __init__ not working in this context so manually doing
 setupLogger()
 LOGGER = logging.getLogger('InaSAFE')
 
 
+def forceFlag():
+    """Whether INASAFE_FORCE asks to always regenerate the products.
+
+    Returns:
+        bool - True if INASAFE_FORCE is set to Y.
+    """
+    myForceFlag = False
+    if 'INASAFE_FORCE' in os.environ:
+        myForceString = os.environ['INASAFE_FORCE']
+        if str(myForceString).capitalize() == 'Y':
+            myForceFlag = True
+    return myForceFlag
+
+
+def renderLocaleMap(theEventId, theLocale, theForceFlag, theProducts):
+    """Render the map of an event in one locale from shared products.
+
+    The grid.xml of the event has already been extracted by
+    :func:`processEvent` so the ShakeEvent is made from local data.
+
+    Args:
+        theEventId: str - id of the event.
+        theLocale: str - locale of the map.
+        theForceFlag: bool - whether to overwrite an existing map.
+        theProducts: dict - products made by
+            :func:`ShakeEvent.generateProducts`.
+
+    Returns:
+        None
+    """
+    myShakeEvent = ShakeEvent(
+        theEventId=theEventId,
+        theLocale=theLocale,
+        theForceFlag=theForceFlag,
+        theDataIsLocalFlag=True)
+    myShakeEvent.renderMap(theForceFlag, theProducts=theProducts)
+
+
+def renderLocaleMaps(theEventId, theLocaleList, theProductsPath,
+                     theProcessCount):
+    """Render the maps of several locales in separate make_map.py processes.
+
+    The processes are started with :samp:`make_map.py --render` rather than
+    forked from this process, which already runs a QgsApplication, so each
+    of them initialises QGIS and its own X connection from scratch.
+
+    Args:
+        theEventId: str - id of the event.
+        theLocaleList: list - locales of the maps.
+        theProductsPath: str - path to the pickled products made by
+            :func:`ShakeEvent.generateProducts`.
+        theProcessCount: int - number of maps rendered at the same time.
+
+    Returns:
+        None
+
+    Raises:
+        MapComposerError if any of the maps could not be rendered.
+    """
+    myFailedLocales = []
+    for myStart in range(0, len(theLocaleList), theProcessCount):
+        myProcesses = []
+        for myLoc in theLocaleList[myStart:myStart + theProcessCount]:
+            myCommand = [sys.executable, os.path.abspath(__file__),
+                         '--render', theEventId, myLoc, theProductsPath]
+            LOGGER.info('Rendering %s map: %s' % (myLoc, myCommand))
+            myProcesses.append((myLoc, Popen(myCommand)))
+        for myLoc, myProcess in myProcesses:
+            if myProcess.wait() != 0:
+                myFailedLocales.append(myLoc)
+    if myFailedLocales:
+        raise MapComposerError('Failed to render %s maps of %s' % (
+            ', '.join(myFailedLocales), theEventId))
+
+
 def processEvent(theEventId=None, theLocale='en'):
-    """Launcher that actually runs the event processing."""
+    """Launcher that actually runs the event processing.
+
+    The raster, contours, cities and impacts of the event are the same in
+    every locale so they are made once. The maps of the locales are then
+    rendered in parallel, up to INASAFE_RENDER_PROCESSES at a time (one per
+    locale by default), by :func:`renderLocaleMaps`. With
+    INASAFE_RENDER_PROCESSES=1 they are rendered one by one in this process.
+
+    Returns:
+        bool - False if the event could not be fetched and set up, True
+            otherwise.
+    """
     myPopulationPath = os.path.join(
         dataDir(),
         'exposure',
@@ -42,11 +134,7 @@ def processEvent(theEventId=None, theLocale='en'):
 
     # Use cached data where available
     # Whether we should always regenerate the products
-    myForceFlag = False
-    if 'INASAFE_FORCE' in os.environ:
-        myForceString = os.environ['INASAFE_FORCE']
-        if str(myForceString).capitalize() == 'Y':
-            myForceFlag = True
+    myForceFlag = forceFlag()
 
     # We always want to generate en products too so we manipulate the locale
     # list and loop through them:
@@ -54,43 +142,183 @@ def processEvent(theEventId=None, theLocale='en'):
     if 'en' not in myLocaleList:
         myLocaleList.append('en')
 
+    # Extract the event. The locale independent products are made by an en
+    # instance so that no translator is installed in this process.
+    # noinspection PyBroadException
+    try:
+        if os.path.exists(myPopulationPath):
+            myShakeEvent = ShakeEvent(
+                theEventId=theEventId,
+                theForceFlag=myForceFlag,
+                thePopulationRasterPath=myPopulationPath)
+        else:
+            myShakeEvent = ShakeEvent(
+                theEventId=theEventId,
+                theForceFlag=myForceFlag)
+    except (BadZipfile, URLError):
+        # retry with force flag true
+        if os.path.exists(myPopulationPath):
+            myShakeEvent = ShakeEvent(
+                theEventId=theEventId,
+                theForceFlag=True,
+                thePopulationRasterPath=myPopulationPath)
+        else:
+            myShakeEvent = ShakeEvent(
+                theEventId=theEventId,
+                theForceFlag=True)
+    except:
+        LOGGER.exception('An error occurred setting up the shake event.')
+        return False
+
+    LOGGER.info('Event Id: %s', myShakeEvent)
+    LOGGER.info('-------------------------------------------')
+
+    if not myForceFlag:
+        # Skip locales whose maps already exist
+        myMissingLocales = []
+        for myLoc in myLocaleList:
+            for myPath in myShakeEvent.mapPaths(myLoc):
+                if not os.path.exists(myPath):
+                    myMissingLocales.append(myLoc)
+                    break
+        myLocaleList = myMissingLocales
+        if not myLocaleList:
+            LOGGER.info('Maps of %s already exist' % myShakeEvent.eventId)
+            return True
+
     # Now generate the products
-    for myLoc in myLocaleList:
-        # Extract the event
+    myProducts = myShakeEvent.generateProducts(myForceFlag)
+    myProcessCount = int(os.environ.get('INASAFE_RENDER_PROCESSES',
+                                        len(myLocaleList)))
+    if myProcessCount > 1 and len(myLocaleList) > 1:
+        myProductsPath = os.path.join(shakemapExtractDir(),
+                                      myShakeEvent.eventId,
+                                      'products.pickle')
+        myFile = open(myProductsPath, 'wb')
+        try:
+            cPickle.dump(myProducts, myFile, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            myFile.close()
+        renderLocaleMaps(myShakeEvent.eventId, myLocaleList, myProductsPath,
+                         myProcessCount)
+    else:
+        for myLoc in myLocaleList:
+            renderLocaleMap(myShakeEvent.eventId, myLoc, myForceFlag,
+                            myProducts)
+    return True
+
+
+def readProcessedEvents(thePath):
+    """Read the ids of events already processed by the daemon.
+
+    Args:
+        thePath: str - path to the file with one event id per line.
+
+    Returns:
+        set: event ids or None if the file does not exist yet.
+    """
+    if not os.path.exists(thePath):
+        return None
+    myFile = open(thePath)
+    try:
+        return set(myLine.strip() for myLine in myFile if myLine.strip())
+    finally:
+        myFile.close()
+
+
+def writeProcessedEvent(thePath, theEventId):
+    """Record that an event was processed by the daemon.
+
+    Args:
+        thePath: str - path to the file with one event id per line.
+        theEventId: str - id of the processed event.
+
+    Returns:
+        None
+    """
+    myFile = open(thePath, 'a')
+    try:
+        myFile.write('%s\n' % theEventId)
+    finally:
+        myFile.close()
+
+
+def runDaemon(theLocale='en', thePollInterval=60, theMaxEvents=0,
+              theMaxAttempts=3):
+    """Poll the shakemap server and process new events as they arrive.
+
+    QGIS, SAFE, the population mosaic, the cities layer and the impact
+    function stay loaded between events (see the cached* functions of
+    shake_event.py) so a new event is processed in seconds.
+
+    The ids of processed events are recorded in
+    :file:`processed-events.txt` of :func:`shakemapDataDir` so that a
+    restarted daemon picks up where it left off. On the very first start
+    only the latest event on the server is processed.
+
+    Args:
+        theLocale: str - (Optional) locale of the products, en products are
+            always made too.
+        thePollInterval: float - (Optional) seconds between listings of the
+            server.
+        theMaxEvents: int - (Optional) number of events after which to
+            return, e.g. to bound memory leaks when the daemon is restarted
+            by a shell loop. 0 means never return.
+        theMaxAttempts: int - (Optional) number of times to try an event
+            before giving up on it.
+
+    Returns:
+        None
+    """
+    myStatePath = os.path.join(shakemapDataDir(), 'processed-events.txt')
+    myProcessed = readProcessedEvents(myStatePath)
+    myQueue = deque()
+    myAttempts = {}
+    myEventCount = 0
+    while True:
         # noinspection PyBroadException
         try:
-            if os.path.exists(myPopulationPath):
-                myShakeEvent = ShakeEvent(
-                    theEventId=theEventId,
-                    theLocale=myLoc,
-                    theForceFlag=myForceFlag,
-                    thePopulationRasterPath=myPopulationPath)
-            else:
-                myShakeEvent = ShakeEvent(
-                    theEventId=theEventId,
-                    theLocale=myLoc,
-                    theForceFlag=myForceFlag)
-        except (BadZipfile, URLError):
-            # retry with force flag true
-            if os.path.exists(myPopulationPath):
-                myShakeEvent = ShakeEvent(
-                    theEventId=theEventId,
-                    theLocale=myLoc,
-                    theForceFlag=True,
-                    thePopulationRasterPath=myPopulationPath)
-            else:
-                myShakeEvent = ShakeEvent(
-                    theEventId=theEventId,
-                    theLocale=myLoc,
-                    theForceFlag=True)
-        except:
-            LOGGER.exception('An error occurred setting up the shake event.')
-            return
-
-        LOGGER.info('Event Id: %s', myShakeEvent)
-        LOGGER.info('-------------------------------------------')
-
-        myShakeEvent.renderMap(myForceFlag)
+            myListing = SFtpClient().getListing(my_func=is_event_id)
+        except:  # pylint: disable=W0702
+            LOGGER.exception('Failed to list shakemaps on server')
+            myListing = None
+        if myListing:
+            myListing = sorted(myListing)
+            if myProcessed is None:
+                # First start: skip the archive of past events
+                for myEvent in myListing[:-1]:
+                    writeProcessedEvent(myStatePath, myEvent)
+                myProcessed = set(myListing[:-1])
+            # Latest events first so a backlog never delays a new event
+            for myEvent in myListing:
+                if myEvent not in myProcessed and myEvent not in myQueue:
+                    LOGGER.info('Queued shakemap %s' % myEvent)
+                    myQueue.appendleft(myEvent)
+
+        while myQueue:
+            myEvent = myQueue.popleft()
+            LOGGER.info('Processing shakemap %s' % myEvent)
+            myAttempts[myEvent] = myAttempts.get(myEvent, 0) + 1
+            # noinspection PyBroadException
+            try:
+                mySuccessFlag = processEvent(myEvent, theLocale)
+            except:  # pylint: disable=W0702
+                LOGGER.exception('Failed to process %s' % myEvent)
+                mySuccessFlag = False
+            if not mySuccessFlag:
+                if myAttempts[myEvent] < theMaxAttempts:
+                    # Queued again by the next listing of the server
+                    continue
+                LOGGER.error('Giving up on %s after %s attempts' % (
+                    myEvent, myAttempts[myEvent]))
+            writeProcessedEvent(myStatePath, myEvent)
+            myProcessed.add(myEvent)
+            del myAttempts[myEvent]
+            myEventCount += 1
+            if theMaxEvents and myEventCount >= theMaxEvents:
+                return
+
+        time.sleep(thePollInterval)
 
 LOGGER.info('-------------------------------------------')
 
@@ -99,9 +327,18 @@ if 'INASAFE_LOCALE' in os.environ:
 else:
     myLocale = 'en'
 
-if len(sys.argv) > 2:
-    sys.exit('Usage:\n%s [optional shakeid]\nor\n%s --list' % (
-        sys.argv[0], sys.argv[0]))
+if len(sys.argv) == 5 and sys.argv[1] == '--render':
+    # One locale of processEvent, see renderLocaleMaps
+    myProductsFile = open(sys.argv[4], 'rb')
+    try:
+        myProducts = cPickle.load(myProductsFile)
+    finally:
+        myProductsFile.close()
+    renderLocaleMap(sys.argv[2], sys.argv[3], forceFlag(), myProducts)
+    sys.exit(0)
+elif len(sys.argv) > 2:
+    sys.exit('Usage:\n%s [optional shakeid]\nor\n%s --list\nor\n'
+             '%s --daemon' % (sys.argv[0], sys.argv[0], sys.argv[0]))
 elif len(sys.argv) == 2:
     print('Processing shakemap %s' % sys.argv[1])
 
@@ -133,6 +370,11 @@ elif len(sys.argv) == 2:
             except:  # pylint: disable=W0702
                 LOGGER.exception('Failed to process %s' % myEvent)
         sys.exit(0)
+    elif myEventId == '--daemon':
+        myPollInterval = float(os.environ.get('INASAFE_POLL_INTERVAL', 60))
+        myMaxEvents = int(os.environ.get('INASAFE_DAEMON_MAX_EVENTS', 0))
+        runDaemon(myLocale, myPollInterval, myMaxEvents)
+        sys.exit(0)
     else:
         processEvent(myEventId, myLocale)
 
@@ -21,7 +21,6 @@ __copyright__ = ('Copyright 2012, Australia Indonesia Facility for '
 import os
 import sys
 import shutil
-from xml.dom import minidom
 import math
 from subprocess import call, CalledProcessError
 import logging
@@ -29,9 +28,6 @@ import numpy
 from datetime import datetime
 import pytz  # sudo apt-get install python-tz
 
-import ogr
-import gdal
-from gdalconst import GA_ReadOnly
 
 from sftp_shake_data import SftpShakeData
 
@@ -76,7 +72,11 @@ from safe.common.version import get_version
 from safe.api import get_plugins as safe_get_plugins
 from safe.api import read_layer as safe_read_layer
 from safe.api import calculate_impact as safe_calculate_impact
+from safe.api import export_layer as safe_export_layer
 from safe.api import Table, TableCell, TableRow
+from safe.api import read_grid_xml, grid_shake_data, GRID_ALGORITHMS
+from safe.api import contour_grid, line_bounds_and_lengths
+from safe.api import Raster, Vector
 from safe_qgis.utilities import getWGS84resolution
 from safe_qgis.clipper import extentToGeoArray, clipLayer
 from utils import shakemapExtractDir, dataDir
@@ -94,6 +94,91 @@ from rt_exceptions import (GridXmlFileNotFoundError,
 LOGGER = logging.getLogger('InaSAFE')
 QGISAPP, CANVAS, IFACE, PARENT = getQgisTestApp()
 
+# Roman numerals and html hex colours of MMI classes 0 to 12. Colours are
+# from http://en.wikipedia.org/wiki/Mercalli_intensity_scale
+MMI_ROMAN_NUMERALS = ['0', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII',
+                      'IX', 'X', 'XI', 'XII']
+MMI_COLOURS = ['#FFFFFF', '#FFFFFF', '#209fff', '#00cfff', '#55ffff',
+               '#aaffff', '#fff000', '#ffa800', '#ff7000', '#ff0000', '#D00',
+               '#800', '#400']
+
+# Layers and impact functions that are the same for every event. They are
+# loaded once per process so that a long running process (see the daemon
+# mode of make_map.py) does not reopen them for each event.
+CACHED_RASTER_LAYERS = {}
+CACHED_CITIES_LAYERS = {}
+CACHED_IMPACT_FUNCTIONS = {}
+
+
+def cachedRasterLayer(thePath):
+    """Get a raster layer and its WGS84 cell size, loading it only once.
+
+    Args:
+        thePath: str - path to a raster file e.g. the population mosaic.
+
+    Returns:
+        QgsRasterLayer, float: the layer and its cell size in degrees as
+            given by :func:`getWGS84resolution`.
+
+    Raises:
+        InvalidLayerError
+    """
+    if thePath not in CACHED_RASTER_LAYERS:
+        myBaseName, _ = os.path.splitext(thePath)
+        myLayer = QgsRasterLayer(thePath, myBaseName)
+        if not myLayer.isValid():
+            raise InvalidLayerError('Layer failed to load!\n%s' % thePath)
+        CACHED_RASTER_LAYERS[thePath] = (myLayer,
+                                         getWGS84resolution(myLayer))
+    return CACHED_RASTER_LAYERS[thePath]
+
+
+def cachedCitiesLayer():
+    """Get the geonames cities layer, opening it only once.
+
+    The spatialite provider keeps the spatial index of the geonames table
+    open with the layer so bounding box queries of later events are cheap.
+
+    Args:
+        None
+
+    Returns:
+        QgsVectorLayer: the geonames table of indonesia.sqlite.
+
+    Raises:
+        InvalidLayerError
+    """
+    # Path to sqlitedb containing geonames table
+    myDBPath = os.path.join(dataDir(), 'indonesia.sqlite')
+    if myDBPath not in CACHED_CITIES_LAYERS:
+        myUri = QgsDataSourceURI()
+        myUri.setDatabase(myDBPath)
+        myTable = 'geonames'
+        myGeometryColumn = 'geom'
+        mySchema = ''
+        myUri.setDataSource(mySchema, myTable, myGeometryColumn)
+        myLayer = QgsVectorLayer(myUri.uri(), 'Towns', 'spatialite')
+        if not myLayer.isValid():
+            raise InvalidLayerError(myDBPath)
+        CACHED_CITIES_LAYERS[myDBPath] = myLayer
+    return CACHED_CITIES_LAYERS[myDBPath]
+
+
+def cachedImpactFunction(theFunctionId):
+    """Get an impact function from the SAFE registry, looking it up once.
+
+    Args:
+        theFunctionId: str - id of the impact function e.g.
+            'I T B Fatality Function'.
+
+    Returns:
+        The impact function class.
+    """
+    if theFunctionId not in CACHED_IMPACT_FUNCTIONS:
+        CACHED_IMPACT_FUNCTIONS[theFunctionId] = safe_get_plugins(
+            theFunctionId)[0][theFunctionId]
+    return CACHED_IMPACT_FUNCTIONS[theFunctionId]
+
 
 class ShakeEvent(QObject):
     """The ShakeEvent class encapsulates behaviour and data relating to an
@@ -314,6 +399,9 @@ class ShakeEvent(QObject):
            fields and attributes. Also it provides all the data we need in a
            single file.
 
+        The header is parsed incrementally and the data block converted to
+        numbers in blocks (see :func:`read_grid_xml`). self.mmiData is set
+        to an array of floats with columns lon, lat and mmi.
 
         Args: None
 
@@ -324,61 +412,28 @@ class ShakeEvent(QObject):
         LOGGER.debug('ParseGridXml requested.')
         myPath = self.gridFilePath()
         try:
-            myDocument = minidom.parse(myPath)
-            myEventElement = myDocument.getElementsByTagName('event')
-            myEventElement = myEventElement[0]
-            self.magnitude = float(myEventElement.attributes[
-                                   'magnitude'].nodeValue)
-            self.longitude = float(myEventElement.attributes[
-                                   'lon'].nodeValue)
-            self.latitude = float(myEventElement.attributes[
-                                  'lat'].nodeValue)
-            self.location = myEventElement.attributes[
-                'event_description'].nodeValue.strip()
-            self.depth = float(myEventElement.attributes['depth'].nodeValue)
+            myHeader, self.mmiData = read_grid_xml(myPath)
+            myEvent = myHeader['event']
+            self.magnitude = float(myEvent['magnitude'])
+            self.longitude = float(myEvent['lon'])
+            self.latitude = float(myEvent['lat'])
+            self.location = myEvent['event_description'].strip()
+            self.depth = float(myEvent['depth'])
             # Get the date - its going to look something like this:
             # 2012-08-07T01:55:12WIB
-            myTimeStamp = myEventElement.attributes[
-                'event_timestamp'].nodeValue
+            myTimeStamp = myEvent['event_timestamp']
             self.extractDateTime(myTimeStamp)
             # Note the timezone here is inconsistent with YZ from grid.xml
             # use the latter
             self.timeZone = myTimeStamp[-3:]
 
-            mySpecificationElement = myDocument.getElementsByTagName(
-                'grid_specification')
-            mySpecificationElement = mySpecificationElement[0]
-            self.xMinimum = float(mySpecificationElement.attributes[
-                                  'lon_min'].nodeValue)
-            self.xMaximum = float(mySpecificationElement.attributes[
-                                  'lon_max'].nodeValue)
-            self.yMinimum = float(mySpecificationElement.attributes[
-                                  'lat_min'].nodeValue)
-            self.yMaximum = float(mySpecificationElement.attributes[
-                                  'lat_max'].nodeValue)
-            self.rows = float(mySpecificationElement.attributes[
-                              'nlat'].nodeValue)
-            self.columns = float(mySpecificationElement.attributes[
-                                 'nlon'].nodeValue)
-            myDataElement = myDocument.getElementsByTagName(
-                'grid_data')
-            myDataElement = myDataElement[0]
-            myData = myDataElement.firstChild.nodeValue
-
-            # Extract the 1,2 and 5th (MMI) columns and populate mmiData
-            myLonColumn = 0
-            myLatColumn = 1
-            myMMIColumn = 4
-            self.mmiData = []
-            for myLine in myData.split('\n'):
-                if not myLine:
-                    continue
-                myTokens = myLine.split(' ')
-                myLon = myTokens[myLonColumn]
-                myLat = myTokens[myLatColumn]
-                myMMI = myTokens[myMMIColumn]
-                myTuple = (myLon, myLat, myMMI)
-                self.mmiData.append(myTuple)
+            mySpecification = myHeader['grid_specification']
+            self.xMinimum = float(mySpecification['lon_min'])
+            self.xMaximum = float(mySpecification['lon_max'])
+            self.yMinimum = float(mySpecification['lat_min'])
+            self.yMaximum = float(mySpecification['lat_max'])
+            self.rows = float(mySpecification['nlat'])
+            self.columns = float(mySpecification['nlon'])
 
         except Exception, e:
             LOGGER.exception('Event parse failed')
@@ -391,12 +446,15 @@ class ShakeEvent(QObject):
 
         The returned string will look like this::
 
-           123.0750,01.7900,1
-           123.1000,01.7900,1.14
-           123.1250,01.7900,1.15
-           123.1500,01.7900,1.16
+           123.075,1.79,1.0
+           123.1,1.79,1.14
+           123.125,1.79,1.15
+           123.15,1.79,1.16
            etc...
 
+        Values are written in full precision, so they are those of the
+        grid but not necessarily in its formatting.
+
         Args: None
 
         Returns: str - a delimited text string that can easily be written to
@@ -405,10 +463,13 @@ class ShakeEvent(QObject):
         Raises: None
 
         """
-        myString = 'lon,lat,mmi\n'
-        for myRow in self.mmiData:
-            myString += '%s,%s,%s\n' % (myRow[0], myRow[1], myRow[2])
-        return myString
+        myLines = ['lon,lat,mmi']
+        # The repr of Python floats is the shortest string that reads
+        # back as the same value
+        for myRow in self.mmiData.tolist():
+            myLines.append('%r,%r,%r' % tuple(myRow))
+        myLines.append('')
+        return '\n'.join(myLines)
 
     def mmiDataToDelimitedFile(self, theForceFlag=True):
         """Save the mmiData to a delimited text file suitable for processing
@@ -590,13 +651,60 @@ class ShakeEvent(QObject):
         shutil.copyfile(mySourceQml, myQmlPath)
         return myShpPath
 
+    def _gridWithGdal(self, theAlgorithm, theTifPath, theForceFlag):
+        """Grid the mmiData to a tif file using gdal_grid.
+
+        Args:
+          theAlgorithm str gdal_grid algorithm, e.g. 'average'.
+          theTifPath str Path of the tif file to create.
+          theForceFlag bool Whether to force the regeneration of the
+            delimited text and vrt files.
+
+        Returns: None
+
+        Raises: Any exceptions will be propogated.
+        """
+        # Ensure the vrt mmi file exists (it will generate csv too if needed)
+        myVrtPath = self.mmiDataToVrt(theForceFlag)
+
+        # now generate the tif using default nearest neighbour interpoation
+        # options. This gives us the same output as the mi.grd generated by
+        # the earthquake server.
+
+        if 'invdist' in theAlgorithm:
+            myAlgorithm = 'invdist:power=2.0:smoothing=1.0'
+        else:
+            myAlgorithm = theAlgorithm
+
+        myOptions = {
+            'alg': myAlgorithm,
+            'xMin': self.xMinimum,
+            'xMax': self.xMaximum,
+            'yMin': self.yMinimum,
+            'yMax': self.yMaximum,
+            'dimX': self.columns,
+            'dimY': self.rows,
+            'vrt': myVrtPath,
+            'tif': theTifPath}
+
+        myCommand = (('gdal_grid -a %(alg)s -zfield "mmi" -txe %(xMin)s '
+                      '%(xMax)s -tye %(yMin)s %(yMax)s -outsize %(dimX)i '
+                      '%(dimY)i -of GTiff -ot Float16 -a_srs EPSG:4326 -l mmi '
+                      '%(vrt)s %(tif)s') % myOptions)
+
+        LOGGER.info('Created this gdal command:\n%s' % myCommand)
+        # Now run GDAL warp scottie...
+        self._runCommand(myCommand)
+
     def mmiDataToRaster(self, theForceFlag=False, theAlgorithm='nearest'):
         """Convert the grid.xml's mmi column to a raster using gdal_grid.
 
         A geotiff file will be created.
 
-        Unfortunately no python bindings exist for doing this so we are
-        going to do it using a shell call.
+        The 'nearest' and 'invdist' algorithms are calculated directly from
+        the parsed grid points (see :func:`grid_shake_data`), giving the
+        raster gdal_grid would make. For any other algorithm we shell out
+        to gdal_grid since no python bindings exist for it.
 
         .. seealso:: http://www.gdal.org/gdal_grid.html
 
@@ -643,37 +751,13 @@ class ShakeEvent(QObject):
         if os.path.exists(myTifPath) and theForceFlag is not True:
             return myTifPath
 
-        # Ensure the vrt mmi file exists (it will generate csv too if needed)
-        myVrtPath = self.mmiDataToVrt(theForceFlag)
-
-        # now generate the tif using default nearest neighbour interpoation
-        # options. This gives us the same output as the mi.grd generated by
-        # the earthquake server.
-
-        if 'invdist' in theAlgorithm:
-            myAlgorithm = 'invdist:power=2.0:smoothing=1.0'
+        if theAlgorithm in GRID_ALGORITHMS:
+            myGrid, myGeotransform = self.mmiDataToGrid(theForceFlag,
+                                                        theAlgorithm)
+            myRaster = Raster(data=myGrid, geotransform=myGeotransform)
+            myRaster.write_to_file(myTifPath)
         else:
-            myAlgorithm = theAlgorithm
-
-        myOptions = {
-            'alg': myAlgorithm,
-            'xMin': self.xMinimum,
-            'xMax': self.xMaximum,
-            'yMin': self.yMinimum,
-            'yMax': self.yMaximum,
-            'dimX': self.columns,
-            'dimY': self.rows,
-            'vrt': myVrtPath,
-            'tif': myTifPath}
-
-        myCommand = (('gdal_grid -a %(alg)s -zfield "mmi" -txe %(xMin)s '
-                      '%(xMax)s -tye %(yMin)s %(yMax)s -outsize %(dimX)i '
-                      '%(dimY)i -of GTiff -ot Float16 -a_srs EPSG:4326 -l mmi '
-                      '%(vrt)s %(tif)s') % myOptions)
-
-        LOGGER.info('Created this gdal command:\n%s' % myCommand)
-        # Now run GDAL warp scottie...
-        self._runCommand(myCommand)
+            self._gridWithGdal(theAlgorithm, myTifPath, theForceFlag)
 
         # copy the keywords file from fixtures for this layer
         myKeywordPath = os.path.join(
@@ -690,10 +774,41 @@ class ShakeEvent(QObject):
         shutil.copyfile(mySourceQml, myQmlPath)
         return myTifPath
 
+    def mmiDataToGrid(self, theForceFlag=False, theAlgorithm='nearest'):
+        """Grid the mmiData in memory.
+
+        Args:
+          theForceFlag bool (Optional). Whether to force the regeneration
+            of the tif file if it has to be made by gdal_grid.
+          theAlgorithm str (Optional). Which resampling algorithm to use.
+            See :func:`mmiDataToRaster`.
+
+        Returns: tuple of the array of mmi values and its geotransform.
+
+        Raises: Any exceptions will be propogated.
+        """
+        if theAlgorithm is None:
+            theAlgorithm = 'nearest'
+
+        if theAlgorithm in GRID_ALGORITHMS:
+            # The grid points are regular so grid the parsed values here
+            # rather than through a delimited text file, a vrt and gdal_grid
+            return grid_shake_data(
+                self.mmiData,
+                [self.xMinimum, self.yMinimum, self.xMaximum, self.yMaximum],
+                (self.rows, self.columns),
+                theAlgorithm)
+
+        myRaster = safe_read_layer(self.mmiDataToRaster(theForceFlag,
+                                                        theAlgorithm))
+        return myRaster.get_data(), myRaster.get_geotransform()
+
     def mmiDataToContours(self, theForceFlag=True, theAlgorithm='nearest'):
-        """Extract contours from the event's tif file.
+        """Extract contours from the event's mmi grid.
 
-        Contours are extracted at a 0.5 MMI interval. The resulting file will
+        Contours are extracted at a 0.5 MMI interval (see
+        :func:`contour_grid`) and their attributes calculated for all
+        contours at once before they are written. The resulting file will
         be saved in the extract directory. In the easiest use case you can
         simply do::
 
@@ -734,76 +849,44 @@ class ShakeEvent(QObject):
                     'Old contour files not deleted'
                     ' - this may indicate a file permissions issue.')
 
-        myTifPath = self.mmiDataToRaster(theForceFlag, theAlgorithm)
-        # Based largely on
-        # http://svn.osgeo.org/gdal/trunk/autotest/alg/contour.py
-        myDriver = ogr.GetDriverByName('ESRI Shapefile')
-        myOgrDataset = myDriver.CreateDataSource(myOutputFile)
-        if myOgrDataset is None:
-            # Probably the file existed and could not be overriden
-            raise ContourCreationError('Could not create datasource for:\n%s'
-                                       'Check that the file does not already '
-                                       'exist and that you '
-                                       'do not have file system permissions '
-                                       'issues')
-        myLayer = myOgrDataset.CreateLayer('contour')
-        myFieldDefinition = ogr.FieldDefn('ID', ogr.OFTInteger)
-        myLayer.CreateField(myFieldDefinition)
-        myFieldDefinition = ogr.FieldDefn('MMI', ogr.OFTReal)
-        myLayer.CreateField(myFieldDefinition)
-        # So we can fix the x pos to the same x coord as centroid of the
-        # feature so labels line up nicely vertically
-        myFieldDefinition = ogr.FieldDefn('X', ogr.OFTReal)
-        myLayer.CreateField(myFieldDefinition)
-        # So we can fix the y pos to the min y coord of the whole contour so
-        # labels line up nicely vertically
-        myFieldDefinition = ogr.FieldDefn('Y', ogr.OFTReal)
-        myLayer.CreateField(myFieldDefinition)
-        # So that we can set the html hex colour based on its MMI class
-        myFieldDefinition = ogr.FieldDefn('RGB', ogr.OFTString)
-        myLayer.CreateField(myFieldDefinition)
-        # So that we can set the label in it roman numeral form
-        myFieldDefinition = ogr.FieldDefn('ROMAN', ogr.OFTString)
-        myLayer.CreateField(myFieldDefinition)
-        # So that we can set the label horizontal alignment
-        myFieldDefinition = ogr.FieldDefn('ALIGN', ogr.OFTString)
-        myLayer.CreateField(myFieldDefinition)
-        # So that we can set the label vertical alignment
-        myFieldDefinition = ogr.FieldDefn('VALIGN', ogr.OFTString)
-        myLayer.CreateField(myFieldDefinition)
-        # So that we can set feature length to filter out small features
-        myFieldDefinition = ogr.FieldDefn('LEN', ogr.OFTReal)
-        myLayer.CreateField(myFieldDefinition)
-
-        myTifDataset = gdal.Open(myTifPath, GA_ReadOnly)
-        # see http://gdal.org/java/org/gdal/gdal/gdal.html for these options
-        myBand = 1
+        myGrid, myGeotransform = self.mmiDataToGrid(theForceFlag,
+                                                    theAlgorithm)
         myContourInterval = 0.5
-        myContourBase = 0
-        myFixedLevelList = []
-        myUseNoDataFlag = 0
-        myNoDataValue = -9999
-        myIdField = 0  # first field defined above
-        myElevationField = 1  # second (MMI) field defined above
+        myLines, myLevels = contour_grid(myGrid, myGeotransform,
+                                         myContourInterval)
+
+        # Attributes for styling and labelling all contours at once:
+        # X is the middle of the x range of each contour and Y its lowest
+        # y coordinate so labels line up nicely vertically, RGB the html
+        # hex colour and ROMAN the label of its MMI class (only on the
+        # whole number contours) and LEN its length to filter out small
+        # features
+        myBounds, myLengths = line_bounds_and_lengths(myLines)
+        myClasses = myLevels.astype(int)
+        myWholeFlags = myLevels == myClasses
+        myColumns = {
+            'ID': numpy.arange(len(myLines)),
+            'MMI': myLevels,
+            'X': (myBounds[:, 0] + myBounds[:, 2]) / 2,
+            'Y': myBounds[:, 1],
+            'RGB': numpy.array(MMI_COLOURS)[myClasses],
+            'ROMAN': numpy.where(myWholeFlags,
+                                 numpy.array(MMI_ROMAN_NUMERALS)[myClasses],
+                                 ''),
+            'ALIGN': numpy.repeat('Center', len(myLines)),
+            'VALIGN': numpy.repeat('HALF', len(myLines)),
+            'LEN': myLengths}
         try:
-            gdal.ContourGenerate(myTifDataset.GetRasterBand(myBand),
-                                 myContourInterval,
-                                 myContourBase,
-                                 myFixedLevelList,
-                                 myUseNoDataFlag,
-                                 myNoDataValue,
-                                 myLayer,
-                                 myIdField,
-                                 myElevationField)
+            myContours = Vector(data=myColumns,
+                                geometry=myLines,
+                                geometry_type='line',
+                                name='contour')
+            myContours.write_to_file(myOutputFile)
         except Exception, e:
             LOGGER.exception('Contour creation failed')
             raise ContourCreationError(str(e))
-        finally:
-            del myTifDataset
-            myOgrDataset.Release()
 
-        # Copy over the standard .prj file since ContourGenerate does not
-        # create a projection definition
+        # Copy over the standard .prj file
         myQmlPath = os.path.join(shakemapExtractDir(),
                                  self.eventId,
                                  'mmi-contours-%s.prj' % theAlgorithm)
@@ -817,12 +900,6 @@ class ShakeEvent(QObject):
         mySourceQml = os.path.join(dataDir(), 'mmi-contours.qml')
         shutil.copyfile(mySourceQml, myQmlPath)
 
-        # Now update the additional columns - X,Y, ROMAN and RGB
-        try:
-            self.setContourProperties(myOutputFile)
-        except InvalidLayerError:
-            raise
-
         return myOutputFile
 
     def romanize(self, theMMIValue):
@@ -840,10 +917,8 @@ class ShakeEvent(QObject):
             return ''
 
         LOGGER.debug('Romanising %f' % float(theMMIValue))
-        myRomanList = ['0', 'I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII',
-                       'IX', 'X', 'XI', 'XII']
         try:
-            myRoman = myRomanList[int(float(theMMIValue))]
+            myRoman = MMI_ROMAN_NUMERALS[int(float(theMMIValue))]
         except ValueError:
             LOGGER.exception('Error converting MMI value to roman')
             return None
@@ -859,12 +934,7 @@ class ShakeEvent(QObject):
         Raises:
             None
         """
-
-        myRGBList = ['#FFFFFF', '#FFFFFF', '#209fff', '#00cfff', '#55ffff',
-                     '#aaffff',
-                     '#fff000', '#ffa800', '#ff7000', '#ff0000', '#D00',
-                     '#800', '#400']
-        myRGB = myRGBList[int(theMMIValue)]
+        myRGB = MMI_COLOURS[int(theMMIValue)]
         return myRGB
 
     def mmiShaking(self, theMMIValue):
@@ -917,82 +987,6 @@ class ShakeEvent(QObject):
         }
         return myDamageDict[theMMIValue]
 
-    def setContourProperties(self, theFile):
-        """
-        Set the X, Y, RGB, ROMAN attributes of the contour layer.
-
-        Args: theFile str (Required) Name of the contour layer.
-
-        Returns: None
-
-        Raises: InvalidLayerError if anything is amiss with the layer.
-        """
-        LOGGER.debug('setContourProperties requested for %s.' % theFile)
-        myLayer = QgsVectorLayer(theFile, 'mmi-contours', "ogr")
-        if not myLayer.isValid():
-            raise InvalidLayerError(theFile)
-
-        myLayer.startEditing()
-        # Now loop through the db adding selected features to mem layer
-        myRequest = QgsFeatureRequest()
-        myFields = myLayer.dataProvider().fields()
-
-        for myFeature in myLayer.getFeatures(myRequest):
-            if not myFeature.isValid():
-                LOGGER.debug('Skipping feature')
-                continue
-            # Work out myX and myY
-            myLine = myFeature.geometry().asPolyline()
-            myY = myLine[0].y()
-
-            myXMax = myLine[0].x()
-            myXMin = myXMax
-            for myPoint in myLine:
-                if myPoint.y() < myY:
-                    myY = myPoint.y()
-                myX = myPoint.x()
-                if myX < myXMin:
-                    myXMin = myX
-                if myX > myXMax:
-                    myXMax = myX
-            myX = myXMin + ((myXMax - myXMin) / 2)
-
-            # Get length
-            myLength = myFeature.geometry().length()
-
-            myMMIValue = float(myFeature['MMI'].toString())
-
-            # We only want labels on the whole number contours
-            if myMMIValue != round(myMMIValue):
-                myRoman = ''
-            else:
-                myRoman = self.romanize(myMMIValue)
-
-            #LOGGER.debug('MMI: %s ----> %s' % (
-            #    myAttributes[myMMIIndex].toString(), myRoman))
-
-            # RGB from http://en.wikipedia.org/wiki/Mercalli_intensity_scale
-            myRGB = self.mmiColour(myMMIValue)
-
-            # Now update the feature
-            myId = myFeature.id()
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('X'), QVariant(myX))
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('Y'), QVariant(myY))
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('RGB'), QVariant(myRGB))
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('ROMAN'), QVariant(myRoman))
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('ALIGN'), QVariant('Center'))
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('VALIGN'), QVariant('HALF'))
-            myLayer.changeAttributeValue(
-                myId, myFields.indexFromName('LEN'), QVariant(myLength))
-
-        myLayer.commitChanges()
-
     def boundsToRectangle(self):
         """Convert the event bounding box to a QgsRectangle.
 
@@ -1205,17 +1199,7 @@ class ShakeEvent(QObject):
             raise InvalidLayerError('Layer failed to load!\n%s' % myPath)
 
         # Setup the cities table, querying on event bbox
-        # Path to sqlitedb containing geonames table
-        myDBPath = os.path.join(dataDir(), 'indonesia.sqlite')
-        myUri = QgsDataSourceURI()
-        myUri.setDatabase(myDBPath)
-        myTable = 'geonames'
-        myGeometryColumn = 'geom'
-        mySchema = ''
-        myUri.setDataSource(mySchema, myTable, myGeometryColumn)
-        myLayer = QgsVectorLayer(myUri.uri(), 'Towns', 'spatialite')
-        if not myLayer.isValid():
-            raise InvalidLayerError(myDBPath)
+        myLayer = cachedCitiesLayer()
         myRectangle = self.boundsToRectangle()
 
         # Do iterative selection using expanding selection area
@@ -1583,7 +1567,7 @@ class ShakeEvent(QObject):
 
         return myPath
 
-    def impactedCitiesTable(self, theCount=5):
+    def impactedCitiesTable(self, theCount=5, theCities=None):
         """Return a table object of sorted impacted cities.
 
         The cities will be listed in the order computed by sortedImpactedCities
@@ -1601,6 +1585,8 @@ class ShakeEvent(QObject):
 
         Args:
             theCount: optional maximum number of cities to show. Default is 5.
+            theCities: optional list of cities as returned by
+                sortedImpactedCities to use instead of looking them up again.
 
         Returns:
             two tuple of:
@@ -1610,7 +1596,10 @@ class ShakeEvent(QObject):
         Raises:
             Propogates any exceptions.
         """
-        myTableData = self.sortedImpactedCities(theCount)
+        if theCities is None:
+            myTableData = self.sortedImpactedCities(theCount)
+        else:
+            myTableData = theCities[:theCount]
         myTableBody = []
         myHeader = TableRow(['',
                              self.tr('Name'),
@@ -1630,8 +1619,9 @@ class ShakeEvent(QObject):
         myTable = Table(myTableBody, header_row=myHeader,
                         table_class='table table-striped table-condensed')
         # Also make an html file on disk
-        myPath = self.writeHtmlTable(theFileName='affected-cities.html',
-                                     theTable=myTable)
+        myPath = self.writeHtmlTable(
+            theFileName=self.localeFileName('affected-cities.html'),
+            theTable=myTable)
 
         return myTable, myPath
 
@@ -1687,8 +1677,9 @@ class ShakeEvent(QObject):
         myTableBody.append(myImpactRow)
         myTable = Table(myTableBody, header_row=myHeader,
                         table_class='table table-striped table-condensed')
-        myPath = self.writeHtmlTable(theFileName='impacts.html',
-                                     theTable=myTable)
+        myPath = self.writeHtmlTable(
+            theFileName=self.localeFileName('impacts.html'),
+            theTable=myTable)
         return myPath
 
     def calculateImpacts(self,
@@ -1738,13 +1729,17 @@ class ShakeEvent(QObject):
             thePopulationRasterPath=myExposurePath)
 
         myClippedHazardLayer = safe_read_layer(myClippedHazardPath)
-        myClippedExposureLayer = safe_read_layer(myClippedExposurePath)
+        # Memory map population so that it is read one block at a time
+        myClippedExposureLayer = safe_read_layer(myClippedExposurePath,
+                                                 memmap=True)
         myLayers = [myClippedHazardLayer, myClippedExposureLayer]
 
-        myFunctionId = 'I T B Fatality Function'
-        myFunction = safe_get_plugins(myFunctionId)[0][myFunctionId]
+        myFunction = cachedImpactFunction('I T B Fatality Function')
 
-        myResult = safe_calculate_impact(myLayers, myFunction)
+        # Keep the result in memory and export it as GeoTIFF straight
+        # into our extract dir for the map below
+        myResult = safe_calculate_impact(myLayers, myFunction,
+                                         write_mode='deferred')
         try:
             myFatalities = myResult.keywords['fatalites_per_mmi']
             myAffected = myResult.keywords['exposed_per_mmi']
@@ -1755,21 +1750,16 @@ class ShakeEvent(QObject):
                 'Fatalities_per_mmi key not found in:\n%s' %
                 myResult.keywords)
             raise
-        # Copy the impact layer into our extract dir.
+        # Write the impact layer and its keywords into our extract dir.
         myTifPath = os.path.join(shakemapExtractDir(),
                                  self.eventId,
                                  'impact-%s.tif' % theAlgorithm)
-        shutil.copyfile(myResult.filename, myTifPath)
-        LOGGER.debug('Copied impact result to:\n%s\n' % myTifPath)
-        # Copy the impact keywords layer into our extract dir.
+        safe_export_layer(myResult, myTifPath)
+        LOGGER.debug('Exported impact result to:\n%s\n' % myTifPath)
         myKeywordsPath = os.path.join(
             shakemapExtractDir(),
             self.eventId,
             'impact-%s.keywords' % theAlgorithm)
-        myKeywordsSource = os.path.splitext(myResult.filename)[0]
-        myKeywordsSource = '%s.keywords' % myKeywordsSource
-        shutil.copyfile(myKeywordsSource, myKeywordsPath)
-        LOGGER.debug('Copied impact keywords to:\n%s\n' % myKeywordsPath)
 
         self.impactFile = myTifPath
         self.impactKeywordsFile = myKeywordsPath
@@ -1798,14 +1788,15 @@ class ShakeEvent(QObject):
             pop).
 
         Raises:
-            FileNotFoundError
+            FileNotFoundError, InvalidLayerError
         """
 
         # _ is a syntactical trick to ignore second returned value
         myBaseName, _ = os.path.splitext(theShakeRasterPath)
         myHazardLayer = QgsRasterLayer(theShakeRasterPath, myBaseName)
-        myBaseName, _ = os.path.splitext(thePopulationRasterPath)
-        myExposureLayer = QgsRasterLayer(thePopulationRasterPath, myBaseName)
+        # The population mosaic is the same for every event
+        myExposureLayer, myExposureGeoCellSize = cachedRasterLayer(
+            thePopulationRasterPath)
 
         # Reproject all extents to EPSG:4326 if needed
         myGeoCrs = QgsCoordinateReferenceSystem()
@@ -1834,8 +1825,6 @@ class ShakeEvent(QObject):
         myHazardGeoCellSize = getWGS84resolution(myHazardLayer)
 
         # In case of two raster layers establish common resolution
-        myExposureGeoCellSize = getWGS84resolution(myExposureLayer)
-
         if myHazardGeoCellSize < myExposureGeoCellSize:
             myCellSize = myHazardGeoCellSize
         else:
@@ -1904,12 +1893,144 @@ class ShakeEvent(QObject):
         else:
             raise FileNotFoundError('Population file could not be found')
 
-    def renderMap(self, theForceFlag=False):
+    def mapPaths(self, theLocale=None):
+        """Get the paths of the map products of the event in a locale.
+
+        Args:
+            theLocale str - (Optional) locale of the products. Defaults to
+                the locale of this instance.
+
+        Returns:
+            str, str, str - paths to the pdf, png and thumbnail png.
+        """
+        if theLocale is None:
+            theLocale = self.locale
+        myDir = os.path.join(shakemapExtractDir(), self.eventId)
+        myPdfPath = os.path.join(
+            myDir, '%s-%s.pdf' % (self.eventId, theLocale))
+        myImagePath = os.path.join(
+            myDir, '%s-%s.png' % (self.eventId, theLocale))
+        myThumbnailImagePath = os.path.join(
+            myDir, '%s-thumb-%s.png' % (self.eventId, theLocale))
+        return myPdfPath, myImagePath, myThumbnailImagePath
+
+    def localeFileName(self, theFileName):
+        """Get the name of a file written for the locale of this instance.
+
+        Files of the en locale keep their plain name, e.g. impacts.html, and
+        files of other locales get the locale appended, e.g.
+        impacts-id.html, so that maps of several locales can be rendered at
+        the same time.
+
+        Args:
+            theFileName str - file name (without full path) e.g. impacts.html.
+
+        Returns:
+            str - file name for the locale.
+        """
+        if self.locale == 'en':
+            return theFileName
+        myBaseName, myExtension = os.path.splitext(theFileName)
+        return '%s-%s%s' % (myBaseName, self.locale, myExtension)
+
+    def generateProducts(self, theForceFlag=False, theAlgorithm='nearest'):
+        """Generate the products of the event that do not depend on locale.
+
+        The shapefiles of shake data, contours and cities, the impacted
+        cities and the impact calculation are the same in every locale. They
+        are made once here and can be passed to :func:`renderMap` of
+        ShakeEvent instances of the same event in other locales.
+
+        Args:
+            theForceFlag bool - (Optional). Whether to force the regeneration
+                of products. Defaults to False.
+            theAlgorithm str - (Optional) Which interpolation algorithm to
+                use to create the underlying raster. Defaults to 'nearest'.
+
+        Returns:
+            dict: paths and values of the products which can be pickled,
+                with keys 'mmi-shapefile', 'contours-shapefile',
+                'cities-shapefile', 'impacted-cities', 'extent-with-cities',
+                'impact-file', 'impact-keywords-file', 'fatality-counts',
+                'fatality-total', 'displaced-counts' and 'affected-counts'.
+
+        Raises:
+            Propagates any exceptions.
+        """
+        myMmiShapeFile = self.mmiDataToShapefile(theForceFlag=theForceFlag)
+        logging.info('Created: %s', myMmiShapeFile)
+        myCitiesShapeFile = None
+        myImpactedCities = None
+
+        myContoursShapeFile = self.mmiDataToContours(
+            theForceFlag=theForceFlag,
+            theAlgorithm=theAlgorithm)
+        logging.info('Created: %s', myContoursShapeFile)
+        try:
+            myCitiesShapeFile = self.citiesToShapefile(
+                theForceFlag=theForceFlag)
+            logging.info('Created: %s', myCitiesShapeFile)
+            mySearchBoxFile = self.citySearchBoxesToShapefile(
+                theForceFlag=theForceFlag)
+            logging.info('Created: %s', mySearchBoxFile)
+            myImpactedCities = self.sortedImpactedCities()
+        except:  # pylint: disable=W0702
+            logging.exception('No nearby cities found!')
+
+        myImpactFile, _ = self.calculateImpacts(theAlgorithm=theAlgorithm)
+        logging.info('Created: %s', myImpactFile)
+
+        myExtent = None
+        if self.extentWithCities is not None:
+            myExtent = (self.extentWithCities.xMinimum(),
+                        self.extentWithCities.yMinimum(),
+                        self.extentWithCities.xMaximum(),
+                        self.extentWithCities.yMaximum())
+
+        return {'mmi-shapefile': myMmiShapeFile,
+                'contours-shapefile': myContoursShapeFile,
+                'cities-shapefile': myCitiesShapeFile,
+                'impacted-cities': myImpactedCities,
+                'extent-with-cities': myExtent,
+                'impact-file': self.impactFile,
+                'impact-keywords-file': self.impactKeywordsFile,
+                'fatality-counts': self.fatalityCounts,
+                'fatality-total': self.fatalityTotal,
+                'displaced-counts': self.displacedCounts,
+                'affected-counts': self.affectedCounts}
+
+    def setProducts(self, theProducts):
+        """Set the state of this instance from shared products.
+
+        Args:
+            theProducts dict - products of the same event made by
+                :func:`generateProducts`, possibly in another locale.
+
+        Returns:
+            None
+        """
+        myExtent = theProducts['extent-with-cities']
+        if myExtent is not None:
+            self.extentWithCities = QgsRectangle(*myExtent)
+        myImpactedCities = theProducts['impacted-cities']
+        if myImpactedCities:
+            self.mostAffectedCity = myImpactedCities[0]
+        self.impactFile = theProducts['impact-file']
+        self.impactKeywordsFile = theProducts['impact-keywords-file']
+        self.fatalityCounts = theProducts['fatality-counts']
+        self.fatalityTotal = theProducts['fatality-total']
+        self.displacedCounts = theProducts['displaced-counts']
+        self.affectedCounts = theProducts['affected-counts']
+
+    def renderMap(self, theForceFlag=False, theProducts=None):
         """This is the 'do it all' method to render a pdf.
 
         Args:
             theForceFlag bool - (Optional). Whether to force the regeneration
                 of map product. Defaults to False.
+            theProducts dict - (Optional) locale independent products made
+                by :func:`generateProducts`, e.g. by a ShakeEvent of the same
+                event in another locale. They are generated if not given.
 
         Returns:
             str - path to rendered pdf.
@@ -1917,16 +2038,7 @@ class ShakeEvent(QObject):
         Raises:
             Propagates any exceptions.
         """
-        myPdfPath = os.path.join(shakemapExtractDir(),
-                                 self.eventId,
-                                 '%s-%s.pdf' % (self.eventId, self.locale))
-        myImagePath = os.path.join(shakemapExtractDir(),
-                                   self.eventId,
-                                   '%s-%s.png' % (self.eventId, self.locale))
-        myThumbnailImagePath = os.path.join(shakemapExtractDir(),
-                                            self.eventId,
-                                            '%s-thumb-%s.png' % (
-                                            self.eventId, self.locale))
+        myPdfPath, myImagePath, myThumbnailImagePath = self.mapPaths()
 
         if not theForceFlag:
             # Check if the images already exist and if so
@@ -1949,33 +2061,26 @@ class ShakeEvent(QObject):
         # noinspection PyArgumentList
         QgsMapLayerRegistry.instance().removeAllMapLayers()
 
-        myMmiShapeFile = self.mmiDataToShapefile(theForceFlag=theForceFlag)
-        logging.info('Created: %s', myMmiShapeFile)
-        myCitiesHtmlPath = None
-        myCitiesShapeFile = None
-
         # 'average', 'invdist', 'nearest' - currently only nearest works
-        myAlgorithm = 'nearest'
-        try:
-            myContoursShapeFile = self.mmiDataToContours(
-                theForceFlag=theForceFlag,
-                theAlgorithm=myAlgorithm)
-        except:
-            raise
-        logging.info('Created: %s', myContoursShapeFile)
-        try:
-            myCitiesShapeFile = self.citiesToShapefile(
-                theForceFlag=theForceFlag)
-            logging.info('Created: %s', myCitiesShapeFile)
-            mySearchBoxFile = self.citySearchBoxesToShapefile(
-                theForceFlag=theForceFlag)
-            logging.info('Created: %s', mySearchBoxFile)
-            _, myCitiesHtmlPath = self.impactedCitiesTable()
-            logging.info('Created: %s', myCitiesHtmlPath)
-        except:  # pylint: disable=W0702
-            logging.exception('No nearby cities found!')
+        if theProducts is None:
+            theProducts = self.generateProducts(theForceFlag=theForceFlag,
+                                                theAlgorithm='nearest')
+        else:
+            self.setProducts(theProducts)
+        myContoursShapeFile = theProducts['contours-shapefile']
+        myCitiesShapeFile = theProducts['cities-shapefile']
+
+        # Only the html tables and the map itself are translated
+        myCitiesHtmlPath = None
+        if theProducts['impacted-cities'] is not None:
+            try:
+                _, myCitiesHtmlPath = self.impactedCitiesTable(
+                    theCities=theProducts['impacted-cities'])
+                logging.info('Created: %s', myCitiesHtmlPath)
+            except:  # pylint: disable=W0702
+                logging.exception('No nearby cities found!')
 
-        _, myImpactsHtmlPath = self.calculateImpacts()
+        myImpactsHtmlPath = self.impactTable()
         logging.info('Created: %s', myImpactsHtmlPath)
 
         # Load our project
@@ -2123,7 +2228,7 @@ class ShakeEvent(QObject):
         myTemplatePath = os.path.join(
             shakemapExtractDir(),
             self.eventId,
-            'composer-template.qpt')
+            self.localeFileName('composer-template.qpt'))
         myFile = file(myTemplatePath, 'wt')
         myFile.write(myTemplateDocument.toByteArray())
         myFile.close()
@@ -2133,7 +2238,7 @@ class ShakeEvent(QObject):
         myProjectPath = os.path.join(
             shakemapExtractDir(),
             self.eventId,
-            'project.qgs')
+            self.localeFileName('project.qgs'))
         myProject.write(QFileInfo(myProjectPath))
 
     def bearingToCardinal(self, theBearing):
@@ -2408,7 +2513,7 @@ class ShakeEvent(QObject):
         else:
             myExtentWithCities = 'Not set'
 
-        if self.mmiData:
+        if self.mmiData is not None and len(self.mmiData):
             mmiData = 'Populated'
         else:
             mmiData = 'Not populated'
@@ -86,7 +86,10 @@ class TestShakeEvent(unittest.TestCase):
         self.assertEquals(25921, len(myGridXmlData))
 
         myDelimitedString = myShakeEvent.mmiDataToDelimitedText()
-        self.assertEqual(578234, len(myDelimitedString))
+        self.assertEqual(470677, len(myDelimitedString))
+        # Values as in the grid, e.g. 122.4500 01.7900 and MMI 1
+        self.assertEqual('lon,lat,mmi\n122.45,1.79,1.0\n',
+                         myDelimitedString[:28])
 
     def test_eventGridToCsv(self):
         """Test grid data can be written to csv"""
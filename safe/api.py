@@ -22,15 +22,17 @@ __copyright__ = ('Copyright 2012, Australia Indonesia Facility for '
 
 # pylint: disable=W0611
 from safe.storage.vector import Vector
+from safe.storage.raster import Raster
 from safe.defaults import DEFAULTS
 from safe.storage.utilities import (bbox_intersection,
                                     buffered_bounding_box,
                                     verify,
                                     write_keywords,
                                     read_keywords,
-                                    calculate_polygon_centroid)
+                                    calculate_polygon_centroid,
+                                    calculate_polygon_centroids)
 
-from safe.storage.core import read_layer
+from safe.storage.core import read_layer, export_layer, write_binary_layer
 
 from safe.impact_functions import (get_plugins,
                                    get_function_title,
@@ -41,7 +43,8 @@ from safe.impact_functions.core import (get_doc_string,
                                         get_unique_values,
                                         get_plugins_as_table)
 
-from safe.engine.core import calculate_impact
+from safe.engine.core import calculate_impact, calculate_impacts
+from safe.engine.interpolation import INTERPOLATION_CACHE
 
 from safe.common.numerics import nanallclose
 from safe.common.exceptions import (InaSAFEError,
@@ -56,6 +59,9 @@ from safe.common.utilities import (VerificationError,
                                    get_free_memory,
                                    format_int)
 from safe.common.converter import convert_mmi_data
+from safe.common.shake_grid import (read_grid_xml, grid_shake_data,
+                                    GRID_ALGORITHMS)
+from safe.common.contours import contour_grid, line_bounds_and_lengths
 from safe.common.version import get_version
 from safe.common.polygon import in_and_outside_polygon
 from safe.common.tables import Table, TableCell, TableRow
@@ -0,0 +1,232 @@
+"""**Contour lines of gridded data**
+
+Contours are traced with marching squares on the lattice of cell centres
+as gdal_contour does. Values equal to a contour level count as above it
+and squares with a missing (NaN) corner are left out.
+"""
+
+import numpy
+
+# Segments in a square for each case of corners above the level, where
+# case = 8 * top left + 4 * top right + 2 * bottom right + bottom left and
+# edges are numbered 0 top, 1 right, 2 bottom and 3 left.
+# The saddles 5 and 10 are resolved by the mean of the corners below.
+SQUARE_SEGMENTS = {1: [(3, 2)],
+                   2: [(2, 1)],
+                   3: [(3, 1)],
+                   4: [(0, 1)],
+                   6: [(0, 2)],
+                   7: [(0, 3)],
+                   8: [(0, 3)],
+                   9: [(0, 2)],
+                   11: [(0, 1)],
+                   12: [(3, 1)],
+                   13: [(2, 1)],
+                   14: [(3, 2)]}
+
+# Segments of saddles with centre below and above the level
+SADDLE_SEGMENTS = {5: ([(0, 1), (3, 2)], [(0, 3), (2, 1)]),
+                   10: ([(0, 3), (2, 1)], [(0, 1), (3, 2)])}
+
+
+def contour_grid(A, geotransform, interval, base=0.0):
+    """Calculate contour lines of gridded values
+
+    Args:
+        * A: Array of values with NaN where missing
+        * geotransform: GDAL geotransform of A without rotation
+        * interval: Difference between contour levels
+        * base: Level from which contour levels are counted. Levels are
+              base + k * interval for all integers k between the smallest
+              and largest values of A.
+
+    Returns:
+        * lines: List of arrays of x and y coordinates, one for each
+              contour line. Closed lines end with their first point.
+              Lines of zero length are left out.
+        * levels: Array of contour level of each line
+
+    Note:
+        Values of A are taken to be at the centres of cells like
+        gdal_contour and GDAL ContourGenerate do.
+    """
+
+    A = numpy.asarray(A, dtype=numpy.float64)
+    rows, columns = A.shape
+    x = geotransform[0] + (numpy.arange(columns) + 0.5) * geotransform[1]
+    y = geotransform[3] + (numpy.arange(rows) + 0.5) * geotransform[5]
+
+    lines = []
+    levels = []
+    if rows < 2 or columns < 2 or numpy.all(numpy.isnan(A)):
+        return lines, numpy.array(levels)
+
+    low = numpy.ceil((numpy.nanmin(A) - base) / interval)
+    high = numpy.floor((numpy.nanmax(A) - base) / interval)
+    for k in numpy.arange(low, high + 1):
+        level = base + k * interval
+        level_lines = _contour_level(A, x, y, level)
+        lines.extend(level_lines)
+        levels.extend([level] * len(level_lines))
+
+    return lines, numpy.array(levels)
+
+
+def line_bounds_and_lengths(lines):
+    """Bounding boxes and lengths of lines
+
+    Args:
+        * lines: List of arrays of x and y coordinates with at least two
+              points each, e.g. from contour_grid
+
+    Returns:
+        * bounds: Array with one row [xmin, ymin, xmax, ymax] per line
+        * lengths: Array of the length of each line in the units of the
+              coordinates
+    """
+
+    if len(lines) == 0:
+        return numpy.zeros((0, 4)), numpy.zeros(0)
+
+    sizes = numpy.array([len(line) for line in lines])
+    starts = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+    points = numpy.concatenate(lines)
+
+    bounds = numpy.zeros((len(lines), 4))
+    bounds[:, :2] = numpy.minimum.reduceat(points, starts)
+    bounds[:, 2:] = numpy.maximum.reduceat(points, starts)
+
+    # Lengths of all segments including those joining consecutive lines
+    segments = numpy.zeros(len(points))
+    steps = numpy.diff(points, axis=0)
+    segments[1:] = numpy.sqrt(steps[:, 0] ** 2 + steps[:, 1] ** 2)
+    segments[starts] = 0
+    lengths = numpy.add.reduceat(segments, starts)
+
+    return bounds, lengths
+
+
+def _contour_level(A, x, y, level):
+    """Contour lines of one level
+
+    Args:
+        * A: Array of values
+        * x, y: Coordinates of columns and rows of A
+        * level: Contour level
+
+    Returns:
+        * List of arrays of coordinates of lines
+    """
+
+    rows, columns = A.shape
+    with numpy.errstate(invalid='ignore'):
+        above = (A >= level).astype(numpy.int8)
+    corners = A[:-1, :-1] + A[:-1, 1:] + A[1:, 1:] + A[1:, :-1]
+    cases = (8 * above[:-1, :-1] + 4 * above[:-1, 1:] +
+             2 * above[1:, 1:] + above[1:, :-1])
+    cases[numpy.isnan(corners)] = 0
+
+    # Edge numbers. Horizontal edges between A[i, j] and A[i, j + 1] are
+    # i * (columns - 1) + j and vertical edges between A[i, j] and
+    # A[i + 1, j] follow as horizontal + i * columns + j
+    horizontal = rows * (columns - 1)
+    i, j = numpy.mgrid[:rows - 1, :columns - 1]
+    top = i * (columns - 1) + j
+    square_edges = numpy.array([top.ravel(),
+                                (horizontal + i * columns + j + 1).ravel(),
+                                (top + columns - 1).ravel(),
+                                (horizontal + i * columns + j).ravel()])
+    cases = cases.ravel()
+
+    segments = []
+    for case, pairs in SQUARE_SEGMENTS.items():
+        squares = numpy.nonzero(cases == case)[0]
+        for pair in pairs:
+            segments.append(square_edges[list(pair)][:, squares])
+
+    for case, (below, centre_above) in SADDLE_SEGMENTS.items():
+        squares = numpy.nonzero(cases == case)[0]
+        if len(squares) == 0:
+            continue
+        centre = corners.ravel()[squares] / 4
+        for pairs, selected in [(below, centre < level),
+                                (centre_above, centre >= level)]:
+            for pair in pairs:
+                segments.append(
+                    square_edges[list(pair)][:, squares[selected]])
+
+    segments = numpy.concatenate(segments, axis=1).T
+    if len(segments) == 0:
+        return []
+
+    # Crossings of level on the edges
+    edges = numpy.unique(segments)
+    is_horizontal = edges < horizontal
+    k = numpy.where(is_horizontal, edges, edges - horizontal)
+    n = numpy.where(is_horizontal, columns - 1, columns)
+    i = k // n
+    j = k % n
+    i1 = numpy.where(is_horizontal, i, i + 1)
+    j1 = numpy.where(is_horizontal, j + 1, j)
+    a = A[i, j]
+    t = (level - a) / (A[i1, j1] - a)
+    points = numpy.zeros((len(edges), 2))
+    points[:, 0] = x[j] + t * (x[j1] - x[j])
+    points[:, 1] = y[i] + t * (y[i1] - y[i])
+
+    lines = []
+    for line in _join_segments(segments):
+        line = points[numpy.searchsorted(edges, line)]
+
+        # Skip lines collapsed onto grid points equal to the level
+        if not numpy.all(line == line[0]):
+            lines.append(line)
+
+    return lines
+
+
+def _join_segments(segments):
+    """Join segments sharing end points into lines
+
+    Args:
+        * segments: Array with two end point numbers for each segment.
+              Each end point is shared by at most two segments.
+
+    Returns:
+        * List of arrays of end point numbers, one for each line. Lines
+          start at end points of single segments where possible and
+          closed lines end with their first point.
+    """
+
+    # Partner of each end (2 * segment + side) sharing its end point
+    ends = segments.ravel()
+    order = numpy.argsort(ends, kind='mergesort')
+    shared = numpy.nonzero(ends[order][1:] == ends[order][:-1])[0]
+    partner = -numpy.ones(len(ends), dtype=int)
+    partner[order[shared]] = order[shared + 1]
+    partner[order[shared + 1]] = order[shared]
+
+    visited = numpy.zeros(len(segments), dtype=bool)
+    starts = numpy.nonzero(partner < 0)[0].tolist()
+    starts += [2 * s for s in range(len(segments))]
+
+    lines = []
+    partner = partner.tolist()
+    for start in starts:
+        segment, side = divmod(start, 2)
+        if visited[segment]:
+            continue
+
+        line = [segments[segment, side]]
+        while True:
+            visited[segment] = True
+            line.append(segments[segment, 1 - side])
+            following = partner[2 * segment + 1 - side]
+            if following < 0:
+                break
+            segment, side = divmod(following, 2)
+            if visited[segment]:
+                break
+        lines.append(numpy.array(line))
+
+    return lines
@@ -21,13 +21,15 @@ __copyright__ = ('Copyright 2012, Australia Indonesia Facility for '
 import os
 import sys
 import shutil
-from xml.dom import minidom
 from subprocess import call, CalledProcessError
 import logging
 
 
 from safe.common.exceptions import (GridXmlFileNotFoundError,
                                     GridXmlParseError)
+from safe.common.shake_grid import (read_grid_xml, grid_shake_data,
+                                    GRID_ALGORITHMS)
+from safe.storage.raster import Raster
 
 # The logger is initialised in utils.py by init
 LOGGER = logging.getLogger('InaSAFE')
@@ -193,6 +195,9 @@ class ShakeEvent():
            fields and attributes. Also it provides all the data we need in a
            single file.
 
+        The header is parsed incrementally and the data block converted to
+        numbers in blocks (see :func:`read_grid_xml`). self.mmiData is set
+        to an array of floats with columns lon, lat and mmi.
 
         Args: None
 
@@ -204,61 +209,28 @@ class ShakeEvent():
         myPath = self.gridFilePath()
         print myPath
         try:
-            myDocument = minidom.parse(myPath)
-            myEventElement = myDocument.getElementsByTagName('event')
-            myEventElement = myEventElement[0]
-            self.magnitude = float(myEventElement.attributes[
-                'magnitude'].nodeValue)
-            self.longitude = float(myEventElement.attributes[
-                'lon'].nodeValue)
-            self.latitude = float(myEventElement.attributes[
-                'lat'].nodeValue)
-            self.location = myEventElement.attributes[
-                'event_description'].nodeValue.strip()
-            self.depth = float(myEventElement.attributes['depth'].nodeValue)
+            myHeader, self.mmiData = read_grid_xml(myPath)
+            myEvent = myHeader['event']
+            self.magnitude = float(myEvent['magnitude'])
+            self.longitude = float(myEvent['lon'])
+            self.latitude = float(myEvent['lat'])
+            self.location = myEvent['event_description'].strip()
+            self.depth = float(myEvent['depth'])
             # Get the date - its going to look something like this:
             # 2012-08-07T01:55:12WIB
-            myTimeStamp = myEventElement.attributes[
-                'event_timestamp'].nodeValue
+            myTimeStamp = myEvent['event_timestamp']
             self.extractDateTime(myTimeStamp)
             # Note the timezone here is inconsistent with YZ from grid.xml
             # use the latter
             self.timeZone = myTimeStamp[-3:]
 
-            mySpecificationElement = myDocument.getElementsByTagName(
-                'grid_specification')
-            mySpecificationElement = mySpecificationElement[0]
-            self.xMinimum = float(mySpecificationElement.attributes[
-                'lon_min'].nodeValue)
-            self.xMaximum = float(mySpecificationElement.attributes[
-                'lon_max'].nodeValue)
-            self.yMinimum = float(mySpecificationElement.attributes[
-                'lat_min'].nodeValue)
-            self.yMaximum = float(mySpecificationElement.attributes[
-                'lat_max'].nodeValue)
-            self.rows = float(mySpecificationElement.attributes[
-                'nlat'].nodeValue)
-            self.columns = float(mySpecificationElement.attributes[
-                'nlon'].nodeValue)
-            myDataElement = myDocument.getElementsByTagName(
-                'grid_data')
-            myDataElement = myDataElement[0]
-            myData = myDataElement.firstChild.nodeValue
-            # Extract the 1,2 and 5th (MMI) columns and populate mmiData
-            myLonColumn = 0
-            myLatColumn = 1
-            myMMIColumn = 4
-            self.mmiData = []
-            for myLine in myData.split('\n'):
-                # print myLine
-                if not myLine:
-                    continue
-                myTokens = myLine.split(' ')
-                myLon = myTokens[myLonColumn]
-                myLat = myTokens[myLatColumn]
-                myMMI = myTokens[myMMIColumn]
-                myTuple = (myLon, myLat, myMMI)
-                self.mmiData.append(myTuple)
+            mySpecification = myHeader['grid_specification']
+            self.xMinimum = float(mySpecification['lon_min'])
+            self.xMaximum = float(mySpecification['lon_max'])
+            self.yMinimum = float(mySpecification['lat_min'])
+            self.yMaximum = float(mySpecification['lat_max'])
+            self.rows = float(mySpecification['nlat'])
+            self.columns = float(mySpecification['nlon'])
 
         except Exception, e:
             LOGGER.exception('Event parse failed')
@@ -276,12 +248,15 @@ class ShakeEvent():
 
         The returned string will look like this::
 
-           123.0750,01.7900,1
-           123.1000,01.7900,1.14
-           123.1250,01.7900,1.15
-           123.1500,01.7900,1.16
+           123.075,1.79,1.0
+           123.1,1.79,1.14
+           123.125,1.79,1.15
+           123.15,1.79,1.16
            etc...
 
+        Values are written in full precision, so they are those of the
+        grid but not necessarily in its formatting.
+
         Args: None
 
         Returns: str - a delimited text string that can easily be written to
@@ -290,10 +265,13 @@ class ShakeEvent():
         Raises: None
 
         """
-        myString = 'lon,lat,mmi\n'
-        for myRow in self.mmiData:
-            myString += '%s,%s,%s\n' % (myRow[0], myRow[1], myRow[2])
-        return myString
+        myLines = ['lon,lat,mmi']
+        # The repr of Python floats is the shortest string that reads
+        # back as the same value
+        for myRow in self.mmiData.tolist():
+            myLines.append('%r,%r,%r' % tuple(myRow))
+        myLines.append('')
+        return '\n'.join(myLines)
 
     def mmiDataToDelimitedFile(self, theForceFlag=True):
         """Save the mmiData to a delimited text file suitable for processing
@@ -427,14 +405,62 @@ class ShakeEvent():
             else:
                 raise Exception(myMessage)
 
+    def _gridWithGdal(self, theAlgorithm, theTifPath, theForceFlag):
+        """Grid the mmiData to a tif file using gdal_grid.
+
+        Args:
+          theAlgorithm str gdal_grid algorithm, e.g. 'average'.
+          theTifPath str Path of the tif file to create.
+          theForceFlag bool Whether to force the regeneration of the
+            delimited text and vrt files.
+
+        Returns: None
+
+        Raises: Any exceptions will be propogated.
+        """
+        # Ensure the vrt mmi file exists (it will generate csv too if needed)
+        myVrtPath = self.mmiDataToVrt(theForceFlag)
+
+        # now generate the tif using default nearest neighbour interpolation
+        # options. This gives us the same output as the mi.grd generated by
+        # the earthquake server.
+
+        if 'invdist' in theAlgorithm:
+            myAlgorithm = 'invdist:power=2.0:smoothing=1.0'
+        else:
+            myAlgorithm = theAlgorithm
+
+        # TODO(Sunni): I'm not sure how this 'mmi' will work
+        myCommand = (('gdal_grid -a %(alg)s -zfield "mmi" -txe %(xMin)s '
+                      '%(xMax)s -tye %(yMin)s %(yMax)s -outsize %(dimX)i '
+                      '%(dimY)i -of GTiff -ot Float16 -a_srs EPSG:4326 -l mmi '
+                      '%(vrt)s %(tif)s') %
+                     {
+                         'alg': myAlgorithm,
+                         'xMin': self.xMinimum,
+                         'xMax': self.xMaximum,
+                         'yMin': self.yMinimum,
+                         'yMax': self.yMaximum,
+                         'dimX': self.columns,
+                         'dimY': self.rows,
+                         'vrt': myVrtPath,
+                         'tif': theTifPath
+                     })
+
+        LOGGER.info('Created this gdal command:\n%s' % myCommand)
+        # Now run GDAL warp scottie...
+        self._runCommand(myCommand)
+
     def mmiDataToRaster(self, theForceFlag=False,
                         theAlgorithm='nearest'):
         """Convert the grid.xml' s mmi column to a raster using gdal_grid.
 
         A geotiff file will be created.
 
-        Unfortunately no python bindings exist for doing this so we are
-        going to do it using a shell call.
+        The 'nearest' and 'invdist' algorithms are calculated directly from
+        the parsed grid points (see :func:`grid_shake_data`), giving the
+        raster gdal_grid would make. For any other algorithm we shell out
+        to gdal_grid since no python bindings exist for it.
 
         .. see also:: http://www.gdal.org/gdal_grid.html
 
@@ -485,38 +511,18 @@ class ShakeEvent():
         if os.path.exists(myTifPath) and theForceFlag is not True:
             return myTifPath
 
-        # Ensure the vrt mmi file exists (it will generate csv too if needed)
-        myVrtPath = self.mmiDataToVrt(theForceFlag)
-
-        # now generate the tif using default nearest neighbour interpolation
-        # options. This gives us the same output as the mi.grd generated by
-        # the earthquake server.
-
-        if 'invdist' in theAlgorithm:
-            myAlgorithm = 'invdist:power=2.0:smoothing=1.0'
+        if theAlgorithm in GRID_ALGORITHMS:
+            # The grid points are regular so grid the parsed values here
+            # rather than through a delimited text file, a vrt and gdal_grid
+            myGrid, myGeotransform = grid_shake_data(
+                self.mmiData,
+                [self.xMinimum, self.yMinimum, self.xMaximum, self.yMaximum],
+                (self.rows, self.columns),
+                theAlgorithm)
+            myRaster = Raster(data=myGrid, geotransform=myGeotransform)
+            myRaster.write_to_file(myTifPath)
         else:
-            myAlgorithm = theAlgorithm
-
-        # TODO(Sunni): I'm not sure how this 'mmi' will work
-        myCommand = (('gdal_grid -a %(alg)s -zfield "mmi" -txe %(xMin)s '
-                      '%(xMax)s -tye %(yMin)s %(yMax)s -outsize %(dimX)i '
-                      '%(dimY)i -of GTiff -ot Float16 -a_srs EPSG:4326 -l mmi '
-                      '%(vrt)s %(tif)s') %
-                     {
-                         'alg': myAlgorithm,
-                         'xMin': self.xMinimum,
-                         'xMax': self.xMaximum,
-                         'yMin': self.yMinimum,
-                         'yMax': self.yMaximum,
-                         'dimX': self.columns,
-                         'dimY': self.rows,
-                         'vrt': myVrtPath,
-                         'tif': myTifPath
-                     })
-
-        LOGGER.info('Created this gdal command:\n%s' % myCommand)
-        # Now run GDAL warp scottie...
-        self._runCommand(myCommand)
+            self._gridWithGdal(theAlgorithm, myTifPath, theForceFlag)
 
         # copy the keywords file from fixtures for this layer
         self.create_keyword_file(theAlgorithm)
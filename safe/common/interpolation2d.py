@@ -48,7 +48,8 @@ def interpolate2d(x, y, Z, points, mode='linear', bounds_error=False):
               is returned for those values
 
     Returns:
-        * 1D array with same length as points with interpolated values
+        * 1D float64 array with same length as points with interpolated
+          values
 
     Raises: Exception, BoundsError (see note about bounds_error)
 
@@ -57,6 +58,10 @@ def interpolate2d(x, y, Z, points, mode='linear', bounds_error=False):
         but need not be equidistantly spaced. No such assumption regarding
         ordering of points is made.
 
+        If x or y are equidistant, as the axes of raster layers are, the
+        neighbours of each point along them are found by division rather
+        than searching (see find_upper_neighbours).
+
         Z is assumed to have dimension M x N, where M = len(x) and N = len(y).
         In other words it is assumed that the x values follow the first
         (vertical) axis downwards and y values the second (horizontal) axis
@@ -72,26 +77,16 @@ def interpolate2d(x, y, Z, points, mode='linear', bounds_error=False):
     x, y, Z, xi, eta = check_inputs(x, y, Z, points, mode, bounds_error)
 
     # Identify elements that are outside interpolation domain or NaN
-    outside = (xi < x[0]) + (eta < y[0]) + (xi > x[-1]) + (eta > y[-1])
-    outside += numpy.isnan(xi) + numpy.isnan(eta)
+    outside = (xi < x[0]) | (eta < y[0]) | (xi > x[-1]) | (eta > y[-1])
+    outside |= numpy.isnan(xi) | numpy.isnan(eta)
 
-    inside = -outside
+    inside = ~outside
     xi = xi[inside]
     eta = eta[inside]
 
     # Find upper neighbours for each interpolation point
-    idx = numpy.searchsorted(x, xi, side='left')
-    idy = numpy.searchsorted(y, eta, side='left')
-
-    # Internal check (index == 0 is OK)
-    msg = ('Interpolation point outside domain. This should never happen. '
-           'Please email Ole.Moller.Nielsen@gmail.com')
-    if len(idx) > 0:
-        if not max(idx) < len(x):
-            raise InaSAFEError(msg)
-    if len(idy) > 0:
-        if not max(idy) < len(y):
-            raise InaSAFEError(msg)
+    idx = find_upper_neighbours(x, xi)
+    idy = find_upper_neighbours(y, eta)
 
     # Get the four neighbours for each interpolation point
     x0 = x[idx - 1]
@@ -115,18 +110,35 @@ def interpolate2d(x, y, Z, points, mode='linear', bounds_error=False):
         dx = z10 - z00
         dy = z01 - z00
         z = z00 + alpha * dx + beta * dy + alpha * beta * (z11 - dx - dy - z00)
+
+        # Self test against the four neighbours allowing for rounding
+        # in the precision of the grid
+        if Z.dtype.kind == 'f':
+            tolerance = max(1.0e-12, 16 * numpy.finfo(Z.dtype).eps)
+        else:
+            tolerance = 1.0e-12
+        upper = numpy.fmax(numpy.fmax(z00, z01), numpy.fmax(z10, z11))
+        oldset = numpy.seterr(invalid='ignore')
+        exceeded = z > upper + tolerance * numpy.abs(upper)
+        numpy.seterr(**oldset)
+        if numpy.any(exceeded):
+            i = numpy.where(exceeded)[0][0]
+            msg = ('Internal check failed. Interpolated value %.15f '
+                   'exceeds largest neighbouring grid value %.15f'
+                   % (z[i], upper[i]))
+            raise InaSAFEError(msg)
     else:
         # Piecewise constant (as verified in input_check)
 
         # Set up masks for the quadrants
         left = alpha < 0.5
-        right = -left
+        right = ~left
         lower = beta < 0.5
-        upper = -lower
+        upper = ~lower
 
-        lower_left = lower * left
-        lower_right = lower * right
-        upper_left = upper * left
+        lower_left = lower & left
+        lower_right = lower & right
+        upper_left = upper & left
 
         # Initialise result array with all elements set to upper right
         z = z11
@@ -136,25 +148,68 @@ def interpolate2d(x, y, Z, points, mode='linear', bounds_error=False):
         z[lower_right] = z10[lower_right]
         z[upper_left] = z01[upper_left]
 
-    # Self test
-    if len(z) > 0:
-        mz = numpy.nanmax(z)
-        mZ = numpy.nanmax(Z)
-        msg = ('Internal check failed. Max interpolated value %.15f '
-               'exceeds max grid value %.15f ' % (mz, mZ))
-        if not(numpy.isnan(mz) or numpy.isnan(mZ)):
-            if not mz <= mZ:
-                raise InaSAFEError(msg)
-
     # Populate result with interpolated values for points inside domain
     # and NaN for values outside
-    r = numpy.zeros(len(points))
+    r = numpy.empty(len(inside), dtype=numpy.float64)
     r[inside] = z
     r[outside] = numpy.nan
 
     return r
 
 
+def uniform_spacing(x):
+    """Spacing of equidistant coordinates
+
+    Args:
+        * x: Monotonically increasing 1D array with at least two elements
+
+    Returns:
+        * Distance between consecutive elements if they are equidistant
+          up to rounding, otherwise None
+    """
+
+    dx = float(x[-1] - x[0]) / (len(x) - 1)
+    if dx > 0 and numpy.allclose(numpy.diff(x), dx, rtol=1.0e-9, atol=0):
+        return dx
+    else:
+        return None
+
+
+def find_upper_neighbours(x, xi):
+    """Find upper neighbours of coordinates in a monotonic axis
+
+    Args:
+        * x: Monotonically increasing 1D array of mesh coordinates
+        * xi: 1D array of coordinates within [x[0], x[-1]]
+
+    Returns:
+        * Array of the smallest indices i such that x[i] >= xi as
+          returned by numpy.searchsorted, but at least 1 so that
+          x[i - 1] <= xi <= x[i]. If x has only one element all
+          indices are 0.
+
+    Note:
+        For equidistant x indices are computed by division and corrected
+        for rounding rather than searched for.
+    """
+
+    if len(x) < 2:
+        return numpy.zeros(len(xi), dtype=numpy.int)
+
+    dx = uniform_spacing(x)
+    if dx is None:
+        idx = numpy.searchsorted(x, xi, side='left')
+    else:
+        idx = numpy.ceil((xi - x[0]) / dx).astype(numpy.int)
+        idx = numpy.clip(idx, 0, len(x) - 1)
+
+        # Rounding can put idx one off in either direction
+        idx[(idx > 0) & (x[idx - 1] >= xi)] -= 1
+        idx[(idx < len(x) - 1) & (x[idx] < xi)] += 1
+
+    return numpy.clip(idx, 1, len(x) - 1)
+
+
 def interpolate_raster(x, y, Z, points, mode='linear', bounds_error=False):
     """2D interpolation of raster data
 
@@ -189,37 +244,38 @@ def check_inputs(x, y, Z, points, mode, bounds_error):
     if mode not in ['linear', 'constant']:
         raise InaSAFEError(msg)
 
-    x = numpy.array(x)
+    x = numpy.asarray(x)
 
     try:
-        y = numpy.array(y)
+        y = numpy.asarray(y)
     except Exception, e:
         msg = ('Input vector y could not be converted to numpy array: '
                '%s' % str(e))
         raise Exception(msg)
 
-    msg = ('Input vector x must be monotoneously increasing. I got '
-           'min(x) == %.15f, but x[0] == %.15f' % (min(x), x[0]))
-    if not min(x) == x[0]:
+    if not x.min() == x[0]:
+        msg = ('Input vector x must be monotoneously increasing. I got '
+               'min(x) == %.15f, but x[0] == %.15f' % (x.min(), x[0]))
         raise InaSAFEError(msg)
 
-    msg = ('Input vector y must be monotoneously increasing. '
-           'I got min(y) == %.15f, but y[0] == %.15f' % (min(y), y[0]))
-    if not min(y) == y[0]:
+    if not y.min() == y[0]:
+        msg = ('Input vector y must be monotoneously increasing. '
+               'I got min(y) == %.15f, but y[0] == %.15f' % (y.min(), y[0]))
         raise InaSAFEError(msg)
 
-    msg = ('Input vector x must be monotoneously increasing. I got '
-           'max(x) == %.15f, but x[-1] == %.15f' % (max(x), x[-1]))
-    if not max(x) == x[-1]:
+    if not x.max() == x[-1]:
+        msg = ('Input vector x must be monotoneously increasing. I got '
+               'max(x) == %.15f, but x[-1] == %.15f' % (x.max(), x[-1]))
         raise InaSAFEError(msg)
 
-    msg = ('Input vector y must be monotoneously increasing. I got '
-           'max(y) == %.15f, but y[-1] == %.15f' % (max(y), y[-1]))
-    if not max(y) == y[-1]:
+    if not y.max() == y[-1]:
+        msg = ('Input vector y must be monotoneously increasing. I got '
+               'max(y) == %.15f, but y[-1] == %.15f' % (y.max(), y[-1]))
         raise InaSAFEError(msg)
 
     try:
-        Z = numpy.array(Z)
+        # Grids are used in their own type, e.g. float32, without copying
+        Z = numpy.asarray(Z)
         m, n = Z.shape
     except Exception, e:
         msg = 'Z must be a 2D numpy array: %s' % str(e)
@@ -234,15 +290,15 @@ def check_inputs(x, y, Z, points, mode, bounds_error):
         raise InaSAFEError(msg)
 
     # Get interpolation points
-    points = numpy.array(points)
+    points = numpy.asarray(points, dtype=numpy.float64)
     xi = points[:, 0]
     eta = points[:, 1]
 
     if bounds_error:
-        xi0 = min(xi)
-        xi1 = max(xi)
-        eta0 = min(eta)
-        eta1 = max(eta)
+        xi0 = xi.min()
+        xi1 = xi.max()
+        eta0 = eta.min()
+        eta1 = eta.max()
 
         msg = ('Interpolation point xi=%f was less than the smallest '
                'value in domain (x=%f) and bounds_error was requested.'
@@ -3,6 +3,9 @@
 .. tip::
    The main public functions are:
     separate_points_by_polygon: Fundamental clipper
+    classify_points_by_polygons: Assign polygon ids to points using an index
+    find_points_in_polygons: Find points in overlapping polygons the same way
+    PointGridIndex: Grid index over points reusable across polygon sets
     intersection: Determine intersections of lines
 
    Some more specific or helper functions include:
@@ -27,7 +30,7 @@ import numpy
 from random import uniform, seed as seed_function
 
 from safe.common.numerics import ensure_numeric
-from safe.common.numerics import grid2points, geotransform2axes
+from safe.common.numerics import geotransform2axes
 from safe.common.exceptions import PolygonInputError, InaSAFEError
 
 LOGGER = logging.getLogger('InaSAFE')
@@ -37,7 +40,8 @@ def separate_points_by_polygon(points, polygon,
                                polygon_bbox=None,
                                closed=True,
                                check_input=True,
-                               use_numpy=True):
+                               use_numpy=True,
+                               use_slabs=False):
     """Determine whether points are inside or outside a polygon.
 
     Args:
@@ -52,6 +56,11 @@ def separate_points_by_polygon(points, polygon,
               the code faster.
         * check_input: Allows faster execution if set to False
         * use_numpy: Use the fast numpy implementation
+        * use_slabs: Bucket polygon edges into horizontal slabs so that
+              each point is only tested against the edges near it.
+              This is much faster for polygons with many vertices,
+              see scripts/benchmark_polygon_kernels.py.
+              Only applies to the numpy implementation.
 
     Returns:
         * indices_inside_polygon: array of indices of points
@@ -161,13 +170,15 @@ def separate_points_by_polygon(points, polygon,
     candidate_points = points[inside_box]
 
     if use_numpy:
-        func = _separate_points_by_polygon
+        res = _separate_points_by_polygon(candidate_points,
+                                          polygon,
+                                          closed=closed,
+                                          use_slabs=use_slabs)
     else:
-        func = _separate_points_by_polygon_python
-
-    local_indices_inside, local_indices_outside = func(candidate_points,
-                                                       polygon,
-                                                       closed=closed)
+        res = _separate_points_by_polygon_python(candidate_points,
+                                                 polygon,
+                                                 closed=closed)
+    local_indices_inside, local_indices_outside = res
 
     # Map local indices from candidate points to global indices of all points
     indices_outside_box = numpy.where(outside_box)[0]
@@ -184,7 +195,8 @@ def separate_points_by_polygon(points, polygon,
 
 
 def _separate_points_by_polygon(points, polygon,
-                                closed, rtol=0.0, atol=0.0):
+                                closed, rtol=0.0, atol=0.0,
+                                use_slabs=False):
     """Underlying algorithm to partition point according to polygon
 
     Input:
@@ -194,7 +206,11 @@ def _separate_points_by_polygon(points, polygon,
        regarded as belonging to the polygon (closed = True)
        or not (closed = False). Close can also be None.
        rtol, atol: Tolerances for when a point is considered to coincide with
-                   a line. Default 0.0.
+                   a line. Default 0.0. Boundary points are found by
+                   _points_on_boundary.
+       use_slabs - (optional) count edge crossings using the slab
+                   decomposition in _edge_crossings_by_slabs rather than
+                   looping over all polygon edges.
 
     Output:
        indices: array of same length as points with indices of points falling
@@ -207,10 +223,6 @@ def _separate_points_by_polygon(points, polygon,
        The indices of points outside are obtained as indices[count:]
      """
 
-    # Suppress numpy warnings (as we'll be dividing by zero)
-    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
-
-    N = polygon.shape[0]
     M = points.shape[0]
 
     if M == 0:
@@ -221,7 +233,55 @@ def _separate_points_by_polygon(points, polygon,
     indices = numpy.zeros(M, numpy.int)
 
     # Vector keeping track of which points are inside
-    inside = numpy.zeros(M, dtype=numpy.int)  # All assumed outside initially
+    if use_slabs:
+        inside = _edge_crossings_by_slabs(points, polygon) % 2
+    else:
+        inside = _edge_crossings(points, polygon) % 2
+
+    if closed is not None:
+        # Find points on polygon boundary
+        boundary_points = _points_on_boundary(points, polygon, rtol, atol)
+
+        if closed:
+            inside[boundary_points] = 1
+        else:
+            inside[boundary_points] = 0
+
+    # Record point as either inside or outside
+    inside_index = numpy.sum(inside)  # How many points are inside
+
+    # Indices of inside points
+    indices[:inside_index] = numpy.where(inside)[0]
+
+    # Indices of outside points
+    indices[inside_index:] = numpy.where(1 - inside)[0]
+
+    return indices[:inside_index], indices[inside_index:]
+
+
+def _edge_crossings(points, polygon):
+    """Count polygon edges crossed by a ray going west from each point
+
+    Input:
+       points - Mx2 array of point coordinates
+       polygon - Nx2 array of polygon vertices
+
+    Output:
+       crossings: integer array of length M. Points with an odd number of
+       crossings are inside the polygon.
+
+    Note:
+       This loops over all polygon edges with each pass covering all points.
+    """
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    N = polygon.shape[0]
+    M = points.shape[0]
+
+    # Vector keeping track of crossings (all assumed outside initially)
+    crossings = numpy.zeros(M, dtype=numpy.int)
 
     x = points[:, 0]
     y = points[:, 1]
@@ -239,36 +299,288 @@ def _separate_points_by_polygon(points, polygon,
         seg_j = (py_j < y) * (py_i >= y)
         mask = (px_i + sigma < x) * (seg_i + seg_j)
 
-        inside[mask] = 1 - inside[mask]
+        crossings[mask] += 1
 
     # Restore numpy warnings
     numpy.seterr(**original_numpy_settings)
 
-    if closed is not None:
-        # Find points on polygon boundary
+    return crossings
+
+
+def _edge_crossings_by_slabs(points, polygon,
+                             edges_per_slab=8, max_pairs=2 ** 22):
+    """Count polygon edges crossed by a ray going west from each point
+
+    This computes the same as _edge_crossings, but is much faster for
+    polygons with many vertices.
+
+    Input:
+       points - Mx2 array of point coordinates
+       polygon - Nx2 array of polygon vertices
+       edges_per_slab - (optional) Approximate number of edges per slab
+       max_pairs - (optional) Maximal number of point-edge pairs to
+                   evaluate at a time. This bounds the memory used.
+
+    Output:
+       crossings: integer array of length M. Points with an odd number of
+       crossings are inside the polygon.
+
+    Note:
+       The polygon is decomposed into horizontal slabs (see _slab_index)
+       and each point is only tested against the edges listed for its slab.
+       This reduces the work from N passes over all points to about
+       edges_per_slab tests per point.
+    """
+
+    M = points.shape[0]
+    crossings = numpy.zeros(M, dtype=numpy.int)
+
+    # Edges (i, j) with ordered latitudes
+    px_i = polygon[:, 0]
+    py_i = polygon[:, 1]
+    px_j = numpy.concatenate((px_i[1:], px_i[:1]))
+    py_j = numpy.concatenate((py_i[1:], py_i[:1]))
+    ymin = numpy.minimum(py_i, py_j)
+    ymax = numpy.maximum(py_i, py_j)
+
+    # Horizontal edges are never crossed
+    edges = numpy.where(ymin < ymax)[0]
+    if len(edges) == 0:
+        return crossings
+
+    # Edges cross latitudes in (ymin, ymax]
+    bounds, slab_edges, slab_start = _slab_index(ymin[edges], ymax[edges],
+                                                 edges_per_slab=edges_per_slab,
+                                                 half_open=True)
+    slab_edges = edges[slab_edges]
+    number_of_slabs = len(bounds) - 1
+
+    # Slab for each point. Points outside all slabs can not cross any edge.
+    slabs = numpy.searchsorted(bounds, points[:, 1], side='left') - 1
+    candidates = numpy.where((slabs >= 0) * (slabs < number_of_slabs))[0]
+    slabs = slabs[candidates]
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    for start, end, p, e in _slab_pairs(slabs, slab_edges, slab_start,
+                                        max_pairs=max_pairs):
+        x = points[candidates[start:end], 0][p]
+        y = points[candidates[start:end], 1][p]
+
+        # Edge crossing formula (as in _edge_crossings)
+        sigma = (y - py_i[e]) / (py_j[e] - py_i[e]) * (px_j[e] - px_i[e])
+        seg_i = (py_i[e] < y) * (py_j[e] >= y)
+        seg_j = (py_j[e] < y) * (py_i[e] >= y)
+        mask = (px_i[e] + sigma < x) * (seg_i + seg_j)
+
+        crossings[candidates[start:end]] = numpy.bincount(
+            p[mask], minlength=end - start)
+
+    # Restore numpy warnings
+    numpy.seterr(**original_numpy_settings)
+
+    return crossings
+
+
+def _points_on_boundary(points, polygon, rtol=0.0, atol=0.0,
+                        edges_per_slab=8, max_pairs=2 ** 22):
+    """Determine which points are on the boundary of a polygon
+
+    Input:
+       points - Mx2 array of point coordinates
+       polygon - Nx2 array of polygon vertices
+       rtol, atol: Tolerances for when a point is considered to coincide with
+                   a line. See point_on_line.
+       edges_per_slab, max_pairs - (optional) see _edge_crossings_by_slabs
+
+    Output:
+       on_boundary: boolean array of length M which is True for points
+       that are on an edge of the polygon according to point_on_line.
+
+    Note:
+       Rather than testing all points against each edge, the edges are
+       bucketed into horizontal slabs and only points lying within the
+       bounding box of an edge (expanded by the tolerances) are tested
+       against it. All tests are done in one vectorised pass.
+    """
+
+    M = points.shape[0]
+    on_boundary = numpy.zeros(M, dtype=numpy.bool)
+
+    px_i = polygon[:, 0]
+    py_i = polygon[:, 1]
+    b0 = numpy.concatenate((px_i[1:], px_i[:1])) - px_i
+    b1 = numpy.concatenate((py_i[1:], py_i[:1])) - py_i
+    denominator = b0 * b0 + b1 * b1
+    len_b = numpy.sqrt(denominator)
+
+    # Distance from edge within which point_on_line may accept a point
+    # plus some slack to cover rounding
+    margin = numpy.zeros(len(len_b))
+    nondegenerate = len_b > 0
+    margin[nondegenerate] = ((atol + rtol * denominator[nondegenerate]) /
+                             len_b[nondegenerate])
+    margin += 4 * numpy.finfo(numpy.float).eps * numpy.max(numpy.abs(polygon))
+
+    xlo = numpy.minimum(px_i, px_i + b0) - margin
+    xhi = numpy.maximum(px_i, px_i + b0) + margin
+    ylo = numpy.minimum(py_i, py_i + b1) - margin
+    yhi = numpy.maximum(py_i, py_i + b1) + margin
+
+    def on_edges(idx, e):
+        """Point on line formula (as in point_on_line) for pairs
+        of points idx and edges e
+        """
+
+        a0 = points[idx, 0] - px_i[e]
+        a1 = points[idx, 1] - py_i[e]
+        nominator = abs(a1 * b0[e] - a0 * b1[e])
+        is_parallel = nominator <= atol + rtol * denominator[e]
+        len_a = numpy.sqrt(a0 * a0 + a1 * a1)
+        cross = a0 * b0[e] + a1 * b1[e]
+        on_line = is_parallel * (cross >= 0) * (len_a <= len_b[e])
+
+        on_boundary[idx[on_line]] = True
+
+    x = points[:, 0]
+    y = points[:, 1]
+
+    N = polygon.shape[0]
+    if M * N <= 4096:
+        # Few pairs - test all points against all edges at once
+        idx = numpy.repeat(numpy.arange(M), N)
+        e = numpy.tile(numpy.arange(N), M)
+        near = ((x[idx] >= xlo[e]) * (x[idx] <= xhi[e]) *
+                (y[idx] >= ylo[e]) * (y[idx] <= yhi[e]))
+        on_edges(idx[near], e[near])
+        return on_boundary
+
+    if N < 4 * edges_per_slab:
+        # Few edges - pairing points with all edges costs more than a loop
         for i in range(N):
-            # Loop through polygon edges
-            j = (i + 1) % N
-            edge = [polygon[i, :], polygon[j, :]]
+            near = ((x >= xlo[i]) * (x <= xhi[i]) *
+                    (y >= ylo[i]) * (y <= yhi[i]))
+            on_edges(numpy.where(near)[0], i)
+        return on_boundary
 
-            # Select those that are on the boundary
-            boundary_points = point_on_line(points, edge, rtol, atol)
+    bounds, slab_edges, slab_start = _slab_index(ylo, yhi,
+                                                 edges_per_slab=edges_per_slab)
+    number_of_slabs = len(bounds) - 1
 
-            if closed:
-                inside[boundary_points] = 1
-            else:
-                inside[boundary_points] = 0
+    # Slab for each point within the latitudes covered by slabs
+    candidates = numpy.where((y >= bounds[0]) * (y <= bounds[-1]))[0]
+    slabs = numpy.searchsorted(bounds, y[candidates], side='left') - 1
+    slabs = numpy.clip(slabs, 0, number_of_slabs - 1)
 
-    # Record point as either inside or outside
-    inside_index = numpy.sum(inside)  # How many points are inside
+    for start, end, p, e in _slab_pairs(slabs, slab_edges, slab_start,
+                                        max_pairs=max_pairs):
+        # Only consider points within bounding box of edge
+        idx = candidates[start:end][p]
+        near = ((x[idx] >= xlo[e]) * (x[idx] <= xhi[e]) *
+                (y[idx] >= ylo[e]) * (y[idx] <= yhi[e]))
+        on_edges(idx[near], e[near])
 
-    # Indices of inside points
-    indices[:inside_index] = numpy.where(inside)[0]
+    return on_boundary
 
-    # Indices of outside points
-    indices[inside_index:] = numpy.where(1 - inside)[0]
 
-    return indices[:inside_index], indices[inside_index:]
+def _slab_index(ylo, yhi, edges_per_slab=8, half_open=False):
+    """Bucket edges into horizontal slabs
+
+    Input:
+       ylo, yhi - arrays with the latitude range of each edge
+       edges_per_slab - (optional) Approximate number of edges per slab
+       half_open - (optional) If True, edges cover latitudes (ylo, yhi]
+                   rather than [ylo, yhi] and slab i covers
+                   (bounds[i], bounds[i + 1]] rather than
+                   [bounds[i], bounds[i + 1]].
+
+    Output:
+       bounds - array with latitudes of slab boundaries
+       slab_edges - array of edge indices ordered by slab
+       slab_start - array such that the edges overlapping slab i are
+                    slab_edges[slab_start[i]:slab_start[i + 1]]
+
+    Note:
+       Slab boundaries are taken from quantiles of the unique edge
+       latitudes so that each slab holds about the same number of edges.
+       Long edges spanning many slabs are listed in each of them. If that
+       makes the index larger than 8 entries per edge fewer slabs are used.
+    """
+
+    E = len(ylo)
+    ys = numpy.unique(numpy.concatenate((ylo, yhi)))
+
+    number_of_slabs = max(1, min(len(ys) - 1, E // edges_per_slab))
+    while True:
+        idx = numpy.linspace(0, len(ys) - 1, number_of_slabs + 1)
+        bounds = numpy.unique(ys[numpy.round(idx).astype(numpy.int)])
+        if len(bounds) == 1:
+            # All edges are at the same latitude
+            bounds = numpy.array([bounds[0], bounds[0]])
+        number_of_slabs = len(bounds) - 1
+
+        # Slabs overlapping each edge
+        if half_open:
+            first = numpy.searchsorted(bounds, ylo, side='right') - 1
+            last = numpy.searchsorted(bounds, yhi, side='left') - 1
+        else:
+            first = numpy.searchsorted(bounds, ylo, side='left') - 1
+            last = numpy.searchsorted(bounds, yhi, side='right') - 1
+        first = numpy.maximum(first, 0)
+        last = numpy.minimum(last, number_of_slabs - 1)
+        counts = last - first + 1
+
+        if counts.sum() <= 8 * E or number_of_slabs == 1:
+            break
+        number_of_slabs = max(1, number_of_slabs // 4)
+
+    # Compressed lists of edges for each slab
+    slab_of_pair = (numpy.repeat(first - numpy.cumsum(counts) + counts,
+                                 counts) +
+                    numpy.arange(counts.sum()))
+    order = numpy.argsort(slab_of_pair, kind='mergesort')
+    slab_edges = numpy.repeat(numpy.arange(E), counts)[order]
+    slab_start = numpy.zeros(number_of_slabs + 1, dtype=numpy.int)
+    slab_start[1:] = numpy.cumsum(numpy.bincount(slab_of_pair,
+                                                 minlength=number_of_slabs))
+
+    return bounds, slab_edges, slab_start
+
+
+def _slab_pairs(slabs, slab_edges, slab_start, max_pairs=2 ** 22):
+    """Generate point-edge pairs from slab index in chunks of points
+
+    Input:
+       slabs - array with the slab of each point
+       slab_edges, slab_start - slab index as returned by _slab_index
+       max_pairs - (optional) Maximal number of pairs in each chunk
+                   unless a single point has more edges than that.
+
+    Output:
+       Generator of tuples (start, end, point_of_pair, edge_of_pair) where
+       start:end is the chunk of points and point_of_pair is relative
+       to start. Each point is paired with each edge listed for its slab.
+    """
+
+    number_of_edges = slab_start[slabs + 1] - slab_start[slabs]
+    cumulative = numpy.cumsum(number_of_edges)
+
+    start = 0
+    while start < len(slabs):
+        offset = cumulative[start] - number_of_edges[start]
+        end = numpy.searchsorted(cumulative, offset + max_pairs,
+                                 side='right')
+        end = max(end, start + 1)
+
+        n = number_of_edges[start:end]
+        point_of_pair = numpy.repeat(numpy.arange(end - start), n)
+        pair_index = (numpy.repeat(slab_start[slabs[start:end]] -
+                                   numpy.cumsum(n) + n, n) +
+                      numpy.arange(n.sum()))
+
+        yield start, end, point_of_pair, slab_edges[pair_index]
+        start = end
 
 
 def _separate_points_by_polygon_python(points, polygon,
@@ -599,6 +911,8 @@ def clip_lines_by_polygon(lines, polygon,
     Input
        lines: Sequence of polylines: [[p0, p1, ...], [q0, q1, ...], ...]
               where pi and qi are point coordinates (x, y).
+              Lines packed into flat arrays (see PackedGeometry in
+              safe.storage.geometry) are used without conversion.
        polygon: list or Nx2 array of polygon vertices
        closed: (optional) determine whether points on boundary should be
                regarded as belonging to the polygon (closed = True)
@@ -620,7 +934,8 @@ def clip_lines_by_polygon(lines, polygon,
        come from, if one e.g. wants to assign the original attribute values
        to clipped lines.
 
-    This is a wrapper around clip_line_by_polygon
+    All segments of all lines are clipped in one vectorised pass.
+    clip_line_by_polygon is a wrapper around this for a single line.
     """
 
     if check_input:
@@ -629,7 +944,13 @@ def clip_lines_by_polygon(lines, polygon,
         if not isinstance(closed, bool):
             raise RuntimeError(msg)
 
-        for i in range(len(lines)):
+        # Packed lines are numeric already
+        if is_packed(lines):
+            lines_to_check = []
+        else:
+            lines_to_check = range(len(lines))
+
+        for i in lines_to_check:
             try:
                 lines[i] = ensure_numeric(lines[i], numpy.float)
             except Exception, e:
@@ -680,13 +1001,33 @@ def _clip_lines_by_polygon(lines,
                            polygon,
                            polygon_segments,
                            polygon_bbox,
-                           closed=True):
+                           closed=True,
+                           max_pairs=2 ** 20):
     """Clip multiple lines by polygon
 
     Underlying function.
     - see clip_lines_by_polygon for details
+
+    All segments of all lines are clipped together as one array rather
+    than one line segment at a time.
+    max_pairs limits the number of segment-edge pairs intersected
+    at once and thereby the memory used.
     """
 
+    # Algorithm
+    #
+    # 1: Collect all segments of lines touching the polygon bounding box
+    # 2: Find all intersection points between these segments and polygon
+    #    edges, working through chunks of segments
+    # 3: For all line segments
+    #    * Calculate distance from first end point to each intersection point
+    #    * Sort intersection points by segment and distance
+    #    * Cut segments into multiple sub-segments
+    # 4: Determine whether midpoints of all sub-segments are inside or
+    #    outside clipping polygon in one call
+    # 5: Join adjacent sub-segments into polylines that are either
+    #    fully inside or outside polygon
+
     # Get bounding box
     minpx = polygon_bbox[0]
     maxpx = polygon_bbox[1]
@@ -696,31 +1037,184 @@ def _clip_lines_by_polygon(lines,
     inside_line_segments = {}
     outside_line_segments = {}
 
-    # Loop through lines
-    M = len(lines)
-    for k in range(M):
-        line = lines[k]
+    # Exclude lines that are fully outside polygon bounding box
+    if is_packed(lines):
+        # Use precomputed bounding boxes of packed lines
+        bboxes = lines.bboxes
+        outside = ((bboxes[:, 1] < minpx) +  # Everything is to the west
+                   (bboxes[:, 0] > maxpx) +  # Everything is to the east
+                   (bboxes[:, 3] < minpy) +  # Everything is to the south
+                   (bboxes[:, 2] > maxpy))   # Everything is to the north
+        for k in range(len(lines)):
+            inside_line_segments[k] = []
+            outside_line_segments[k] = []
+        for k in numpy.where(outside)[0]:
+            outside_line_segments[k].append(lines[k])
+        candidates = numpy.where(-outside)[0]
+    else:
+        candidates = []
+        for k in range(len(lines)):
+            line = lines[k]
+            if (max(line[:, 0]) < minpx or  # Everything is to the west
+                min(line[:, 0]) > maxpx or  # Everything is to the east
+                max(line[:, 1]) < minpy or  # Everything is to the south
+                min(line[:, 1]) > maxpy):   # Everything is to the north
+
+                inside_line_segments[k] = []
+                outside_line_segments[k] = [line]
+            else:
+                inside_line_segments[k] = []
+                outside_line_segments[k] = []
+                candidates.append(k)
+
+    if len(candidates) == 0:
+        return inside_line_segments, outside_line_segments
+
+    # Step 1: Segments of all candidate lines. Segment i goes from
+    # vertex i to vertex i + 1 except across the last vertex of each line.
+    if is_packed(lines):
+        # Gather vertices straight from the packed coordinates
+        starts = lines.ring_offsets[lines.part_offsets[candidates]]
+        lengths = lines.ring_offsets[lines.part_offsets[candidates] + 1]
+        lengths -= starts
+        offsets = numpy.cumsum(lengths) - lengths
+        vertex_ids = (numpy.arange(numpy.sum(lengths)) +
+                      numpy.repeat(starts - offsets, lengths))
+        vertices = lines.coordinates[vertex_ids]
+    else:
+        lengths = numpy.array([len(lines[k]) for k in candidates])
+        vertices = numpy.concatenate([lines[k] for k in candidates])
+    first_vertex = numpy.ones(len(vertices), dtype=bool)
+    first_vertex[numpy.cumsum(lengths) - 1] = False
+    first_vertex = numpy.where(first_vertex)[0]
+    p0 = vertices[first_vertex]
+    p1 = vertices[first_vertex + 1]
+    segment_lines = numpy.repeat(numpy.arange(len(candidates)),
+                                 lengths - 1)
+    S = len(p0)
+
+    # Only segments intersecting the bounding box can intersect the polygon.
+    # The rest are cut at their end points only and therefore kept whole.
+    overlap = -(((p0[:, 0] < minpx) * (p1[:, 0] < minpx)) +  # West
+                ((p0[:, 0] > maxpx) * (p1[:, 0] > maxpx)) +  # East
+                ((p0[:, 1] < minpy) * (p1[:, 1] < minpy)) +  # South
+                ((p0[:, 1] > maxpy) * (p1[:, 1] > maxpy)))   # North
+
+    # Segments where both end points are outside the bounding box could
+    # still cross it so check those against its edges
+    corners = numpy.array([[minpx, minpy], [maxpx, minpy],
+                           [maxpx, maxpy], [minpx, maxpy]])
+    bbox_segments = polygon2segments(corners)
+    endpoints_outside = overlap.copy()
+    for p in [p0, p1]:
+        endpoints_outside *= -((minpx < p[:, 0]) * (p[:, 0] < maxpx) +
+                               (minpy < p[:, 1]) * (p[:, 1] < maxpy))
+    for i in numpy.where(endpoints_outside)[0]:
+        values = intersection([p0[i], p1[i]], bbox_segments)
+        overlap[i] = numpy.any(-numpy.isnan(values[:, 0]))
+
+    # Step 2: Intersect segments with polygon edges in chunks
+    # using the same formula as in function intersection()
+    x2 = polygon_segments[0, 0, :]
+    y2 = polygon_segments[0, 1, :]
+    x3 = polygon_segments[1, 0, :]
+    y3 = polygon_segments[1, 1, :]
+    x3x2 = x3 - x2
+    y3y2 = y3 - y2
 
-        # Exclude lines that are fully outside polygon bounding box
-        if (max(line[:, 0]) < minpx or  # Everything is to the west
-            min(line[:, 0]) > maxpx or  # Everything is to the east
-            max(line[:, 1]) < minpy or  # Everything is to the south
-            min(line[:, 1]) > maxpy):   # Everything is to the north
+    cut_segments = [numpy.arange(S), numpy.arange(S)]
+    cut_points = [p0, p1]
 
-            inside_line_segments[k] = []
-            outside_line_segments[k] = [line]
-            continue
+    overlapping = numpy.where(overlap)[0]
+    chunk_size = max(1, max_pairs // max(1, len(x2)))
 
-        # Call underlying function for one line and one polygon
-        inside, outside = _clip_line_by_polygon(line,
-                                                polygon,
-                                                polygon_segments,
-                                                polygon_bbox,
-                                                closed=closed)
+    original_settings = numpy.seterr(divide='ignore', invalid='ignore')
+    try:
+        for start in range(0, len(overlapping), chunk_size):
+            s = overlapping[start:start + chunk_size]
+
+            x0 = p0[s, 0][:, numpy.newaxis]
+            y0 = p0[s, 1][:, numpy.newaxis]
+            x1x0 = p1[s, 0][:, numpy.newaxis] - x0
+            y1y0 = p1[s, 1][:, numpy.newaxis] - y0
+            x2x0 = x2 - x0
+            y2y0 = y2 - y0
+
+            denominator = y3y2 * x1x0 - x3x2 * y1y0
+            u0 = (y3y2 * x2x0 - x3x2 * y2y0) / denominator
+            u1 = (x2x0 * y1y0 - y2y0 * x1x0) / denominator
+
+            mask = (u0 >= 0.0) * (u0 <= 1.0) * (u1 >= 0.0) * (u1 <= 1.0)
+            i, _ = numpy.where(mask)
+            u0 = u0[mask]
+
+            x = x0[i, 0] + u0 * x1x0[i, 0]
+            y = y0[i, 0] + u0 * y1y0[i, 0]
+
+            cut_segments.append(s[i])
+            cut_points.append(numpy.array([x, y]).T)
+    finally:
+        numpy.seterr(**original_settings)
+
+    cut_segments = numpy.concatenate(cut_segments)
+    cut_points = numpy.concatenate(cut_points)
+
+    # Step 3: Sort cut points by segment and by distance from first end point
+    V = cut_points - p0[cut_segments]
+    distances = (V * V).sum(axis=1)
+    idx = numpy.lexsort((distances, cut_segments))
+    cut_segments = cut_segments[idx]
+    distances = distances[idx]
+    cut_points = cut_points[idx]
+
+    # Remove duplicate points within segments that were intersected
+    duplicates = numpy.zeros(len(distances), dtype=bool)
+    duplicates[1:] = ((cut_segments[1:] == cut_segments[:-1]) *
+                      (distances[1:] == distances[:-1]))
+    duplicates *= overlap[cut_segments]
+    cut_segments = cut_segments[-duplicates]
+    cut_points = cut_points[-duplicates]
+
+    # Consecutive cut points within the same segment form sub-segments
+    # ordered by line, segment and position along segment
+    same = cut_segments[1:] == cut_segments[:-1]
+    start_points = cut_points[:-1][same]
+    end_points = cut_points[1:][same]
+    sub_segment_lines = segment_lines[cut_segments[:-1][same]]
+
+    # Step 4: Separate sub-segment midpoints according to polygon
+    # Deliberately ignore boundary as midpoints by definition
+    # are fully inside or fully outside.
+    midpoints = (start_points + end_points) / 2
+    inside, outside = separate_points_by_polygon(midpoints,
+                                                 polygon,
+                                                 polygon_bbox,
+                                                 check_input=False,
+                                                 closed=closed)
+
+    # Step 5: Rejoin adjacent sub-segments and add to result lines
+    for idx, result in [(inside, inside_line_segments),
+                        (outside, outside_line_segments)]:
+        if len(idx) == 0:
+            continue
 
-        # Record clipped line segments from line k
-        inside_line_segments[k] = inside
-        outside_line_segments[k] = outside
+        idx = numpy.sort(idx)
+        starts = start_points[idx]
+        ends = end_points[idx]
+        ids = sub_segment_lines[idx]
+
+        # Sub-segments are adjacent if they belong to the same line and
+        # one ends where the next starts (same test as join_line_segments)
+        adjacent = ((ids[1:] == ids[:-1]) *
+                    numpy.all(numpy.abs(ends[:-1] - starts[1:]) <=
+                              1.0e-12 + 1.0e-12 * numpy.abs(starts[1:]),
+                              axis=1))
+        breaks = numpy.where(-adjacent)[0] + 1
+        first = numpy.concatenate(([0], breaks))
+        last = numpy.concatenate((breaks, [len(idx)]))
+        for i, j in zip(first, last):
+            line = numpy.concatenate((starts[i:i + 1], ends[i:j]))
+            result[candidates[ids[i]]].append(line)
 
     return inside_line_segments, outside_line_segments
 
@@ -832,8 +1326,6 @@ def clip_line_by_polygon(line, polygon,
                                  closed=closed)
 
 
-# FIXME (Ole, 14 sep 2012): Will clean this up soon, promise
-# pylint: disable=W0613
 def _clip_line_by_polygon(line,
                           polygon,
                           polygon_segments,
@@ -845,163 +1337,12 @@ def _clip_line_by_polygon(line,
     - see public clip_line_by_polygon() for details
     """
 
-    # Algorithm
-    #
-    # 1: Find all intersection points between line segments and polygon edges
-    # 2: For each line segment
-    #    * Calculate distance from first end point to each intersection point
-    #    * Sort intersection points by distance
-    #    * Cut segment into multiple segments
-    # 3: For each new line segment
-    #    * Calculate its midpoint
-    #    * Determine if it is inside or outside clipping polygon
-    # 4: Join adjacent segments into polylines that are either
-    #     fully inside or outside polygon
-    # 5
-
-    # Get bounding box
-    minpx = polygon_bbox[0]
-    maxpx = polygon_bbox[1]
-    minpy = polygon_bbox[2]
-    maxpy = polygon_bbox[3]
-
-    # Lists collecting clipped line segments
-    inside_line_segments = []
-    outside_line_segments = []
-
-    # Loop through line segments
-    M = line.shape[0]
-    for k in range(M - 1):
-        p0 = line[k, :]
-        p1 = line[k + 1, :]
-        segment = [p0, p1]
-
-        #-------------
-        # Optimisation
-        #-------------
-        # Skip segments that are outside polygon bounding box
-
-        # In test_engine.py
-        # test_polygon_to_roads_interpolation_flood_example with
-        # (E_attributes[:-1:100]) took
-        # * Without this: 92s
-        # * With original optimisation: 61s
-        # * With new version: 54s
-        if p0[0] < minpx and p1[0] < minpx:  # Entire segment to the west
-            segment_is_outside_bbox = True
-        elif p0[0] > maxpx and p1[0] > maxpx:  # Entire segment to the east
-            segment_is_outside_bbox = True
-        elif p0[1] < minpy and p1[1] < minpy:  # Entire segment to the south
-            segment_is_outside_bbox = True
-        elif p0[1] > maxpy and p1[1] > maxpy:  # Entire segment to the north
-            segment_is_outside_bbox = True
-        else:
-            # Skip segments where both end points are outside polygon
-            # bounding box and which don't intersect the bounding box
-            segment_is_outside_bbox = True
-            if minpx < p0[0] < maxpx or minpy < p0[1] < maxpy:
-                # First endpoint is inside bounding box
-                segment_is_outside_bbox = False
-            elif minpx < p1[0] < maxpx or minpy < p1[1] < maxpy:
-                # Second endpoint is inside bounding box
-                segment_is_outside_bbox = False
-            else:
-                # Both end points are outside bounding box, but could be on
-                # either side so need to check if segment intersects polygon
-                # bounding box.
-                corners = numpy.array([[minpx, minpy], [maxpx, minpy],
-                                       [maxpx, maxpy], [minpx, maxpy],
-                                       [minpx, minpy]])
-                for i in range(4):
-                    edge = [corners[i, :], corners[i + 1, :]]
-                    value = intersection(segment, edge)
-                    if value is not None:
-                        # Segment intersects polygon bounding box
-                        segment_is_outside_bbox = False
-                        break
-        #-----------------
-        # End optimisation
-        #-----------------
-
-        # Separate segments that are inside from those outside
-        if segment_is_outside_bbox:
-            outside_line_segments.append(segment)
-        else:
-            # Intersect segment with all polygon edges
-            # and decide for each sub-segment whether in or out
-            values = intersection(segment, polygon_segments)
-            mask = -numpy.isnan(values[:, 0])
-            V = values[mask]
-
-            # Array for intersections
-            intersections = numpy.zeros((len(V) + 2, 2))
-
-            # Include end points
-            intersections[0, :] = p0
-            intersections[1, :] = p1
-
-            # Add internal intersections
-            intersections[2:, :] = V
-
-            # For each intersection, computer distance from first end point
-            V = intersections - p0
-            distances = (V * V).sum(axis=1)
-
-            # Sort intersections by distance
-            idx = numpy.argsort(distances)
-            distances = distances[idx]
-            intersections = intersections[idx]
-
-            # Remove duplicate points
-            duplicates = numpy.zeros(len(distances), dtype=bool)
-            duplicates[1:] = distances[1:] - distances[:-1] == 0
-            intersections = intersections[-duplicates, :]
-
-            # FIXME (Ole): Next candidate for vectorisation (11/9/2012) below
-            # Loop through intersections for this line segment
-            #distances = {}
-            #for i in range(len(intersections)):
-            #    v = p0 - intersections[i]
-            #    d = numpy.dot(v, v)
-            #    if d in distances:
-            #        print i, d, distances[d], intersections[i]
-            #        import sys; sys.exit()
-            #    distances[d] = intersections[i]  # Don't record duplicates
-
-            # Sort intersections by distance using Schwarzian transform
-            #A = zip(distances.keys(), distances.values())
-            #A.sort()
-            #_, intersections = zip(*A)
-
-            # Separate segment midpoints according to polygon
-            # Deliberately ignore boundary as midpoints by definition
-            # are fully inside or fully outside.
-            intersections = numpy.array(intersections)
-            midpoints = (intersections[:-1] + intersections[1:]) / 2
-            inside, outside = separate_points_by_polygon(midpoints,
-                                                         polygon,
-                                                         polygon_bbox,
-                                                         check_input=False,
-                                                         closed=closed)
-
-            # Form segments and add to the right lists
-            for i, idx in enumerate([inside, outside]):
-                if len(idx) > 0:
-                    segments = numpy.concatenate((intersections[idx, :],
-                                                  intersections[idx + 1, :]),
-                                                 axis=1)
-                    m, n = segments.shape
-                    segments = numpy.reshape(segments, (m, n / 2, 2))
-                    if i == 0:
-                        inside_line_segments.extend(segments.tolist())
-                    else:
-                        outside_line_segments.extend(segments.tolist())
-
-    # Rejoin adjacent segments and add to result lines
-    inside_lines = join_line_segments(inside_line_segments)
-    outside_lines = join_line_segments(outside_line_segments)
-
-    return inside_lines, outside_lines
+    inside, outside = _clip_lines_by_polygon([line],
+                                             polygon,
+                                             polygon_segments,
+                                             polygon_bbox,
+                                             closed=closed)
+    return inside[0], outside[0]
 
 
 def join_line_segments(segments, rtol=1.0e-12, atol=1.0e-12):
@@ -1249,6 +1590,578 @@ def intersection(line0, line1):
     return result
 
 
+#-------------------------------------------------
+# Spatial index for classifying points by polygons
+#-------------------------------------------------
+def _get_polygon_rings(polygon):
+    """Get outer and inner rings from polygon object or array
+
+    Args:
+        * polygon: Polygon geometry object or array of vertices
+
+    Returns:
+        * outer_ring: Nx2 array of vertices
+        * inner_rings: List of Nx2 arrays or None
+    """
+
+    if hasattr(polygon, 'outer_ring'):
+        outer_ring = polygon.outer_ring
+        inner_rings = polygon.inner_rings
+    else:
+        # Assume it is an array
+        outer_ring = polygon
+        inner_rings = None
+
+    return outer_ring, inner_rings
+
+
+def polygon_bounding_boxes(polygons):
+    """Compute bounding boxes of polygons
+
+    Args:
+        * polygons: list of polygon geometry objects or list of polygon arrays
+              or polygons packed into flat arrays
+
+    Returns:
+        * Px4 array of bounding boxes [minx, maxx, miny, maxy] - one per
+          input polygon. Only outer rings are considered.
+    """
+
+    if is_packed(polygons):
+        # Bounding boxes are precomputed
+        return polygons.bboxes
+
+    bboxes = numpy.zeros((len(polygons), 4))
+    for i, polygon in enumerate(polygons):
+        outer_ring, _ = _get_polygon_rings(polygon)
+        outer_ring = ensure_numeric(outer_ring, numpy.float)
+
+        bboxes[i, 0] = numpy.min(outer_ring[:, 0])
+        bboxes[i, 1] = numpy.max(outer_ring[:, 0])
+        bboxes[i, 2] = numpy.min(outer_ring[:, 1])
+        bboxes[i, 3] = numpy.max(outer_ring[:, 1])
+
+    return bboxes
+
+
+class PointGridIndex:
+    """Regular grid of cells over a set of points
+
+    The points are sorted by the cell they fall in so the points in the
+    cells overlapping a bounding box can be found with a few slices.
+    The index only depends on the points, so it can be built once and
+    used with any number of polygons (see classify_points_by_polygons).
+    """
+
+    def __init__(self, points, points_per_cell=16):
+        """Build index
+
+        Args:
+            * points: Nx2 array of point coordinates (x, y)
+            * points_per_cell: Average number of points per cell.
+                  Default 16.
+        """
+
+        points = ensure_numeric(points, numpy.float)
+        M = points.shape[0]
+        self.number_of_points = M
+        if M == 0:
+            self.minx = self.maxx = self.miny = self.maxy = 0.0
+        else:
+            x = points[:, 0]
+            y = points[:, 1]
+            self.minx = numpy.min(x)
+            self.maxx = numpy.max(x)
+            self.miny = numpy.min(y)
+            self.maxy = numpy.max(y)
+
+        n = max(1, int(numpy.sqrt(float(M) / points_per_cell)))
+        dx = (self.maxx - self.minx) / n
+        dy = (self.maxy - self.miny) / n
+        if dx == 0:
+            dx = 1.0
+        if dy == 0:
+            dy = 1.0
+        self.n = n
+        self.dx = dx
+        self.dy = dy
+
+        if M == 0:
+            cells = numpy.zeros(0, dtype=numpy.int)
+        else:
+            columns = numpy.minimum(
+                numpy.floor((x - self.minx) / dx).astype(numpy.int), n - 1)
+            rows = numpy.minimum(
+                numpy.floor((y - self.miny) / dy).astype(numpy.int), n - 1)
+            cells = rows * n + columns
+
+        # Point indices sorted by cell and start of each cell within them
+        self.order = numpy.argsort(cells, kind='mergesort')
+        self.starts = numpy.zeros(n * n + 1, dtype=numpy.int)
+        self.starts[1:] = numpy.cumsum(numpy.bincount(cells,
+                                                      minlength=n * n))
+
+    def __len__(self):
+        """Number of points in index
+        """
+        return self.number_of_points
+
+    def candidates(self, bbox):
+        """Get points in the cells overlapping a bounding box
+
+        Args:
+            * bbox: Bounding box [minx, maxx, miny, maxy]
+
+        Returns:
+            * Array of indices of the points in the cells overlapping bbox.
+              This is a superset of the points inside bbox.
+        """
+
+        pminx, pmaxx, pminy, pmaxy = bbox
+        if (self.number_of_points == 0 or
+                pmaxx < self.minx or pminx > self.maxx or
+                pmaxy < self.miny or pminy > self.maxy):
+            return numpy.zeros(0, dtype=numpy.int)
+
+        # Find grid cells overlapping bounding box
+        n = self.n
+        c0 = max(int(numpy.floor((pminx - self.minx) / self.dx)), 0)
+        c1 = min(int(numpy.floor((pmaxx - self.minx) / self.dx)), n - 1)
+        r0 = max(int(numpy.floor((pminy - self.miny) / self.dy)), 0)
+        r1 = min(int(numpy.floor((pmaxy - self.miny) / self.dy)), n - 1)
+
+        # Cells in each row are contiguous in the sorted point order
+        starts = self.starts
+        return numpy.concatenate([self.order[starts[r * n + c0]:
+                                             starts[r * n + c1 + 1]]
+                                  for r in range(r0, r1 + 1)])
+
+
+def classify_points_by_polygons(points, polygons,
+                                closed=True,
+                                check_input=True,
+                                points_per_cell=16,
+                                index=None):
+    """Determine which polygon each point falls in
+
+    Args:
+        * points: Nx2 array of point coordinates (x, y)
+        * polygons: list of polygon geometry objects or list of polygon arrays
+              or polygons packed into flat arrays (see PackedGeometry in
+              safe.storage.geometry)
+        * closed: (optional) determine whether points on boundary should be
+              regarded as belonging to the polygon (closed = True)
+              or not (closed = False). See separate_points_by_polygon.
+        * check_input: Allows faster execution if set to False
+        * points_per_cell: Average number of points per cell in the
+              grid index. Default 16.
+        * index: (optional) PointGridIndex built over the same points.
+              Pass it in when classifying one set of points by several
+              sets of polygons so the index is only built once.
+
+    Returns:
+        * polygon_ids: Integer array of length N with the index of the
+              polygon each point falls in or -1 if it is outside all polygons
+
+    Raises:
+        PolygonInputError if points can not be converted to an Nx2 array
+        or the index was built for a different number of points
+
+    Note:
+        The points are sorted once into a regular grid of cells covering
+        their extent and the bounding boxes of all polygons are computed
+        up front. For each polygon only the unassigned points in the cells
+        overlapping its bounding box are passed to the point in polygon
+        algorithm. This brings the cost down from O(polygons x points) to
+        roughly that of testing each point against the polygons near it.
+
+        If multiple polygons overlap, the one first encountered will be used.
+    """
+
+    if check_input:
+        points = _check_points(points, closed)
+
+    M = points.shape[0]
+    polygon_ids = numpy.zeros(M, dtype=numpy.int) - 1
+    if M == 0 or len(polygons) == 0:
+        return polygon_ids
+
+    for i, candidates, inside in _points_in_each_polygon(
+            points, polygons, closed, points_per_cell, index, polygon_ids):
+        polygon_ids[candidates[inside]] = i
+
+    return polygon_ids
+
+
+def find_points_in_polygons(points, polygons,
+                            closed=True,
+                            check_input=True,
+                            points_per_cell=16,
+                            index=None):
+    """Find all points falling in each of several polygons
+
+    Args:
+        * points, polygons, closed, check_input, points_per_cell, index:
+              See classify_points_by_polygons
+
+    Returns:
+        * List of integer arrays, one for each polygon, with the indices
+              of all points inside it in ascending order
+
+    Raises:
+        PolygonInputError if points can not be converted to an Nx2 array
+        or the index was built for a different number of points
+
+    Note:
+        Unlike classify_points_by_polygons, points in overlapping
+        polygons or on edges shared by polygons (if closed is True) are
+        found in each of them. The result is the same as calling
+        inside_polygon for each polygon but only points near each polygon
+        are tested (see classify_points_by_polygons).
+    """
+
+    if check_input:
+        points = _check_points(points, closed)
+
+    indices = [numpy.zeros(0, dtype=numpy.int) for _ in polygons]
+    if points.shape[0] == 0 or len(polygons) == 0:
+        return indices
+
+    for i, candidates, inside in _points_in_each_polygon(
+            points, polygons, closed, points_per_cell, index):
+        indices[i] = numpy.sort(candidates[inside])
+
+    return indices
+
+
+def _check_points(points, closed):
+    """Check arguments of classify_points_by_polygons
+
+    Returns:
+        * Points as Nx2 float array
+    """
+
+    msg = 'Keyword argument "closed" must be boolean or None'
+    if not (isinstance(closed, bool) or closed is None):
+        raise PolygonInputError(msg)
+
+    try:
+        points = ensure_numeric(points, numpy.float)
+    except Exception, e:
+        msg = ('Points could not be converted to numeric array: %s'
+               % str(e))
+        raise PolygonInputError(msg)
+
+    if len(points.shape) == 1:
+        # Only one point was passed in. Convert to array of points.
+        points = numpy.reshape(points, (1, 2))
+
+    msg = ('Points array must be a 2d array with two columns (x,y). '
+           'I got shape %s' % str(points.shape))
+    if len(points.shape) != 2 or points.shape[1] != 2:
+        raise PolygonInputError(msg)
+
+    return points
+
+
+def _points_in_each_polygon(points, polygons, closed, points_per_cell,
+                            index, polygon_ids=None):
+    """Test points near each polygon against it
+
+    Args:
+        * points: Nx2 float array of checked points
+        * polygons, closed, points_per_cell, index: See
+              classify_points_by_polygons
+        * polygon_ids: (optional) Array of polygon ids being assigned.
+              If given, points with ids other than -1 when a polygon is
+              reached are not tested against it.
+
+    Returns:
+        * Generator of (i, candidates, inside) where candidates are the
+          indices of the points tested against polygon i and inside
+          indexes those of them in polygon i
+    """
+
+    M = points.shape[0]
+    bboxes = polygon_bounding_boxes(polygons)
+
+    # Build grid index over points unless one was given
+    if index is None:
+        index = PointGridIndex(points, points_per_cell=points_per_cell)
+    else:
+        msg = ('Point index was built for %i points but %i points '
+               'were given' % (len(index), M))
+        if len(index) != M:
+            raise PolygonInputError(msg)
+
+    for i, polygon in enumerate(polygons):
+        candidates = index.candidates(bboxes[i])
+
+        # Points already assigned to a polygon are not considered again
+        if polygon_ids is not None:
+            candidates = candidates[polygon_ids[candidates] < 0]
+        if len(candidates) == 0:
+            continue
+
+        # Input was checked, so skip checks in the per polygon calls
+        outer_ring, inner_rings = _get_polygon_rings(polygon)
+        outer_ring = ensure_numeric(outer_ring, numpy.float)
+        inside, _ = in_and_outside_polygon(points[candidates],
+                                           outer_ring,
+                                           holes=inner_rings,
+                                           closed=closed,
+                                           check_input=False)
+        yield i, candidates, inside
+
+
+def rasterise_polygons(polygons, geotransform, shape, closed=True):
+    """Label each point of a grid with the polygon it falls in
+
+    Args:
+        * polygons: list of polygon geometry objects or list of polygon arrays
+              or polygons packed into flat arrays (see PackedGeometry in
+              safe.storage.geometry)
+        * geotransform: 6-tuple used to locate the grid geographically
+            (top left x, w-e pixel resolution, rotation,
+            top left y, rotation, n-s pixel resolution)
+        * shape: Number of rows and columns of the grid
+        * closed: (optional) determine whether grid points on boundary
+              should be regarded as belonging to the polygon. See
+              separate_points_by_polygon.
+
+    Returns:
+        * labels: Integer array of the shape of the grid with the index of
+              the polygon each grid point falls in or -1 if it is outside
+              all polygons
+
+    Note:
+        Grid points are the pixel centres (see geotransform2axes).
+
+        Each polygon is filled one grid row at a time within its bounding
+        box (see _ring_mask) rather than testing every grid point against
+        it, so the cost is proportional to the number of edge crossings
+        and the area of the bounding boxes. Grid points are labelled
+        exactly as classify_points_by_polygons labels them, and if
+        multiple polygons overlap, the one first encountered will be used.
+    """
+
+    ny, nx = shape
+    x, y = geotransform2axes(geotransform, nx, ny)
+
+    labels = numpy.zeros((ny, nx), dtype=numpy.int32) - 1
+    if len(polygons) == 0:
+        return labels
+
+    bboxes = polygon_bounding_boxes(polygons)
+    for i, polygon in enumerate(polygons):
+        # Grid points within bounding box of polygon
+        minx, maxx, miny, maxy = bboxes[i]
+        c0 = numpy.searchsorted(x, minx, side='left')
+        c1 = numpy.searchsorted(x, maxx, side='right')
+        j0 = numpy.searchsorted(y, miny, side='left')
+        j1 = numpy.searchsorted(y, maxy, side='right')
+        if c0 >= c1 or j0 >= j1:
+            continue
+
+        outer_ring, inner_rings = _get_polygon_rings(polygon)
+        inside = _ring_mask(outer_ring, x[c0:c1], y[j0:j1], closed)
+        if inner_rings is not None:
+            if closed is None:
+                hole_closed = None
+            else:
+                hole_closed = not closed
+            for hole in inner_rings:
+                inside &= ~_ring_mask(hole, x[c0:c1], y[j0:j1],
+                                      hole_closed)
+
+        # Latitudes go south to north whereas rows go north to south
+        window = labels[ny - j1:ny - j0, c0:c1]
+        window[inside[::-1] & (window < 0)] = i
+
+    return labels
+
+
+def zonal_statistics(A, geotransform, polygons, closed=True):
+    """Sum and count grid values in each polygon
+
+    Args:
+        * A: MxN array of grid values
+        * geotransform: 6-tuple used to locate A geographically
+            (top left x, w-e pixel resolution, rotation,
+            top left y, rotation, n-s pixel resolution)
+        * polygons: list of polygon geometry objects or list of polygon arrays
+              or polygons packed into flat arrays
+        * closed: (optional) see rasterise_polygons
+
+    Returns:
+        * sums: Array with the sum of the grid values in each polygon.
+              NaN values are ignored.
+        * counts: Integer array with the number of grid points in each
+              polygon
+
+    Note:
+        Grid points are assigned to polygons as in clip_grid_by_polygons
+        (see rasterise_polygons), but without generating their
+        coordinates.
+    """
+
+    A = numpy.asarray(A)
+    labels = rasterise_polygons(polygons, geotransform, A.shape,
+                                closed=closed)
+
+    inside = labels >= 0
+    polygon_ids = labels[inside]
+    values = A[inside]
+    valid = ~numpy.isnan(values)
+
+    counts = numpy.bincount(polygon_ids, minlength=len(polygons))
+    sums = numpy.bincount(polygon_ids[valid], weights=values[valid],
+                          minlength=len(polygons))
+    return sums, counts
+
+
+def _ring_mask(ring, x, y, closed):
+    """Determine which points of a grid are inside a ring
+
+    Args:
+        * ring: Nx2 array of vertices
+        * x, y: Increasing axes of the grid
+        * closed: Whether points on the ring are inside (True), outside
+              (False) or undetermined (None)
+
+    Returns:
+        * Boolean array of shape (len(y), len(x))
+
+    Note:
+        This gives the same as separate_points_by_polygon for the grid
+        points. The edges crossed by each grid row and where they cross
+        it are computed with the formula in _edge_crossings. Points east
+        of an odd number of crossings are inside, which are the runs of
+        points between the first and second, the third and fourth, ...
+        crossing of each row. Points on the boundary are found among the
+        grid points next to the crossings and on horizontal edges
+        (see _ring_boundary).
+    """
+
+    ring = ensure_numeric(ring, numpy.float)
+    px_i = ring[:, 0]
+    py_i = ring[:, 1]
+    px_j = numpy.concatenate((px_i[1:], px_i[:1]))
+    py_j = numpy.concatenate((py_i[1:], py_i[:1]))
+    ymin = numpy.minimum(py_i, py_j)
+    ymax = numpy.maximum(py_i, py_j)
+
+    # Edges cross the rows with latitudes in (ymin, ymax]
+    e, j = _edge_rows(numpy.searchsorted(y, ymin, side='right'),
+                      numpy.searchsorted(y, ymax, side='right'))
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    # Edge crossing formula (as in _edge_crossings)
+    sigma = ((y[j] - py_i[e]) / (py_j[e] - py_i[e]) *
+             (px_j[e] - px_i[e]))
+    crossings = px_i[e] + sigma
+
+    numpy.seterr(**original_numpy_settings)
+
+    # Sort crossings along each row. There is an even number per row.
+    order = numpy.lexsort((crossings, j))
+    j = j[order]
+    crossings = crossings[order]
+
+    # Mark start and end of runs and fill them
+    start = numpy.searchsorted(x, crossings[0::2], side='right')
+    end = numpy.searchsorted(x, crossings[1::2], side='right')
+    runs = numpy.zeros((len(y), len(x) + 1), dtype=numpy.int8)
+    numpy.add.at(runs, (j[0::2], start), 1)
+    numpy.add.at(runs, (j[0::2], end), -1)
+    inside = numpy.cumsum(runs, axis=1, dtype=numpy.int8)[:, :-1] > 0
+
+    if closed is not None:
+        j, c = _ring_boundary(ring, x, y)
+        inside[j, c] = closed
+
+    return inside
+
+
+def _ring_boundary(ring, x, y):
+    """Find the grid points on a ring
+
+    Args:
+        * ring: Nx2 array of vertices
+        * x, y: Increasing axes of the grid
+
+    Returns:
+        * j, c: Arrays of the row and column indices of the grid points
+          on the ring according to _points_on_boundary
+    """
+
+    px_i = ring[:, 0]
+    py_i = ring[:, 1]
+    px_j = numpy.concatenate((px_i[1:], px_i[:1]))
+    py_j = numpy.concatenate((py_i[1:], py_i[:1]))
+    ymin = numpy.minimum(py_i, py_j)
+    ymax = numpy.maximum(py_i, py_j)
+    xmin = numpy.minimum(px_i, px_j)
+    xmax = numpy.maximum(px_i, px_j)
+
+    # Edges and the rows with latitudes in [ymin, ymax]
+    e, j = _edge_rows(numpy.searchsorted(y, ymin, side='left'),
+                      numpy.searchsorted(y, ymax, side='right'))
+
+    # Candidates are the two grid points either side of where sloping
+    # edges cross a row
+    sloping = py_i[e] != py_j[e]
+    es = e[sloping]
+    js = j[sloping]
+    sigma = ((y[js] - py_i[es]) / (py_j[es] - py_i[es]) *
+             (px_j[es] - px_i[es]))
+    c = numpy.searchsorted(x, px_i[es] + sigma, side='left')
+    candidate_rows = [js, js]
+    candidate_columns = [c - 1, c]
+
+    # and all grid points along horizontal edges
+    eh = e[~sloping]
+    jh, ch = _edge_rows(numpy.searchsorted(x, xmin[eh], side='left'),
+                        numpy.searchsorted(x, xmax[eh], side='right'))
+    candidate_rows.append(j[~sloping][jh])
+    candidate_columns.append(ch)
+
+    j = numpy.concatenate(candidate_rows)
+    c = numpy.clip(numpy.concatenate(candidate_columns), 0, len(x) - 1)
+    if len(j) == 0 or len(x) == 0:
+        return j, c
+
+    # Test each candidate once
+    cells = numpy.unique(j * len(x) + c)
+    j = cells // len(x)
+    c = cells % len(x)
+
+    points = numpy.column_stack((x[c], y[j]))
+    on_boundary = _points_on_boundary(points, ring)
+    return j[on_boundary], c[on_boundary]
+
+
+def _edge_rows(lo, hi):
+    """Expand ranges of indices into pairs
+
+    Args:
+        * lo, hi: Integer arrays of the same length
+
+    Returns:
+        * k, j: Integer arrays such that the pairs (k[n], j[n]) are all
+          pairs with lo[k] <= j < hi[k] ordered by k and j
+    """
+
+    counts = numpy.maximum(hi - lo, 0)
+    k = numpy.repeat(numpy.arange(len(lo)), counts)
+    offsets = numpy.cumsum(counts) - counts
+    j = (numpy.arange(counts.sum()) - numpy.repeat(offsets, counts) +
+         numpy.repeat(lo, counts))
+    return k, j
+
+
 # Main functions for polygon clipping
 # FIXME (Ole): Both can be rigged to return points or lines
 # outside any polygon by adding that as the entry in the list returned
@@ -1275,52 +2188,67 @@ def clip_grid_by_polygons(A, geotransform, polygons):
 
         If multiple polygons overlap, the one first encountered will be used.
 
+        Grid points are assigned to polygons by rasterise_polygons, and
+        coordinates are only generated for those inside a polygon.
     """
 
-    # Convert raster grid to Nx2 array of points and an N array of pixel values
+    A = numpy.asarray(A)
     ny, nx = A.shape
     x, y = geotransform2axes(geotransform, nx, ny)
-    points, values = grid2points(A, x, y)
+    labels = rasterise_polygons(polygons, geotransform, A.shape,
+                                closed=True)
+
+    # Grid points inside a polygon in row major order as in grid2points
+    idx = numpy.flatnonzero(labels >= 0)
+    polygon_ids = labels.reshape(-1)[idx]
+    rows = idx // nx
+    columns = idx % nx
+    points = numpy.column_stack((x[columns], y[ny - 1 - rows]))
+    values = A.reshape(-1)[idx]
 
     # Generate list of points and values that fall inside each polygon
-    points_covered = []
-    remaining_points = points
-    remaining_values = values
+    return group_by_polygon_ids(polygon_ids, len(polygons), points, values)
 
-    for polygon in polygons:
-        #print 'Remaining points', len(remaining_points)
 
-        if hasattr(polygon, 'outer_ring'):
-            outer_ring = polygon.outer_ring
-            inner_rings = polygon.inner_rings
-        else:
-            # Assume it is an array
-            outer_ring = polygon
-            inner_rings = None
+def group_by_polygon_ids(polygon_ids, number_of_polygons, *arrays):
+    """Split arrays into groups according to polygon ids
+
+    Args:
+        * polygon_ids: Array of polygon ids as returned by
+              classify_points_by_polygons
+        * number_of_polygons: Number of polygons that were classified against
+        * arrays: One or more arrays of the same length as polygon_ids
 
-        inside, outside = in_and_outside_polygon(remaining_points,
-                                                 outer_ring,
-                                                 holes=inner_rings,
-                                                 closed=True,
-                                                 check_input=False)
-        # Add features inside this polygon
-        points_covered.append((remaining_points[inside],
-                               remaining_values[inside]))
+    Returns:
+        List with one tuple of sub arrays per polygon. Points outside all
+        polygons are left out and the original order is retained within
+        each group.
+    """
 
-        # Select remaining points to clip
-        remaining_points = remaining_points[outside]
-        remaining_values = remaining_values[outside]
+    # Stable sort so that order is retained within each polygon
+    order = numpy.argsort(polygon_ids, kind='mergesort')
+    bounds = numpy.searchsorted(polygon_ids[order],
+                                numpy.arange(number_of_polygons + 1))
 
-    return points_covered
+    groups = []
+    for i in range(number_of_polygons):
+        idx = order[bounds[i]:bounds[i + 1]]
+        groups.append(tuple([A[idx] for A in arrays]))
 
+    return groups
 
-def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
+
+def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True,
+                           exclusive=False):
     """Clip multiple lines by multiple polygons
 
     Args:
         * lines: Sequence of polylines: [[p0, p1, ...], [q0, q1, ...], ...]
             where pi and qi are point coordinates (x, y).
         * polygons: list of polygons, each an array of vertices
+            Lines and polygons can also be packed into flat arrays (see
+            PackedGeometry in safe.storage.geometry). Only the outer rings
+            of packed polygons are used.
         * closed: optional parameter to determine whether lines that fall on
             an polygon boundary should be considered to be inside
             (closed=True), outside (closed=False) or
@@ -1328,17 +2256,27 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
             algorithm up but lines on boundaries may or may not be
             deemed to fall inside the polygon and so will be
             indeterministic.
+        * exclusive: optional parameter. If True, only the parts of lines
+            that fall outside all previous polygons are clipped by the
+            next polygon. This is much faster when there are many polygons
+            but means that line parts inside overlapping polygons only
+            end up with the first one encountered.
 
     Returns:
         lines_covered: List of polylines inside a polygon -o ne per input
-        polygon.
+        polygon. Each is a dictionary keyed by the index of the
+        original line as returned by clip_lines_by_polygon.
 
 
-    .. note:: If multiple polygons overlap, the one first encountered will be
-        used.
+    .. note:: If multiple polygons overlap and exclusive is True, the one
+        first encountered will be used. Otherwise every polygon gets the
+        lines it covers.
     """
 
-    if check_input:
+    if is_packed(polygons):
+        polygons = polygons.get_outer_rings()
+
+    if check_input and not is_packed(lines):
         for i in range(len(lines)):
             try:
                 lines[i] = ensure_numeric(lines[i], numpy.float)
@@ -1351,6 +2289,7 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
             if not len(lines[i].shape) == 2:
                 raise RuntimeError(msg)
 
+    if check_input:
         for i in range(len(polygons)):
             try:
                 polygons[i] = ensure_numeric(polygons[i], numpy.float)
@@ -1362,33 +2301,53 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
     # Initialise structures
     lines_covered = []
     remaining_lines = lines
+    parent_line_ids = range(len(lines))
 
     # Clip lines to polygons
     for polygon in polygons:
-    #for i, polygon in enumerate(polygons):
-        #print ('Doing polygon %i (%i vertices) of %i with '
-        #       '%i lines' % (i, len(polygon),
-        #                     len(polygons),
-        #                     len(remaining_lines)))
-        inside_lines, _ = clip_lines_by_polygon(remaining_lines,
-                                                polygon,
-                                                check_input=False)
-        #print ('- %i segments were inside'
-        #       % len(line_dictionary_to_geometry(inside_lines)))
-
-        # Record lines inside this polygon
-        lines_covered.append(inside_lines)
-
-        # Use lines outside as remaining lines
-        # FIXME (Ole): This optimisation needs some thought
-        # as lines are often partially clipped. We also need to keep
-        # track of the parent line to get its attributes if we want
-        # to go down this road
-        #remaining_lines = outside_lines
+        inside_lines, outside_lines = clip_lines_by_polygon(remaining_lines,
+                                                            polygon,
+                                                            closed=closed,
+                                                            check_input=False)
+
+        if not exclusive:
+            # Record lines inside this polygon
+            lines_covered.append(inside_lines)
+            continue
+
+        # Record lines inside this polygon by their parent line and
+        # use lines outside as remaining lines for the next polygon
+        covered = dict([(i, []) for i in range(len(lines))])
+        remaining_lines = []
+        remaining_parent_ids = []
+        for k, parent_id in enumerate(parent_line_ids):
+            covered[parent_id].extend(inside_lines[k])
+            remaining_lines.extend(outside_lines[k])
+            remaining_parent_ids.extend([parent_id] * len(outside_lines[k]))
+
+        lines_covered.append(covered)
+        parent_line_ids = remaining_parent_ids
 
     return lines_covered
 
 
+def is_packed(geometry):
+    """Determine if geometry is packed into flat coordinate arrays
+
+    Args:
+        * geometry: Sequence of geometries or PackedGeometry instance
+          (see safe.storage.geometry)
+
+    Returns:
+        * True if geometry has the coordinates, offsets and bounding boxes
+          of a PackedGeometry
+    """
+
+    return (hasattr(geometry, 'coordinates') and
+            hasattr(geometry, 'ring_offsets') and
+            hasattr(geometry, 'bboxes'))
+
+
 def polygon2segments(polygon):
     """Convert polygon to segments structure suitable for use in intersection
 
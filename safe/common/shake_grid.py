@@ -0,0 +1,307 @@
+"""**Reading of ShakeMap grid.xml files**
+
+The grid.xml file published by ShakeMap has a short header describing the
+event, the grid and its fields followed by a large grid_data element with
+one line of whitespace separated numbers for each grid point, e.g.::
+
+   <shakemap_grid ... event_id="20120726022003" ...>
+   <event magnitude="5.0" depth="11" lat="-0.210000" lon="124.450000" ... />
+   <grid_specification lon_min="122.450000" lat_min="-2.210000" ...
+       nlon="161" nlat="161" />
+   <grid_field index="1" name="LON" units="dd" />
+   <grid_field index="2" name="LAT" units="dd" />
+   ...
+   <grid_data>
+   122.4500 01.7900 0.01 0.01 1 0.03 0.01 0 0.5 1 600
+   ...
+   </grid_data>
+   </shakemap_grid>
+
+The header is parsed incrementally with an XML parser and the data block is
+converted to numbers in blocks with numpy so neither the document nor the
+data are ever held in memory as text or Python objects.
+"""
+
+import numpy
+from xml.etree import ElementTree
+
+from safe.common.exceptions import GridXmlParseError
+
+# Number of bytes of grid_data converted to numbers at a time
+GRID_BLOCK_SIZE = 2 ** 22
+
+# Algorithms of gdal_grid provided by grid_shake_data
+GRID_ALGORITHMS = ['nearest', 'invdist']
+
+
+class _GridHeader(object):
+    """Target of the XML parser collecting attributes of header elements
+    """
+
+    def __init__(self):
+        self.header = {'grid_fields': {}}
+
+    def start(self, tag, attributes):
+        # Drop namespace, e.g. {http://earthquake.usgs.gov/...}event
+        tag = tag.split('}')[-1]
+        if tag == 'grid_field':
+            self.header['grid_fields'][int(attributes['index'])] = (
+                attributes['name'])
+        elif tag != 'grid_data':
+            self.header[tag] = dict(attributes)
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.header
+
+
+def read_grid_xml(filename, field_names=('LON', 'LAT', 'MMI'),
+                  block_size=GRID_BLOCK_SIZE):
+    """Read header and data of ShakeMap grid.xml file
+
+    Args:
+        * filename: Path to grid.xml file
+        * field_names: Names of grid fields (see the grid_field elements)
+              to return in the data array. Case is ignored.
+              If None, all fields are returned.
+        * block_size: Approximate number of bytes of the data block
+              converted to numbers at a time
+
+    Returns:
+        * header: Dictionary of dictionaries of the attributes of the
+              shakemap_grid, event and grid_specification elements with
+              keys of the same names and the list of names of all grid
+              fields in the order of their columns with key 'grid_fields'
+        * data: Numpy array of floats with one row for each grid point
+              and one column for each of field_names
+
+    Raises:
+        * GridXmlParseError if file is not a valid grid.xml file
+    """
+
+    fid = open(filename, 'rb')
+    try:
+        target = _GridHeader()
+        parser = ElementTree.XMLParser(target=target)
+
+        # Feed header to parser up to the start of the data block
+        data_tag = '<grid_data>'
+        try:
+            while True:
+                # Lines, not iteration, as the data are read in blocks
+                line = fid.readline()
+                if not line:
+                    msg = 'No grid_data element found in %s' % filename
+                    raise GridXmlParseError(msg)
+                i = line.find(data_tag)
+                if i >= 0:
+                    parser.feed(line[:i + len(data_tag)])
+                    line = line[i + len(data_tag):]
+                    break
+                parser.feed(line)
+        except ElementTree.ParseError, e:
+            msg = 'Invalid header in %s: %s' % (filename, str(e))
+            raise GridXmlParseError(msg)
+        header = target.header
+
+        fields = header['grid_fields']
+        fields = [fields[i] for i in sorted(fields.keys())]
+        header['grid_fields'] = fields
+        if field_names is None:
+            columns = range(len(fields))
+        else:
+            available = [name.upper() for name in fields]
+            columns = []
+            for name in field_names:
+                if name.upper() not in available:
+                    msg = ('Field %s not found in %s. Available fields '
+                           'are %s' % (name, filename, ', '.join(fields)))
+                    raise GridXmlParseError(msg)
+                columns.append(available.index(name.upper()))
+
+        # Convert data block to numbers, cutting blocks after whole lines
+        blocks = []
+        text = line
+        end = -1
+        while end < 0:
+            block = fid.read(block_size)
+            text += block
+            end = text.find('</grid_data>')
+            if end >= 0:
+                text = text[:end]
+                remainder = ''
+            elif block:
+                i = text.rfind('\n') + 1
+                text, remainder = text[:i], text[i:]
+            else:
+                msg = 'Data block of %s is not terminated' % filename
+                raise GridXmlParseError(msg)
+
+            # Whitespace on its own would be converted to [-1.]
+            if text and not text.isspace():
+                values = numpy.fromstring(text, sep=' ')
+                if values.size % len(fields) != 0:
+                    msg = ('Lines of grid_data in %s must have %i values '
+                           'each' % (filename, len(fields)))
+                    raise GridXmlParseError(msg)
+                values = values.reshape((-1, len(fields)))
+                blocks.append(values[:, columns].copy())
+            text = remainder
+    finally:
+        fid.close()
+
+    if blocks:
+        data = numpy.concatenate(blocks)
+    else:
+        data = numpy.zeros((0, len(columns)))
+
+    # Conversion of text stops silently at the first invalid number
+    specification = header.get('grid_specification', {})
+    if 'nlon' in specification and 'nlat' in specification:
+        points = int(specification['nlon']) * int(specification['nlat'])
+        if data.shape[0] != points:
+            msg = ('Expected %i grid points in %s but got %i'
+                   % (points, filename, data.shape[0]))
+            raise GridXmlParseError(msg)
+
+    return header, data
+
+
+def grid_shake_data(data, extent, shape, algorithm='nearest', power=2.0,
+                    smoothing=1.0, block_size=GRID_BLOCK_SIZE):
+    """Grid values at ShakeMap grid points onto a raster
+
+    Args:
+        * data: Array with columns lon, lat and value, one row for each
+              point of the ShakeMap grid in the order of grid.xml, i.e.
+              rows of constant latitude from north to south
+        * extent: Bounding box [west, south, east, north] of the raster
+        * shape: Number of rows and columns of the raster
+        * algorithm: 'nearest' for the value of the nearest grid point or
+              'invdist' for values weighted by inverse distance to all
+              grid points (see gdal_grid)
+        * power, smoothing: Parameters of 'invdist'. Weights are
+              1 / (d**2 + smoothing**2)**(power / 2) where d is the
+              distance in degrees.
+        * block_size: Approximate number of weights calculated at a time
+              for 'invdist'
+
+    Returns:
+        * A: Numpy array of gridded values with the given shape
+        * geotransform: GDAL geotransform of A
+
+    Raises:
+        * GridXmlParseError if the points are not ordered by rows and
+          columns or the algorithm is unknown
+
+    Note:
+        The raster is the one made by gdal_grid -txe west east
+        -tye south north -outsize columns rows. Cells cover the extent
+        and values are calculated at their centres.
+    """
+
+    west, south, east, north = [float(x) for x in extent]
+    rows, columns = [int(x) for x in shape]
+    dx = (east - west) / columns
+    dy = (north - south) / rows
+    geotransform = (west, dx, 0.0, north, 0.0, -dy)
+
+    # Centres of raster cells
+    x = west + (numpy.arange(columns) + 0.5) * dx
+    y = north - (numpy.arange(rows) + 0.5) * dy
+
+    lon, lat, values = _shake_lattice(numpy.asarray(data,
+                                                    dtype=numpy.float64))
+    if algorithm == 'nearest':
+        i = _nearest(lat, y)
+        j = _nearest(lon, x)
+        A = values[i[:, numpy.newaxis], j[numpy.newaxis, :]]
+    elif algorithm == 'invdist':
+        # Squared distances separate into longitudes and latitudes on
+        # the lattice of grid points
+        dx2 = (x[:, numpy.newaxis] - lon) ** 2
+        dy2 = (y[:, numpy.newaxis] - lat) ** 2 + smoothing ** 2
+
+        # Sums of weighted values and of weights in one product
+        Z = numpy.ones((values.size, 2))
+        Z[:, 0] = values.ravel()
+
+        A = numpy.zeros((rows, columns))
+        step = max(1, block_size // (columns * values.size))
+        for start in range(0, rows, step):
+            stop = min(start + step, rows)
+            W = (dx2[numpy.newaxis, :, numpy.newaxis, :] +
+                 dy2[start:stop, numpy.newaxis, :, numpy.newaxis])
+            if power == 2:
+                numpy.reciprocal(W, out=W)
+            else:
+                numpy.power(W, -power / 2.0, out=W)
+            S = numpy.dot(W.reshape(((stop - start) * columns, -1)), Z)
+            A[start:stop, :] = (S[:, 0] / S[:, 1]).reshape((-1, columns))
+    else:
+        msg = ('Algorithm must be either nearest or invdist. I got %s'
+               % algorithm)
+        raise GridXmlParseError(msg)
+
+    return A, geotransform
+
+
+def _shake_lattice(data):
+    """Axes and values of ShakeMap grid points
+
+    Args:
+        * data: Array with columns lon, lat and value in the order of
+              grid.xml
+
+    Returns:
+        * lon: Longitudes of grid columns
+        * lat: Latitudes of grid rows
+        * values: Array of values with one row for each latitude
+
+    Raises:
+        * GridXmlParseError if points do not form a lattice
+    """
+
+    # Number of points in first row of constant latitude
+    different = numpy.nonzero(data[:, 1] != data[0, 1])[0]
+    if len(different) > 0:
+        columns = different[0]
+    else:
+        columns = len(data)
+    rows = len(data) // columns
+
+    lon = data[:columns, 0]
+    lat = data[::columns, 1]
+    if (rows * columns != len(data) or
+            not numpy.all(data[:, 0].reshape((rows, columns)) == lon) or
+            not numpy.all(data[:, 1].reshape((rows, columns)).T == lat)):
+        msg = 'ShakeMap grid points must be ordered by rows and columns'
+        raise GridXmlParseError(msg)
+
+    return lon, lat, data[:, 2].reshape((rows, columns))
+
+
+def _nearest(axis, x):
+    """Indices of nearest values on ascending or descending axis
+
+    Args:
+        * axis: Monotonic array of coordinates
+        * x: Array of coordinates
+
+    Returns:
+        * Array of indices into axis of the coordinate nearest to each x
+    """
+
+    if len(axis) > 1 and axis[0] > axis[-1]:
+        return len(axis) - 1 - _nearest(axis[::-1], x)
+
+    upper = numpy.clip(numpy.searchsorted(axis, x), 1, max(1, len(axis) - 1))
+    lower = upper - 1
+    upper = numpy.minimum(upper, len(axis) - 1)
+    nearest = numpy.where(axis[upper] - x < x - axis[lower], upper, lower)
+    return nearest
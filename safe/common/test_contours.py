@@ -0,0 +1,89 @@
+import unittest
+import numpy
+
+from safe.common.contours import contour_grid, line_bounds_and_lengths
+
+
+class Test_contours(unittest.TestCase):
+
+    def test_contour_circles(self):
+        """Contours of distance from the origin are circles
+        """
+
+        # Grid cell centres from -0.99 to 0.99 in both directions
+        geotransform = (-1.0, 0.02, 0, 1.0, 0, -0.02)
+        x = numpy.arange(100) * 0.02 - 0.99
+        X, Y = numpy.meshgrid(x, -x)
+        A = numpy.sqrt(X ** 2 + Y ** 2)
+
+        lines, levels = contour_grid(A, geotransform, 0.25)
+        assert numpy.allclose(levels, [0.25, 0.5, 0.75, 1.0, 1.0, 1.0, 1.0,
+                                       1.25, 1.25, 1.25, 1.25])
+        for line, level in zip(lines, levels):
+            # On the circle within interpolation error and closed unless
+            # crossing the edge of the grid
+            radii = numpy.sqrt(line[:, 0] ** 2 + line[:, 1] ** 2)
+            assert numpy.allclose(radii, level, rtol=0, atol=2.0e-4)
+            assert numpy.all(line[0] == line[-1]) == (level < 0.99)
+
+        bounds, lengths = line_bounds_and_lengths(lines[:3])
+        for k, level in enumerate(levels[:3]):
+            assert numpy.allclose(bounds[k], [-level, -level, level, level],
+                                  rtol=0, atol=1.0e-3)
+        assert numpy.allclose(lengths, 2 * numpy.pi * levels[:3],
+                              rtol=1.0e-3)
+
+    def test_contour_saddles_and_nan(self):
+        """Saddles are resolved by the centre value and NaN leaves gaps
+        """
+
+        A = numpy.array([[0, 1, 0],
+                         [1, 0.4, 1],
+                         [0, 1, 0]])
+        geotransform = (0, 1, 0, 3, 0, -1)
+
+        # Centres of saddle squares are above 0.5 so the four corners are
+        # cut off by separate lines in addition to the ring around the
+        # centre
+        lines, levels = contour_grid(A, geotransform, 0.5)
+        assert numpy.all(levels == 0.5)
+        assert len(lines) == 5
+        assert sorted([len(line) for line in lines]) == [2, 2, 2, 2, 5]
+
+        # Centres below the level join up the low corners and the centre
+        A[1, 1] = -0.8
+        lines, levels = contour_grid(A, geotransform, 0.5)
+        assert numpy.allclose(levels, [-0.5, 0.0, 0.5, 0.5, 0.5, 0.5])
+        assert [len(line) for line in lines] == [5, 5, 3, 3, 3, 3]
+
+        # Values equal to a level are above it so lines collapsed onto
+        # the maximum are left out
+        lines, levels = contour_grid(A, geotransform, 1.0)
+        assert numpy.all(levels == 0)
+        assert len(lines) == 1
+
+        A[1, 1] = numpy.nan
+        lines, levels = contour_grid(A, geotransform, 0.5)
+        assert len(lines) == 0
+
+        lines, levels = contour_grid(numpy.zeros((3, 3)) + numpy.nan,
+                                     geotransform, 0.5)
+        assert len(lines) == 0
+        bounds, lengths = line_bounds_and_lengths(lines)
+        assert bounds.shape == (0, 4)
+        assert lengths.shape == (0,)
+
+    def test_line_bounds_and_lengths(self):
+        """Bounding boxes and lengths of lines are computed at once
+        """
+
+        lines = [numpy.array([[0, 0], [3, 4], [3, 0]]),
+                 numpy.array([[-1, 2], [-1, -2]])]
+        bounds, lengths = line_bounds_and_lengths(lines)
+        assert numpy.allclose(bounds, [[0, 0, 3, 4], [-1, -2, -1, 2]])
+        assert numpy.allclose(lengths, [9, 4])
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_contours, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -4,6 +4,8 @@ import unittest
 # Import InaSAFE modules
 from safe.common.interpolation2d import interpolate2d, interpolate_raster
 from safe.common.interpolation2d import BoundsError
+from safe.common.interpolation2d import (uniform_spacing,
+                                         find_upper_neighbours)
 from safe.common.interpolation1d import interpolate1d
 from safe.common.testing import combine_coordinates
 from safe.common.numerics import nanallclose
@@ -449,6 +451,47 @@ class Test_interpolate(unittest.TestCase):
 
         assert numpy.allclose(vals, refs, rtol=1e-12, atol=1e-12)
 
+    def test_interpolation_uniform_grid(self):
+        """Interpolation on equidistant axes agrees with searching
+        """
+
+        # Equidistant axes and the same axes made slightly uneven
+        x = numpy.linspace(100.05, 109.95, 100)
+        y = numpy.linspace(-5.025, 4.975, 200)
+        assert uniform_spacing(x) is not None
+        assert uniform_spacing(y) is not None
+
+        x_uneven = x.copy()
+        x_uneven[50] += 1.0e-6
+        y_uneven = y.copy()
+        y_uneven[1] -= 1.0e-6
+        assert uniform_spacing(x_uneven) is None
+        assert uniform_spacing(y_uneven) is None
+
+        # Points inside and outside the grid and on grid lines
+        numpy.random.seed(13)
+        points = (numpy.random.random((5000, 2)) * [11, 11] +
+                  [x[0] - 0.5, y[0] - 0.5])
+        points = numpy.concatenate(
+            [points, combine_coordinates(x[::3], y[::7])])
+        for xi in [x[::3], points[:, 0]]:
+            assert numpy.all(find_upper_neighbours(x, xi) ==
+                             find_upper_neighbours(x_uneven, xi))
+
+        A = numpy.random.random((len(x), len(y)))
+        A[numpy.random.random(A.shape) < 0.05] = numpy.nan
+
+        for mode in ['linear', 'constant']:
+            vals = interpolate2d(x, y, A, points, mode=mode)
+            refs = interpolate2d(x_uneven, y_uneven, A, points, mode=mode)
+            assert nanallclose(vals, refs, rtol=1.0e-5, atol=1.0e-5)
+
+            # Single precision grids
+            vals32 = interpolate2d(x, y, A.astype(numpy.float32), points,
+                                   mode=mode)
+            assert vals32.dtype == numpy.float64
+            assert nanallclose(vals32, vals, rtol=1.0e-6, atol=1.0e-6)
+
     #-----------------------
     # 1D interpolation tests
     #-----------------------
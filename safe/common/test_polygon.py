@@ -17,12 +17,19 @@ from safe.common.polygon import (separate_points_by_polygon,
                                  join_line_segments,
                                  clip_line_by_polygon,
                                  clip_grid_by_polygons,
+                                 classify_points_by_polygons,
+                                 find_points_in_polygons,
+                                 PointGridIndex,
+                                 group_by_polygon_ids,
+                                 rasterise_polygons,
+                                 zonal_statistics,
                                  populate_polygon,
                                  generate_random_points_in_bbox,
                                  PolygonInputError,
                                  line_dictionary_to_geometry)
 from safe.common.testing import test_polygon, test_lines
-from safe.common.numerics import ensure_numeric
+from safe.common.numerics import (ensure_numeric, grid2points,
+                                  geotransform2axes)
 
 
 def linear_function(x, y):
@@ -540,6 +547,86 @@ class Test_Polygon(unittest.TestCase):
         assert numpy.allclose(ins_p, [1, 2, 3])
         assert numpy.allclose(out_p, [0, 4, 5])
 
+    def test_separate_points_by_polygon_slabs(self):
+        """Slab version of polygon clipping agrees with edge version
+        """
+
+        # Polygon with horizontal edges and shared vertex latitudes
+        polygon = [[0, 0], [1, 0], [0.5, -1], [2, -1], [2, 1], [0, 1]]
+        points = [[0.5, 1.4], [0.5, 0.5], [1, -0.5], [1.5, 0],
+                  [0.5, 1.5], [0.5, -0.5], [3, 0], [1.5, -1], [2, 0.5]]
+        for closed in [True, False, None]:
+            ins_e, out_e = separate_points_by_polygon(points, polygon,
+                                                      closed=closed)
+            ins_s, out_s = separate_points_by_polygon(points, polygon,
+                                                      closed=closed,
+                                                      use_slabs=True)
+            assert numpy.all(ins_e == ins_s)
+            assert numpy.all(out_e == out_s)
+
+        # Many vertices and points at vertex latitudes
+        N = 2000
+        angles = numpy.linspace(0, 2 * numpy.pi, N, endpoint=False)
+        radii = 1 + 0.1 * numpy.sin(37 * angles) + 0.05 * numpy.cos(angles)
+        polygon = numpy.array([radii * numpy.cos(angles),
+                               radii * numpy.sin(angles)]).T
+        polygon = numpy.round(polygon * 100) / 100  # Horizontal edges
+
+        points = generate_random_points_in_bbox(polygon, 2000, seed=17)
+        points[:500, 1] = polygon[:500, 1]
+        ins_e, out_e = separate_points_by_polygon(points, polygon,
+                                                  closed=None)
+        ins_s, out_s = separate_points_by_polygon(points, polygon,
+                                                  closed=None,
+                                                  use_slabs=True)
+        assert numpy.all(ins_e == ins_s)
+        assert numpy.all(out_e == out_s)
+        assert len(ins_s) > 0
+        assert len(out_s) > 0
+
+    def test_separate_points_by_polygon_boundary(self):
+        """Points on boundary of polygons with many vertices are detected
+        """
+
+        N = 200
+        angles = numpy.linspace(0, 2 * numpy.pi, N, endpoint=False)
+        radii = 1 + 0.1 * numpy.sin(7 * angles)
+        polygon = numpy.array([radii * numpy.cos(angles),
+                               radii * numpy.sin(angles)]).T
+        polygon = numpy.round(polygon * 100) / 100  # Horizontal edges
+
+        # Points at vertices, on edges and elsewhere
+        next_vertices = numpy.roll(polygon, -1, axis=0)
+        points = numpy.concatenate((polygon,
+                                    (polygon + next_vertices) / 2,
+                                    polygon + 0.25 * (next_vertices -
+                                                      polygon),
+                                    generate_random_points_in_bbox(
+                                        polygon, 1000, seed=17)))
+
+        # Reference result using point_on_line for each edge
+        on_boundary = numpy.zeros(len(points), dtype=bool)
+        for i in range(N):
+            on_boundary += point_on_line(points,
+                                         [polygon[i], next_vertices[i]],
+                                         rtol=0, atol=0)
+        assert numpy.sum(on_boundary) >= N
+
+        ins_n, out_n = separate_points_by_polygon(points, polygon,
+                                                  closed=None)
+        ins_c, out_c = separate_points_by_polygon(points, polygon,
+                                                  closed=True)
+        ins_o, out_o = separate_points_by_polygon(points, polygon,
+                                                  closed=False)
+
+        expected = numpy.zeros(len(points), dtype=bool)
+        expected[ins_n] = True
+        expected[on_boundary] = True
+        assert numpy.all(ins_c == numpy.where(expected)[0])
+
+        expected[on_boundary] = False
+        assert numpy.all(ins_o == numpy.where(expected)[0])
+
     def test_polygon_clipping_error_handling(self):
         """Polygon clipping checks input as expected"""
 
@@ -1004,6 +1091,229 @@ class Test_Polygon(unittest.TestCase):
 
     test_clip_points_by_polygons_with_holes.slow = True
 
+    def test_classify_points_by_polygons(self):
+        """Points can be classified by multiple polygons using an index
+        """
+
+        # Two unit squares side by side, one overlapping the other
+        # and one with a hole
+        polygons = [numpy.array([[0, 0], [1, 0], [1, 1], [0, 1]]),
+                    numpy.array([[1, 0], [2, 0], [2, 1], [1, 1]]),
+                    numpy.array([[0.5, 0], [1.5, 0], [1.5, 1], [0.5, 1]]),
+                    Polygon(outer_ring=numpy.array([[3, 0], [4, 0],
+                                                    [4, 1], [3, 1]]),
+                            inner_rings=[numpy.array([[3.25, 0.25],
+                                                      [3.75, 0.25],
+                                                      [3.75, 0.75],
+                                                      [3.25, 0.75]])])]
+
+        points = [[0.5, 0.5], [1.5, 0.5], [2.5, 0.5], [1.0, 0.5],
+                  [3.1, 0.5], [3.5, 0.5], [-1, -1], [0.75, 0.9]]
+        polygon_ids = classify_points_by_polygons(points, polygons)
+        assert numpy.all(polygon_ids == [0, 1, -1, 0, 3, -1, -1, 0])
+
+        # Degenerate input
+        assert len(classify_points_by_polygons(numpy.zeros((0, 2)),
+                                               polygons)) == 0
+        assert numpy.all(classify_points_by_polygons(points, []) == -1)
+        assert numpy.all(classify_points_by_polygons([0.5, 0.5],
+                                                     polygons) == [0])
+
+        try:
+            classify_points_by_polygons('Hmmm', polygons)
+        except PolygonInputError:
+            pass
+        else:
+            msg = 'Should have raised PolygonInputError'
+            raise Exception(msg)
+
+    def test_classify_points_by_polygons_random(self):
+        """Polygon classification using index matches brute force algorithm
+        """
+
+        # Tile the bounding box of test_polygon with translated copies of it
+        polygons = []
+        for dx in [-0.01, 0, 0.01]:
+            for dy in [-0.01, 0, 0.01]:
+                polygons.append(test_polygon + [dx, dy])
+
+        points = generate_random_points_in_bbox(test_polygon,
+                                                5000, seed=17)
+
+        # Reference result taking first polygon encountered
+        reference = numpy.zeros(len(points), dtype=numpy.int) - 1
+        for i, polygon in enumerate(polygons):
+            inside = inside_polygon(points, polygon)
+            inside = inside[reference[inside] < 0]
+            reference[inside] = i
+
+        for points_per_cell in [1, 16, 10000]:
+            polygon_ids = classify_points_by_polygons(
+                points, polygons, points_per_cell=points_per_cell)
+            assert numpy.all(polygon_ids == reference)
+
+        # Grouping by polygon id
+        groups = group_by_polygon_ids(polygon_ids, len(polygons),
+                                      points, numpy.arange(len(points)))
+        assert len(groups) == len(polygons)
+        for i, (P, idx) in enumerate(groups):
+            assert numpy.all(reference[idx] == i)
+            assert numpy.allclose(P, points[idx])
+            assert numpy.all(idx[1:] > idx[:-1])
+
+    def test_find_points_in_polygons(self):
+        """All points in overlapping polygons and on shared edges are found
+        """
+
+        # Two unit squares sharing an edge and one overlapping both
+        polygons = [numpy.array([[0, 0], [1, 0], [1, 1], [0, 1]]),
+                    numpy.array([[1, 0], [2, 0], [2, 1], [1, 1]]),
+                    numpy.array([[0.5, 0], [1.5, 0], [1.5, 1], [0.5, 1]])]
+        points = [[0.25, 0.5], [1.0, 0.5], [0.75, 0.5], [1.75, 0.5],
+                  [3.0, 0.5]]
+
+        indices = find_points_in_polygons(points, polygons)
+        assert len(indices) == 3
+        assert indices[0].tolist() == [0, 1, 2]
+        assert indices[1].tolist() == [1, 3]
+        assert indices[2].tolist() == [1, 2]
+
+        # Shared edge belongs to neither square if polygons are open
+        indices = find_points_in_polygons(points, polygons, closed=False)
+        assert indices[0].tolist() == [0, 2]
+        assert indices[1].tolist() == [3]
+
+        # Same as inside_polygon for each polygon
+        polygons = [test_polygon + [dx, dy]
+                    for dx in [-0.01, 0, 0.01] for dy in [-0.01, 0, 0.01]]
+        points = generate_random_points_in_bbox(test_polygon,
+                                                5000, seed=17)
+        for points_per_cell in [1, 16, 10000]:
+            indices = find_points_in_polygons(
+                points, polygons, points_per_cell=points_per_cell)
+            for i, polygon in enumerate(polygons):
+                assert numpy.all(indices[i] ==
+                                 inside_polygon(points, polygon))
+
+        assert find_points_in_polygons(points, []) == []
+        indices = find_points_in_polygons(numpy.zeros((0, 2)), polygons)
+        assert [len(idx) for idx in indices] == [0] * len(polygons)
+
+    def test_classify_points_by_polygons_with_index(self):
+        """Point index can be built once and used with several polygon sets
+        """
+
+        points = generate_random_points_in_bbox(test_polygon,
+                                                2000, seed=13)
+        index = PointGridIndex(points)
+        assert len(index) == len(points)
+
+        for dx in [-0.01, 0, 0.02, 10]:
+            polygons = [test_polygon + [dx, 0],
+                        test_polygon + [dx, 0.01]]
+            reference = classify_points_by_polygons(points, polygons)
+            polygon_ids = classify_points_by_polygons(points, polygons,
+                                                      index=index)
+            assert numpy.all(polygon_ids == reference)
+
+        # Candidates cover all points in a bounding box
+        bbox = [numpy.min(test_polygon[:, 0]), numpy.mean(test_polygon[:, 0]),
+                numpy.min(test_polygon[:, 1]), numpy.mean(test_polygon[:, 1])]
+        inside = ((points[:, 0] >= bbox[0]) & (points[:, 0] <= bbox[1]) &
+                  (points[:, 1] >= bbox[2]) & (points[:, 1] <= bbox[3]))
+        candidates = index.candidates(bbox)
+        assert set(numpy.where(inside)[0]) <= set(candidates)
+        assert len(index.candidates([100, 101, 100, 101])) == 0
+        assert len(PointGridIndex(numpy.zeros((0, 2))).candidates(bbox)) == 0
+
+        # Index must match the points
+        try:
+            classify_points_by_polygons(points[:10], [test_polygon],
+                                        index=index)
+        except PolygonInputError:
+            pass
+        else:
+            msg = 'Should have raised PolygonInputError'
+            raise Exception(msg)
+
+    def test_rasterise_polygons(self):
+        """Grid points are labelled with the polygons they fall in
+        """
+
+        numpy.random.seed(17)
+        A = numpy.random.random((60, 80))
+        A[3, 4] = numpy.nan
+
+        # Random polygons, some with holes, which may overlap
+        polygons = []
+        for k in range(20):
+            x0, y0 = numpy.random.random(2) * [80, 60]
+            n = numpy.random.randint(3, 30)
+            angles = numpy.sort(numpy.random.random(n)) * 2 * numpy.pi
+            radii = (numpy.random.random() * 15 + 1) * (
+                0.4 + numpy.random.random(n))
+            ring = numpy.transpose([x0 + radii * numpy.cos(angles),
+                                    y0 + radii * numpy.sin(angles)])
+            if k % 4 == 0:
+                hole = [x0, y0] + numpy.array([[-1, -1], [1, -1], [0, 1]])
+                polygons.append(Polygon(outer_ring=ring,
+                                        inner_rings=[hole]))
+            else:
+                polygons.append(ring)
+
+        # Polygons with edges and vertices on grid points
+        polygons.append(numpy.array([[10.5, 10.5], [20.5, 10.5],
+                                     [20.5, 20.5], [10.5, 20.5]]))
+        polygons.append(numpy.array([[30.5, 30.5], [40.5, 40.5],
+                                     [30.5, 50.5], [30.5, 30.5]]))
+        polygons.append(Polygon(
+            outer_ring=numpy.array([[50.5, 5.5], [70.5, 5.5],
+                                    [70.5, 25.5], [50.5, 25.5]]),
+            inner_rings=[numpy.array([[55.5, 10.5], [60.5, 10.5],
+                                      [60.5, 15.5], [55.5, 15.5]])]))
+
+        # Polygons partly and entirely outside grid
+        polygons.append(numpy.array([[-5, -5], [100, 30], [-5, 70]]))
+        polygons.append(numpy.array([[200, 200], [201, 200], [201, 201]]))
+
+        for geotransform in [(0.0, 1.0, 0, 60.0, 0, -1.0),
+                             (0.13, 0.7, 0, 61.3, 0, -0.9)]:
+
+            # Reference classification of all grid points
+            x, y = geotransform2axes(geotransform, 80, 60)
+            points, values = grid2points(A, x, y)
+            reference = classify_points_by_polygons(points, polygons,
+                                                    check_input=False)
+
+            labels = rasterise_polygons(polygons, geotransform, A.shape)
+            assert labels.shape == A.shape
+            assert numpy.all(labels.reshape(-1) == reference)
+
+            # Clipping gives the same points and values as before
+            groups = group_by_polygon_ids(reference, len(polygons),
+                                          points, values)
+            res = clip_grid_by_polygons(A, geotransform, polygons)
+            assert len(res) == len(polygons)
+            for (p0, v0), (p1, v1) in zip(groups, res):
+                assert numpy.all(p0 == p1)
+                assert numpy.allclose(v0, v1, rtol=0, atol=0) or \
+                    numpy.isnan(numpy.sum(v0))
+
+            # Zonal statistics
+            sums, counts = zonal_statistics(A, geotransform, polygons)
+            assert numpy.allclose(sums, [numpy.nansum(v) for _, v in groups])
+            assert counts.tolist() == [len(v) for _, v in groups]
+            assert counts[-1] == 0
+            assert counts[-2] > 0
+
+        # Polygons on boundary are open without closed
+        geotransform = (0.0, 1.0, 0, 60.0, 0, -1.0)
+        square = polygons[-5]
+        for closed, number in [(True, 121), (False, 81)]:
+            labels = rasterise_polygons([square], geotransform, A.shape,
+                                        closed=closed)
+            assert numpy.sum(labels == 0) == number
+
     def test_intersection1(self):
         """Intersection of two simple lines works
         """
@@ -1524,6 +1834,70 @@ class Test_Polygon(unittest.TestCase):
                               [[0.3, 0.2],
                                [0.31666667, 0.31666667]])
 
+    def test_clip_lines_by_multiple_polygons_exclusive(self):
+        """Lines are only clipped by the first polygon covering them
+        """
+
+        # Same polygons and lines as in test above
+        polygons = [[[0, 0], [1, 0], [1, 1], [0, 1]],  # Unit square
+                    [[1, 0], [3, 0], [2, 1]],  # Adjacent triangle
+                    [[0, 3], [1, 3], [0.5, 2],
+                     [2, 2], [2, 4], [0, 4]],  # Convoluted
+                    [[-1, -1], [5, -1], [5, 3], [5, 3]],  # Overlapping
+                    [[-1, -1], [6, -1], [6, 6], [6, 6]]]  # Cover the others
+
+        input_lines = [[[0, 0.5], [4, 0.5]],
+                       [[2, 0], [2, 5]],
+                       [[0, 0], [5, 5]],
+                       [[10, 10], [30, 10]],
+                       [[-1, 0.5], [0.5, 0.5], [2.5, 3]],
+                       [[0.5, 0.5], [0.5, 2]],
+                       [[100, 100], [300, 100]],
+                       [[0.3, 0.2], [0.7, 3], [1.0, 1.9]],
+                       [[30, 10], [30, 20]]]
+
+        lines_covered = clip_lines_by_polygons(input_lines, polygons,
+                                               exclusive=True)
+        reference = clip_lines_by_polygons(input_lines, polygons)
+
+        assert len(lines_covered) == len(polygons)
+        for lines in lines_covered:
+            assert len(lines) == len(input_lines)
+
+        # First polygon sees all lines
+        for key in reference[0]:
+            assert len(lines_covered[0][key]) == len(reference[0][key])
+            for line, ref in zip(lines_covered[0][key], reference[0][key]):
+                assert numpy.allclose(line, ref)
+
+        # All lines are inside their polygon and outside previous ones
+        for i, polygon in enumerate(polygons):
+            for key in lines_covered[i]:
+                for line in lines_covered[i][key]:
+                    # Allow for zero length pieces where end points
+                    # are on the boundary
+                    inside, outside = clip_line_by_polygon(line, polygon)
+                    for x in outside:
+                        assert numpy.allclose(x[0], x[-1])
+
+                    midpoints = (line[:-1] + line[1:]) / 2
+                    for previous in polygons[:i]:
+                        inside = inside_polygon(midpoints, previous,
+                                                closed=False)
+                        assert len(inside) == 0
+
+        # Polygon 4, line 2 (first part was taken by polygon 0 and
+        # the remainder was split where it touches polygon 2)
+        assert numpy.allclose(lines_covered[4][2][0],
+                              [[1., 1.],
+                               [2., 2.],
+                               [5., 5.]])
+
+        # Polygon 2, line 1 (lower part was taken by polygon 3)
+        assert numpy.allclose(lines_covered[2][1][0],
+                              [[2., 2.],
+                               [2., 4.]])
+
     def test_clip_lines_by_polygon_real_data(self):
         """Real roads are clipped by complex polygon
         """
@@ -0,0 +1,140 @@
+import unittest
+import numpy
+
+from safe.common.shake_grid import read_grid_xml, grid_shake_data
+from safe.common.exceptions import GridXmlParseError
+from safe.common.utilities import unique_filename, temp_dir
+
+GRID_XML = """<?xml version="1.0" encoding="US-ASCII" standalone="yes"?>
+<shakemap_grid xmlns="http://earthquake.usgs.gov/eqcenter/shakemap" \
+event_id="20120726022003" shakemap_version="1">
+<event magnitude="5.0" depth="11" lat="-0.210000" lon="124.450000" \
+event_timestamp="2012-07-26T02:15:35WIB" \
+event_description="Southern Molucca Sea   " />
+<grid_specification lon_min="122.450000" lat_min="-2.210000" \
+lon_max="122.500000" lat_max="1.790000" nlon="3" nlat="2" />
+<grid_field index="1" name="LON" units="dd" />
+<grid_field index="2" name="LAT" units="dd" />
+<grid_field index="3" name="PGA" units="pctg" />
+<grid_field index="4" name="MMI" units="intensity" />
+<grid_data>
+122.4500 01.7900 0.01 1
+122.4750 01.7900 0.02 1.14
+122.5000 01.7900 0.03 1.15
+122.4500 -02.2100 0.04 2
+122.4750 -02.2100 0.05 2.5
+122.5000 -02.2100 0.06 3.25
+</grid_data>
+</shakemap_grid>
+"""
+
+
+def write_grid(text):
+    """Write grid.xml text to temporary file and return its name
+    """
+
+    filename = unique_filename(suffix='.xml', dir=temp_dir('test'))
+    fid = open(filename, 'w')
+    fid.write(text)
+    fid.close()
+    return filename
+
+
+class Test_shake_grid(unittest.TestCase):
+
+    def test_read_grid_xml(self):
+        """Header and data of grid.xml can be read
+        """
+
+        filename = write_grid(GRID_XML)
+        header, data = read_grid_xml(filename)
+
+        assert header['event']['magnitude'] == '5.0'
+        assert header['event']['event_description'].strip() == (
+            'Southern Molucca Sea')
+        assert header['grid_specification']['nlon'] == '3'
+        assert header['shakemap_grid']['event_id'] == '20120726022003'
+        assert header['grid_fields'] == ['LON', 'LAT', 'PGA', 'MMI']
+
+        reference = [[122.45, 1.79, 1], [122.475, 1.79, 1.14],
+                     [122.5, 1.79, 1.15], [122.45, -2.21, 2],
+                     [122.475, -2.21, 2.5], [122.5, -2.21, 3.25]]
+        assert data.dtype == numpy.float64
+        assert numpy.allclose(data, reference, rtol=0, atol=1.0e-12)
+
+        # Data are the same whichever way the data block is cut up
+        for block_size in [1, 7, 40, 1000]:
+            _, D = read_grid_xml(filename, block_size=block_size)
+            assert numpy.all(D == data)
+
+        # Any fields in any order
+        _, D = read_grid_xml(filename, field_names=['mmi', 'PGA'])
+        assert numpy.allclose(D[:, 0], data[:, 2])
+        assert numpy.allclose(D[:, 1], [0.01, 0.02, 0.03, 0.04, 0.05, 0.06])
+
+        _, D = read_grid_xml(filename, field_names=None)
+        assert D.shape == (6, 4)
+
+    def test_read_grid_xml_errors(self):
+        """Invalid grid.xml files raise GridXmlParseError
+        """
+
+        filename = write_grid(GRID_XML)
+        self.assertRaises(GridXmlParseError, read_grid_xml, filename,
+                          field_names=['LON', 'PGV'])
+
+        # Truncated data, bad numbers, missing end tag and header
+        for text in [GRID_XML.replace('122.5000 -02.2100 0.06 3.25\n', ''),
+                     GRID_XML.replace('0.05', 'x'),
+                     GRID_XML.replace(' 2.5\n', '\n'),
+                     GRID_XML.split('</grid_data>')[0],
+                     GRID_XML.split('<grid_data>')[0],
+                     GRID_XML.replace('<event ', '<event <')]:
+            filename = write_grid(text)
+            self.assertRaises(GridXmlParseError, read_grid_xml, filename)
+
+    def test_grid_shake_data(self):
+        """Grid points are gridded like gdal_grid does
+        """
+
+        filename = write_grid(GRID_XML)
+        _, data = read_grid_xml(filename, field_names=['LON', 'LAT', 'MMI'])
+        extent = [122.45, -2.21, 122.5, 1.79]
+        shape = (4, 5)
+
+        A, geotransform = grid_shake_data(data, extent, shape)
+        assert A.shape == shape
+        assert numpy.allclose(geotransform,
+                              (122.45, 0.01, 0, 1.79, 0, -1.0))
+
+        # Values at cell centres from nearest grid point or inverse
+        # distance weighting of all grid points
+        B, _ = grid_shake_data(data, extent, shape, algorithm='invdist',
+                               block_size=1)
+        for i in range(shape[0]):
+            y = 1.79 - (i + 0.5) * 1.0
+            for j in range(shape[1]):
+                x = 122.45 + (j + 0.5) * 0.01
+                d2 = (data[:, 0] - x) ** 2 + (data[:, 1] - y) ** 2
+                assert A[i, j] == data[numpy.argmin(d2), 2]
+
+                weights = 1.0 / (d2 + 1.0)
+                value = numpy.sum(weights * data[:, 2]) / numpy.sum(weights)
+                assert numpy.allclose(B[i, j], value, rtol=1.0e-12)
+
+        C, _ = grid_shake_data(data, extent, shape, algorithm='invdist',
+                               power=3.0, smoothing=0.5)
+        weights = ((data[:, 0] - 122.455) ** 2 +
+                   (data[:, 1] - 1.29) ** 2 + 0.25) ** -1.5
+        value = numpy.sum(weights * data[:, 2]) / numpy.sum(weights)
+        assert numpy.allclose(C[0, 0], value, rtol=1.0e-12)
+
+        self.assertRaises(GridXmlParseError, grid_shake_data, data, extent,
+                          shape, algorithm='average')
+        self.assertRaises(GridXmlParseError, grid_shake_data,
+                          data[[1, 0, 2, 3, 4, 5]], extent, shape)
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_shake_grid, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
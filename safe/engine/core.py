@@ -1,13 +1,18 @@
 """Computational engine for InaSAFE core.
 
-Provides the function calculate_impact()
+Provides the functions calculate_impact() and calculate_impacts()
 """
 
 import numpy
+import multiprocessing
 
 from safe.storage.projection import Projection
 from safe.storage.projection import DEFAULT_PROJECTION
+from safe.storage.core import read_layer, write_binary_layer
+from safe.storage.vector import convert_polygons_to_centroids
 from safe.impact_functions.core import extract_layers
+from safe.engine.tiling import is_tiled, run_tiles
+from safe.engine.interpolation import INTERPOLATION_CACHE
 from safe.common.utilities import unique_filename, verify
 from utilities import REQUIRED_KEYWORDS
 from datetime import datetime
@@ -20,7 +25,13 @@ import logging
 LOGGER = logging.getLogger('InaSAFE')
 
 
-def calculate_impact(layers, impact_fcn):
+# Ways of writing impact layers in calculate_impact
+WRITE_MODES = ['immediate', 'deferred', 'background']
+
+
+def calculate_impact(layers, impact_fcn, export=False,
+                     write_mode='immediate', processes=None,
+                     use_cache=False):
     """Calculate impact levels as a function of list of input layers
 
     Input
@@ -28,13 +39,38 @@ def calculate_impact(layers, impact_fcn):
 
         impact_fcn: Function of the form f(layers)
 
+        export: If True, the impact layer is written as GeoTIFF or
+                shapefile (e.g. for loading into QGIS). Otherwise it is
+                written in the binary format of write_binary_layer which
+                is faster and keeps attribute names in full.
+
+        write_mode: When to write the impact layer to file. Either
+                'immediate' (default) to write it before returning,
+                'deferred' to keep it in memory until its filename is
+                asked for with get_filename or 'background' to have it
+                written by a background thread while the caller carries on.
+                See Layer.defer_write.
+
+        processes: Number of worker processes for impact functions that
+                can be run tile by tile (see safe.engine.tiling). Other
+                impact functions, and all of them if processes is None
+                or 1 (default), are run in this process.
+
+        use_cache: If True, hazard values assigned to the exposure layer
+                by the impact function are kept in INTERPOLATION_CACHE
+                and reused when the same layers are analysed again, e.g.
+                with other parameters. See
+                assign_hazard_values_to_exposure_data. Not used for
+                impact functions run tile by tile. Default is False.
+
     Output
-        filename of resulting impact layer (GML). Comment is embedded as
-        metadata. Filename is generated from input data and date.
+        Impact layer. Its filename is that of the file written and
+        comments are embedded as keywords.
 
     Note
         The admissible file types are tif and asc/prj for raster and
-        gml or shp for vector data
+        gml or shp for vector data. Use read_layer to read the impact
+        layer file in either format and export_layer to export it later.
 
     Assumptions
         1. All layers are in WGS84 geographic coordinates
@@ -45,8 +81,165 @@ def calculate_impact(layers, impact_fcn):
         'calculate_impact called with:\nLayers: %s\nFunction:%s' % (
             layers, impact_fcn))
     # Input checks
+    check_write_mode(write_mode)
     check_data_integrity(layers)
 
+    return _run_impact_function(layers, impact_fcn, export, write_mode,
+                                processes=processes, use_cache=use_cache)
+
+
+def calculate_impacts(hazards, exposure, impact_fcn, export=False,
+                      write_mode='immediate', processes=None):
+    """Calculate impact of several hazard scenarios on one exposure layer
+
+    Input
+        hazards: List of hazard layers or filenames of hazard layers
+
+        exposure: Exposure layer or filename of exposure layer
+
+        impact_fcn: Function of the form f(layers)
+
+        export, write_mode: How to write each impact layer.
+                See calculate_impact.
+
+        processes: Number of worker processes to run the scenarios in.
+                If None or 1 (default) they are run one after the other
+                in this process. Otherwise a process pool is used and
+                write_mode must be 'immediate'. Hazards given as filenames
+                are then read by the workers.
+
+    Output
+        List of impact layers, one for each hazard in the same order.
+
+    Note
+        The exposure layer is read and checked once. Each scenario gets
+        a copy of it with its own attributes but the same geometry, so
+        arrays and indices derived from the exposure geometry (see
+        Vector.get_point_coordinates) are computed once and reused for
+        all hazards.
+    """
+
+    LOGGER.debug(
+        'calculate_impacts called with:\nHazards: %s\nExposure: %s\n'
+        'Function:%s' % (hazards, exposure, impact_fcn))
+    # Input checks
+    check_write_mode(write_mode)
+
+    msg = ('Argument processes must be None or a positive integer. '
+           'I got %s' % str(processes))
+    verify(processes is None or (isinstance(processes, int) and
+                                 processes > 0), msg)
+
+    if processes is not None and processes > 1:
+        msg = ('Impact layers computed in a process pool must be written '
+               'by the workers, so write_mode must be "immediate". '
+               'I got %s' % write_mode)
+        verify(write_mode == 'immediate', msg)
+
+    if isinstance(exposure, basestring):
+        exposure = read_layer(exposure)
+    check_data_integrity([exposure])
+
+    if processes is None or processes == 1:
+        return [_calculate_scenario_impact(hazard, exposure, impact_fcn,
+                                           export, write_mode)
+                for hazard in hazards]
+
+    # Derive arrays from exposure geometry before the workers are forked
+    # so they share them rather than each computing their own.
+    if exposure.is_vector:
+        if exposure.is_point_data:
+            exposure.get_point_index()
+        elif exposure.is_polygon_data:
+            convert_polygons_to_centroids(exposure).get_point_index()
+
+    pool = multiprocessing.Pool(processes,
+                                initializer=_initialise_scenarios,
+                                initargs=(hazards, exposure, impact_fcn,
+                                          export))
+    try:
+        impacts = pool.map(_calculate_scenario, range(len(hazards)))
+    finally:
+        pool.close()
+        pool.join()
+
+    return impacts
+
+
+# Arguments of calculate_impacts in worker processes. They are inherited
+# when the workers are forked, so layers need not be picklable.
+_scenarios = {}
+
+
+def _initialise_scenarios(hazards, exposure, impact_fcn, export):
+    """Store arguments of calculate_impacts in worker process
+    """
+
+    # Don't share GDAL file handles with the parent process
+    for layer in list(hazards) + [exposure]:
+        if not isinstance(layer, basestring) and layer.is_raster:
+            layer.reopen()
+
+    _scenarios['hazards'] = hazards
+    _scenarios['exposure'] = exposure
+    _scenarios['impact_fcn'] = impact_fcn
+    _scenarios['export'] = export
+
+
+def _calculate_scenario(i):
+    """Calculate impact of hazard number i in worker process
+    """
+
+    return _calculate_scenario_impact(_scenarios['hazards'][i],
+                                      _scenarios['exposure'],
+                                      _scenarios['impact_fcn'],
+                                      _scenarios['export'],
+                                      'immediate')
+
+
+def _calculate_scenario_impact(hazard, exposure, impact_fcn, export,
+                               write_mode):
+    """Calculate impact of one hazard on exposure already checked
+
+    Input
+        hazard: Hazard layer or filename
+        exposure: Exposure layer checked by check_data_integrity
+        impact_fcn, export, write_mode: See calculate_impact
+
+    Output
+        Impact layer
+    """
+
+    if isinstance(hazard, basestring):
+        hazard = read_layer(hazard)
+
+    # Impact functions may add to the attributes of the exposure layer,
+    # so give them a copy which shares everything else with it.
+    if exposure.is_vector:
+        exposure = exposure.copy(share_geometry=True)
+
+    layers = [hazard, exposure]
+    check_data_integrity(layers, checked_layers=[exposure])
+
+    return _run_impact_function(layers, impact_fcn, export, write_mode)
+
+
+def check_write_mode(write_mode):
+    """Check that write mode is one of WRITE_MODES
+    """
+
+    msg = ('Argument write_mode must be one of %s. I got %s'
+           % (WRITE_MODES, write_mode))
+    verify(write_mode in WRITE_MODES, msg)
+
+
+def _run_impact_function(layers, impact_fcn, export, write_mode,
+                         processes=None, use_cache=False):
+    """Run impact function on checked layers and write result
+
+    See calculate_impact for arguments.
+    """
+
     # Get an instance of the passed impact_fcn
     impact_function = impact_fcn()
 
@@ -54,7 +247,17 @@ def calculate_impact(layers, impact_fcn):
     start_time = datetime.now()
 
     # Pass input layers to plugin
-    F = impact_function.run(layers)
+    if processes is not None and processes > 1 and is_tiled(impact_function):
+        # Tiles are interpolated by worker processes whose caches are
+        # discarded with them, so use_cache does not apply
+        F = run_tiles(impact_function, layers, processes=processes)
+    else:
+        cache_enabled = INTERPOLATION_CACHE.enabled
+        INTERPOLATION_CACHE.enabled = use_cache
+        try:
+            F = impact_function.run(layers)
+        finally:
+            INTERPOLATION_CACHE.enabled = cache_enabled
 
     # End time
     end_time = datetime.now()
@@ -103,18 +306,6 @@ def calculate_impact(layers, impact_fcn):
     msg = 'Impact function %s returned None' % str(impact_function)
     verify(F is not None, msg)
 
-    # Write result and return filename
-    if F.is_raster:
-        extension = '.tif'
-        # use default style for raster
-    else:
-        extension = '.shp'
-        # use default style for vector
-
-    output_filename = unique_filename(suffix=extension)
-    F.filename = output_filename
-    F.write_to_file(output_filename)
-
     # Establish default name (layer1 X layer1 x impact_function)
     if not F.get_name():
         default_name = ''
@@ -129,6 +320,26 @@ def calculate_impact(layers, impact_fcn):
 
         F.set_name(default_name)
 
+    # Write result
+    if export:
+        # Use default style for raster or vector
+        if F.is_raster:
+            extension = '.tif'
+        else:
+            extension = '.shp'
+        write = F.write_to_file
+    else:
+        extension = '.npz'
+        write = lambda filename: write_binary_layer(F, filename)
+
+    output_filename = unique_filename(suffix=extension)
+    if write_mode == 'immediate':
+        F.filename = output_filename
+        write(output_filename)
+    else:
+        F.defer_write(output_filename, write,
+                      background=(write_mode == 'background'))
+
     # FIXME (Ole): If we need to save style as defined by the impact_function
     #              this is the place
 
@@ -136,12 +347,18 @@ def calculate_impact(layers, impact_fcn):
     return F
 
 
-def check_data_integrity(layer_objects):
+def check_data_integrity(layer_objects, checked_layers=None):
     """Check list of layer objects
 
     Input
         layer_objects: List of InaSAFE layer instances
 
+        checked_layers: Optional list of layers in layer_objects which have
+                        already been checked, e.g. an exposure layer used
+                        with several hazards. Their projections and grids
+                        are compared with those of the other layers but
+                        their keywords and features are not checked again.
+
     Output
         Nothing
 
@@ -167,19 +384,24 @@ def check_data_integrity(layer_objects):
     reference_projection = Projection(DEFAULT_PROJECTION)
     geotransform = None
 
+    if checked_layers is None:
+        checked_layers = []
+    checked = set([id(layer) for layer in checked_layers])
+
     for layer in layer_objects:
 
         # Check that critical keywords exist and are non empty
-        keywords = layer.get_keywords()
-        for kw in REQUIRED_KEYWORDS:
-            msg = ('Layer %s did not have required keyword "%s". '
-                   '%s' % (layer.name, kw, instructions))
-            verify(kw in keywords, msg)
-
-            val = keywords[kw]
-            msg = ('No value found for keyword "%s" in layer %s. '
-                   '%s' % (kw, layer.name, instructions))
-            verify(val, msg)
+        if id(layer) not in checked:
+            keywords = layer.get_keywords()
+            for kw in REQUIRED_KEYWORDS:
+                msg = ('Layer %s did not have required keyword "%s". '
+                       '%s' % (layer.name, kw, instructions))
+                verify(kw in keywords, msg)
+
+                val = keywords[kw]
+                msg = ('No value found for keyword "%s" in layer %s. '
+                       '%s' % (kw, layer.name, instructions))
+                verify(val, msg)
 
         # Ensure that projection is consistent across all layers
         if reference_projection is None:
@@ -212,7 +434,7 @@ def check_data_integrity(layer_objects):
         # FIXME (Ole): Not good as nasty error is raised in cases where
         # there are no buildings in the hazard area. Need to be more graceful
         # See e.g. shakemap dated 20120227190230
-        if layer.is_vector:
+        if layer.is_vector and id(layer) not in checked:
             msg = ('There are no vector data features. '
                    'Perhaps zoom out or pan to the study area '
                    'and try again')
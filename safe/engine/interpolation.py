@@ -4,16 +4,19 @@ Provides interpolation functionality to assign values from one layer instance
 to another irrespective of layer types.
 """
 
+import os
 import numpy
+import hashlib
 
+from third_party.odict import OrderedDict
 from safe.common.interpolation2d import interpolate_raster
 from safe.common.utilities import verify
 from safe.common.utilities import ugettext as tr
-from safe.common.numerics import ensure_numeric
 from safe.common.geodesy import Point
 from safe.common.exceptions import InaSAFEError, BoundsError
-from safe.common.polygon import (inside_polygon,
-                                 clip_lines_by_polygons, clip_grid_by_polygons)
+from safe.common.polygon import (classify_points_by_polygons,
+                                 clip_lines_by_polygons, clip_grid_by_polygons,
+                                 rasterise_polygons)
 
 from safe.storage.vector import Vector, convert_polygons_to_centroids
 from safe.storage.utilities import geometrytype2string
@@ -21,10 +24,217 @@ from safe.storage.utilities import DEFAULT_ATTRIBUTE
 from safe.storage.geometry import Polygon
 
 
+class InterpolationCache:
+    """Least recently used results of assign_hazard_values_to_exposure_data
+
+    Results are keyed by hashes of the contents of the hazard and
+    exposure layers (see layer_hash) so they are found again when the
+    same layers are read again, e.g. to rerun an impact function with
+    different parameters. Results are kept in memory only.
+    """
+
+    def __init__(self, max_entries=4, enabled=False):
+        """Create empty cache
+
+        Args:
+            * max_entries: Number of results to keep. The least recently
+                  used result is dropped when more are added.
+            * enabled: Whether assign_hazard_values_to_exposure_data uses
+                  this cache when its argument use_cache is None.
+                  See calculate_impact.
+        """
+
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Get cached result
+
+        Args:
+            * key: Key as returned by interpolation_key
+
+        Returns:
+            * Copy of cached layer or None if key was not found
+        """
+
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        # Move to the end as most recently used
+        result = self.entries.pop(key)
+        self.entries[key] = result
+        return copy_result(result)
+
+    def put(self, key, result):
+        """Store result
+
+        Args:
+            * key: Key as returned by interpolation_key
+            * result: Interpolated layer. A copy is stored so it is not
+                  affected by changes to result.
+        """
+
+        if self.max_entries < 1:
+            return
+
+        if key in self.entries:
+            self.entries.pop(key)
+        self.entries[key] = copy_result(result)
+        self._drop_entries()
+
+    def set_max_entries(self, max_entries):
+        """Change number of results kept
+
+        Args:
+            * max_entries: Number of results to keep. Use 0 to disable
+                  caching.
+        """
+
+        self.max_entries = max_entries
+        self._drop_entries()
+
+    def _drop_entries(self):
+        """Drop least recently used results so at most max_entries are kept
+        """
+
+        while len(self.entries) > max(self.max_entries, 0):
+            self.entries.popitem(0)
+
+    def clear(self):
+        """Remove all results and reset statistics
+        """
+
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get_statistics(self):
+        """Get cache statistics
+
+        Returns:
+            * Dictionary with the number of hits and misses, the number of
+              results stored and the maximal number of results
+        """
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries}
+
+
+# Cache used by assign_hazard_values_to_exposure_data
+INTERPOLATION_CACHE = InterpolationCache()
+
+
+def copy_result(layer):
+    """Copy interpolated layer so its attributes can be changed
+
+    Geometry is shared with layer. See Vector.copy.
+    """
+
+    if layer.is_vector:
+        return layer.copy(share_geometry=True)
+    else:
+        return layer
+
+
+def interpolation_key(hazard, exposure, layer_name, attribute_name, mode):
+    """Key of result of assign_hazard_values_to_exposure_data
+
+    Args:
+        * hazard, exposure: Hazard and exposure layers
+        * layer_name, attribute_name: Names as returned by check_inputs
+        * mode: Interpolation mode
+
+    Returns:
+        * Tuple of layer hashes, names and mode
+    """
+
+    return (layer_hash(hazard), layer_hash(exposure),
+            layer_name, attribute_name, mode)
+
+
+def layer_hash(layer):
+    """Hash of the contents of a layer
+
+    Args:
+        * layer: Raster or vector layer
+
+    Returns:
+        * Hexadecimal SHA1 digest of data, geometry, projection, name
+          and keywords of layer. Layers with the same contents have the
+          same hash regardless of where they come from.
+
+    Note:
+        Layers read from file are not read again to be hashed. Their file
+        name, size and modification time stand in for their data, along
+        with the attribute names and number of features of vector layers
+        (and copies of them). Attribute values of such vector layers must
+        therefore not be changed in place while they are used with
+        INTERPOLATION_CACHE. Rasters held in memory are hashed one window
+        at a time and other vector layers are hashed in full.
+    """
+
+    h = hashlib.sha1()
+    h.update(str(layer.get_name()))
+    h.update(str(sorted(layer.get_keywords().items())))
+    h.update(layer.get_projection())
+
+    if layer.is_raster:
+        h.update(str(layer.get_geotransform()))
+        if getattr(layer, 'band', None) is not None:
+            status = os.stat(layer.filename)
+            h.update(str((os.path.abspath(layer.filename),
+                          status.st_size, status.st_mtime)))
+        else:
+            # Windows of data held in memory are not cached by get_data
+            for window in layer.get_windows():
+                h.update(numpy.ascontiguousarray(
+                    layer.get_data(nan=True, window=window)))
+    elif layer.file_stamp is not None:
+        h.update(str(layer.file_stamp))
+        h.update(str(sorted(layer.get_attribute_names())))
+        h.update(str(len(layer)))
+    else:
+        h.update(str(layer.geometry_type))
+        if layer.is_point_data:
+            h.update(numpy.ascontiguousarray(layer.get_point_coordinates()))
+        else:
+            geometry = layer.get_packed_geometry()
+            for A in [geometry.coordinates, geometry.ring_offsets,
+                      geometry.part_offsets]:
+                h.update(numpy.ascontiguousarray(A))
+
+        if layer.is_columnar:
+            for name in sorted(layer.get_attribute_names()):
+                values = layer.get_column(name)
+                h.update(name)
+                if values.dtype == object:
+                    h.update(repr(values.tolist()))
+                else:
+                    h.update(str(values.dtype))
+                    h.update(numpy.ascontiguousarray(values))
+        else:
+            h.update(repr([sorted(row.items())
+                           for row in layer.get_data()]))
+
+    return h.hexdigest()
+
+
 def assign_hazard_values_to_exposure_data(hazard, exposure,
                                           layer_name=None,
                                           attribute_name=None,
-                                          mode='linear'):
+                                          mode='linear',
+                                          use_cache=None):
     """Assign hazard values to exposure data
 
     This is the high level wrapper around interpolation functions for different
@@ -57,6 +267,15 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
              piecewise constant interpolation. This parameter is passed
              all the way down to the underlying interpolation function
              interpolate2d (module common/interpolation2d.py)
+        * use_cache:
+             If True the result is looked up in and added to
+             INTERPOLATION_CACHE, so interpolating between layers with
+             the same contents again is skipped. The exposure layer is
+             then left unchanged. Layers are hashed to look them up (see
+             layer_hash), which costs about as much as interpolating
+             large vector layers held in memory but little for layers
+             read from file. If None (default) the cache is used if it
+             is enabled, e.g. by calculate_impact.
 
     Returns:
         Layer representing the exposure data with hazard levels assigned.
@@ -114,6 +333,26 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
 
     layer_name, attribute_name = check_inputs(hazard, exposure,
                                               layer_name, attribute_name)
+
+    if use_cache is None:
+        use_cache = INTERPOLATION_CACHE.enabled
+
+    # Aligned rasters are not interpolated so there is nothing to cache
+    if use_cache and not (hazard.is_raster and exposure.is_raster):
+        key = interpolation_key(hazard, exposure,
+                                layer_name, attribute_name, mode)
+        result = INTERPOLATION_CACHE.get(key)
+        if result is None:
+            # Interpolate into a copy so the exposure layer and with it
+            # the key stay the same for the next run
+            if exposure.is_vector:
+                exposure = exposure.copy(share_geometry=True)
+            result = assign_hazard_values_to_exposure_data(
+                hazard, exposure, layer_name=layer_name,
+                attribute_name=attribute_name, mode=mode, use_cache=False)
+            INTERPOLATION_CACHE.put(key, result)
+        return result
+
     # Raster-Vector
     if hazard.is_raster and exposure.is_vector:
         return interpolate_raster_vector(hazard, exposure,
@@ -362,7 +601,8 @@ def interpolate_polygon_raster(source, target,
 def interpolate_raster_vector_points(source, target,
                                      layer_name=None,
                                      attribute_name=None,
-                                     mode='linear'):
+                                     mode='linear',
+                                     block_size=None):
     """Interpolate from raster layer to point data
 
     Args:
@@ -374,11 +614,25 @@ def interpolate_raster_vector_points(source, target,
               If None (default) the name of layer source is used
         * mode: 'linear' or 'constant' - determines whether interpolation
               from grid to points should be bilinear or piecewise constant
+        * block_size: Optional approximate number of grid points read at
+              a time. See Raster.get_windows.
 
     Output
         I: Vector data set; points located as target with values
            interpolated from source
 
+    Note:
+        The raster is read one window of rows at a time and only points
+        whose neighbouring grid rows are in the window are interpolated
+        from it (see split_points_by_windows). Peak memory is therefore
+        bounded by block_size and the number of points rather than the
+        size of the raster. Results are the same as interpolating from
+        the entire grid up to rounding.
+
+        Interpolated values are written into one array. For column wise
+        targets this becomes a new column of the returned layer, which
+        shares the other columns with target. Otherwise the values are
+        added to the attribute dictionaries of target.
     """
 
     msg = ('There are no data points to interpolate to. Perhaps zoom out '
@@ -390,42 +644,102 @@ def interpolate_raster_vector_points(source, target,
     verify(target.is_vector)
     verify(target.is_point_data)
 
-    # Get raster data and corresponding x and y axes
-    A = source.get_data(nan=True)
+    # Get raster axes. Latitudes go from south to north.
     longitudes, latitudes = source.get_geometry()
-    verify(len(longitudes) == A.shape[1])
-    verify(len(latitudes) == A.shape[0])
+    verify(len(longitudes) == source.columns)
+    verify(len(latitudes) == source.rows)
 
     # Get vector point geometry as Nx2 array
-    coordinates = numpy.array(target.get_geometry(),
-                              dtype='d',
-                              copy=False)
-    # Get original attributes
-    attributes = target.get_data()
-
-    # Create new attribute and interpolate
-    try:
-        values = interpolate_raster(longitudes, latitudes, A,
-                                    coordinates, mode=mode)
-    except (BoundsError, InaSAFEError), e:
-        msg = (tr('Could not interpolate from raster layer %(raster)s to '
-                 'vector layer %(vector)s. Error message: %(error)s')
-               % {'raster': source.get_name(),
-                  'vector': target.get_name(),
-                  'error': str(e)})
-        raise InaSAFEError(msg)
+    coordinates = target.get_point_coordinates()
+
+    # Interpolate from each window of the raster to the points it covers
+    values = numpy.zeros(len(coordinates))
+    windows = source.get_windows(block_size=block_size)
+    indices = split_points_by_windows(latitudes, coordinates, windows)
+    for (_, yoff, xsize, ysize), idx in zip(windows, indices):
+        if len(idx) == 0:
+            continue
+
+        # Include the row above the window as upper neighbour of its
+        # first row
+        top = max(yoff - 1, 0)
+        bottom = yoff + ysize
+        A = source.get_data(nan=True,
+                            window=(0, top, xsize, bottom - top))
+        y = latitudes[source.rows - bottom:source.rows - top]
+
+        try:
+            values[idx] = interpolate_raster(longitudes, y, A,
+                                             coordinates[idx], mode=mode)
+        except (BoundsError, InaSAFEError), e:
+            msg = (tr('Could not interpolate from raster layer %(raster)s '
+                      'to vector layer %(vector)s. Error message: '
+                      '%(error)s')
+                   % {'raster': source.get_name(),
+                      'vector': target.get_name(),
+                      'error': str(e)})
+            raise InaSAFEError(msg)
 
     # Add interpolated attribute to existing attributes and return
-    N = len(target)
-    for i in range(N):
-        attributes[i][attribute_name] = values[i]
+    if target.is_columnar:
+        attributes = dict(target.data)
+        attributes[attribute_name] = values
+    else:
+        attributes = target.get_data()
+        for i, value in enumerate(values.tolist()):
+            attributes[i][attribute_name] = value
+
+    if target.is_packed:
+        geometry = target.get_packed_geometry()
+    else:
+        geometry = coordinates
 
     return Vector(data=attributes,
                   projection=target.get_projection(),
-                  geometry=coordinates,
+                  geometry=geometry,
+                  geometry_type='point',
                   name=layer_name)
 
 
+def split_points_by_windows(latitudes, points, windows):
+    """Find points to interpolate from each window of raster rows
+
+    Args:
+        * latitudes: Latitudes of raster rows from south to north as
+              returned by Raster.get_geometry
+        * points: Nx2 array of point coordinates (lon, lat)
+        * windows: Pixel windows (xoff, yoff, xsize, ysize) of whole rows
+              in row order covering the raster (see Raster.get_windows)
+
+    Returns:
+        * List of arrays of point indices, one array for each window
+
+    Note:
+        Each point is interpolated from the two rows enclosing it
+        (see interpolate2d). It goes with the window containing the
+        lower of these rows, whose upper neighbour is then either in the
+        window too or the row just above it. Points outside the grid go
+        with the first or last window.
+    """
+
+    rows = len(latitudes)
+
+    # Index of lower enclosing row counting rows from the top like
+    # windows. Same search as in interpolate2d so neighbours agree.
+    lower = rows - numpy.searchsorted(latitudes, points[:, 1], side='left')
+    lower = numpy.clip(lower, 0, rows - 1)
+
+    starts = numpy.array([yoff for _, yoff, _, _ in windows])
+    window = numpy.searchsorted(starts, lower, side='right') - 1
+
+    # Sort point indices by window
+    order = numpy.argsort(window, kind='mergesort')
+    bounds = numpy.searchsorted(window[order],
+                                numpy.arange(len(windows) + 1))
+
+    return [order[bounds[k]:bounds[k + 1]] for k in range(len(windows))]
+
+
 def interpolate_polygon_points(source, target,
                                layer_name=None):
     """Interpolate from polygon vector layer to point vector data
@@ -462,7 +776,7 @@ def interpolate_polygon_points(source, target,
     #----------------
 
     # Extract point features
-    points = ensure_numeric(target.get_geometry())
+    points = target.get_point_coordinates()
     attributes = target.get_data()
     original_geometry = target.get_geometry()  # Geometry for returned data
 
@@ -481,23 +795,23 @@ def interpolate_polygon_points(source, target,
         for key in attribute_names:
             a[key] = None
 
-    # Traverse polygons and assign attributes to points that fall inside
-    for i, polygon in enumerate(geom):
-        # Carry all attributes across from source
-        poly_attr = data[i]
-
-        # Assign default attribute to indicate points inside
+    # Assign default attribute to indicate points inside
+    for poly_attr in data:
         poly_attr[DEFAULT_ATTRIBUTE] = True
 
-        # Clip data points by polygons and add polygon attributes
-        indices = inside_polygon(points, polygon.outer_ring,
-                                 holes=polygon.inner_rings)
+    # Find polygon containing each point. Polygons are visited in reverse
+    # order so that the last of any overlapping polygons is used.
+    N = len(geom)
+    polygon_ids = classify_points_by_polygons(points, geom[::-1],
+                                              index=target.get_point_index())
+    inside = polygon_ids >= 0
+    polygon_ids[inside] = N - 1 - polygon_ids[inside]
 
-        for k in indices:
-            for key in poly_attr:
-                # Assign attributes from polygon to points
-                attributes[k][key] = poly_attr[key]
-            attributes[k]['polygon_id'] = i  # Store id for associated polygon
+    # Assign attributes from polygon to points that fall inside
+    for k in numpy.where(inside)[0]:
+        i = int(polygon_ids[k])
+        attributes[k].update(data[i])
+        attributes[k]['polygon_id'] = i  # Store id for associated polygon
 
     # Create new Vector instance and return
     V = Vector(data=attributes,
@@ -522,7 +836,8 @@ def interpolate_polygon_lines(source, target,
            Attributes are combined from polygon they fall into and
            line that was clipped.
 
-           Lines not in any polygon are ignored.
+           Lines not in any polygon are ignored. Parts of lines in
+           overlapping polygons are assigned to the first of them only.
     """
 
     # Extract line features
@@ -541,8 +856,10 @@ def interpolate_polygon_lines(source, target,
     #clipped_geometry = []
     #clipped_attributes = []
 
-    # Clip line lines to polygons
-    lines_covered = clip_lines_by_polygons(lines, polygons)
+    # Clip line lines to polygons. Each part of a line belongs to one
+    # polygon at most, so parts already inside a polygon are not clipped
+    # by the polygons after it.
+    lines_covered = clip_lines_by_polygons(lines, polygons, exclusive=True)
 
     # Create one new line data layer with joined attributes
     # from polygons and lines
@@ -662,30 +979,27 @@ def tag_polygons_by_grid(polygons, grid, threshold=0, tag='affected'):
     polygon_attributes = polygons.get_data()
     polygon_geometry = polygons.get_geometry(as_geometry_objects=True)
 
-    # Separate grid points by polygon
-    res = clip_grid_by_polygons(grid.get_data(),
+    # Label grid points by polygon
+    labels = rasterise_polygons(polygon_geometry,
                                 grid.get_geotransform(),
-                                polygon_geometry)
+                                (grid.rows, grid.columns))
+
+    # Count grid values exceeding the threshold in each polygon
+    oldset = numpy.seterr(invalid='ignore')  # NaN is never exceeding
+    exceeding = labels[grid.get_data() > threshold]
+    numpy.seterr(**oldset)
+    counts = numpy.bincount(exceeding[exceeding >= 0],
+                            minlength=len(polygons))
 
     # Create new polygon layer with tag set according to grid values
     # and threshold
     new_attributes = []
-    for i, (_, values) in enumerate(res):
-        # For each polygon check if any grid value in it exceeds the threshold
-        affected = False
-        for val in values:
-            # Check each grid value in this polygon
-            if val > threshold:
-                affected = True
-
+    for i, count in enumerate(counts):
         # Existing attributes for this polygon
         attr = polygon_attributes[i].copy()
 
-        # Create tagged polygon feature
-        if affected:
-            attr[tag] = True
-        else:
-            attr[tag] = False
+        # Tag polygons with any grid value exceeding the threshold
+        attr[tag] = bool(count > 0)
 
         new_attributes.append(attr)
 
@@ -6,23 +6,28 @@ import os
 from os.path import join
 
 # Import InaSAFE modules
-from safe.engine.core import calculate_impact
+from safe.engine.core import calculate_impact, calculate_impacts
+from safe.engine.tiling import is_tiled, run_tiles, split_features
 from safe.engine.interpolation import interpolate_polygon_raster
 from safe.engine.interpolation import interpolate_raster_vector_points
+from safe.engine.interpolation import split_points_by_windows
 from safe.engine.interpolation import assign_hazard_values_to_exposure_data
 from safe.engine.interpolation import tag_polygons_by_grid
+from safe.engine.interpolation import INTERPOLATION_CACHE, layer_hash
 
 
 from safe.storage.core import read_layer
 from safe.storage.core import write_vector_data
 from safe.storage.core import write_raster_data
 from safe.storage.vector import Vector
+from safe.storage.raster import Raster
 from safe.storage.utilities import DEFAULT_ATTRIBUTE
 
 from safe.common.polygon import separate_points_by_polygon
 from safe.common.polygon import is_inside_polygon, inside_polygon
 from safe.common.polygon import clip_lines_by_polygon, clip_grid_by_polygons
 from safe.common.polygon import line_dictionary_to_geometry
+from safe.common.polygon import generate_random_points_in_bbox
 from safe.common.interpolation2d import interpolate_raster
 from safe.common.numerics import normal_cdf, lognormal_cdf, erf, ensure_numeric
 from safe.common.numerics import nanallclose
@@ -928,6 +933,30 @@ class Test_Engine(unittest.TestCase):
         assert data[2]['tag'] is True
         assert data[3]['tag'] is False
 
+    def test_tagging_polygons_by_raster_values_in_memory(self):
+        """Polygons are tagged if any grid value in them exceeds threshold
+        """
+
+        A = numpy.zeros((10, 10))
+        A[2, 3] = 5
+        A[9, 0] = 3
+        A[7, 7] = numpy.nan
+        G = Raster(data=A, geotransform=(0.0, 1.0, 0, 10.0, 0, -1.0),
+                   name='grid')
+
+        squares = [numpy.array([[2, 6], [5, 6], [5, 9], [2, 9]]),
+                   numpy.array([[6, 1], [9, 1], [9, 4], [6, 4]]),
+                   numpy.array([[0.5, 0.5], [0.5, 0.5], [0.5, 0.5]])]
+        P = Vector(data=[{'id': i} for i in range(3)], geometry=squares,
+                   name='squares')
+
+        R = tag_polygons_by_grid(P, G, threshold=1, tag='tag')
+        assert R.get_data('tag') == [True, False, True]
+        assert R.get_data('id') == [0, 1, 2]
+
+        R = tag_polygons_by_grid(P, G, threshold=5, tag='tag')
+        assert R.get_data('tag') == [False, False, False]
+
     def test_polygon_hazard_with_holes_and_raster_exposure(self):
         """Rasters can be clipped by polygons (with holes)
 
@@ -1019,6 +1048,62 @@ class Test_Engine(unittest.TestCase):
 
     test_flood_building_impact_function.slow = True
 
+    def test_calculate_impacts(self):
+        """Impacts of several hazards on one exposure layer can be calculated
+        """
+
+        hazard_filenames = [join(HAZDATA, x) for x in
+                            ['Flood_Current_Depth_Jakarta_geographic.asc',
+                             'Flood_Design_Depth_Jakarta_geographic.asc']]
+        exposure_filename = join(TESTDATA,
+                                 'OSM_building_polygons_20110905.shp')
+
+        IF = get_plugin('FloodBuildingImpactFunction')
+
+        # Reference results calculated one at a time
+        reference = []
+        for filename in hazard_filenames:
+            H = read_layer(filename)
+            E = read_layer(exposure_filename)
+            reference.append(calculate_impact(layers=[H, E],
+                                              impact_fcn=IF))
+
+        E = read_layer(exposure_filename)
+        attributes = E.get_data(copy=True)
+        for hazards, processes in [(hazard_filenames, None),
+                                   ([read_layer(x) for x in
+                                     hazard_filenames], 1),
+                                   (hazard_filenames, 2)]:
+            impacts = calculate_impacts(hazards, E, IF,
+                                        processes=processes)
+            assert len(impacts) == len(reference)
+            for I, R in zip(impacts, reference):
+                assert len(I) == len(R)
+                assert I.get_data() == R.get_data()
+                assert nanallclose(I.get_geometry()[0], R.get_geometry()[0])
+                assert I.get_filename().endswith('.npz')
+                assert os.path.isfile(I.get_filename())
+
+            # Attributes of exposure layer are left alone
+            assert E.get_data() == attributes
+
+        # Exposure can also be given as a filename
+        impacts = calculate_impacts(hazard_filenames[:1], exposure_filename,
+                                    IF)
+        assert impacts[0].get_data() == reference[0].get_data()
+
+        # Layers written in the background can't come from a process pool
+        try:
+            calculate_impacts(hazard_filenames, E, IF, processes=2,
+                              write_mode='background')
+        except VerificationError, e:
+            assert 'immediate' in str(e)
+        else:
+            msg = 'Deferred writing in a process pool should have failed'
+            raise Exception(msg)
+
+    test_calculate_impacts.slow = True
+
     def test_data_sources_are_carried_forward(self):
         """Data sources are carried forward to impact layer
         """
@@ -1305,10 +1390,11 @@ class Test_Engine(unittest.TestCase):
 
         IF = plugin_list[0][plugin_name]
         impact_vector = calculate_impact(layers=[H, E],
-                                         impact_fcn=IF)
+                                         impact_fcn=IF,
+                                         export=True)
         impact_filename = impact_vector.get_filename()
         # Read calculated result
-        # Read to have truncation
+        # Read exported shapefile to have truncation
         my_impact_vector = read_layer(impact_filename)
         icoordinates = my_impact_vector.get_geometry()
         iattributes = my_impact_vector.get_data()
@@ -2734,6 +2820,249 @@ class Test_Engine(unittest.TestCase):
 
     test_layer_integrity_raises_exception.slow = True
 
+    def test_tiled_impact_functions(self):
+        """Impact functions run tile by tile give the same results
+        """
+
+        H = read_layer(join(HAZDATA,
+                            'Flood_Current_Depth_Jakarta_geographic.asc'))
+        E = read_layer(join(TESTDATA, 'Population_Jakarta_geographic.asc'))
+
+        for plugin_name in ['FloodEvacuationFunction',
+                            'CategorisedHazardPopulationImpactFunction',
+                            'ITBFatalityFunction']:
+            IF = get_plugin(plugin_name)
+            assert is_tiled(IF)
+
+            reference = calculate_impact(layers=[H, E], impact_fcn=IF)
+            R = reference.get_data()
+            for processes in [1, 3]:
+                # Tiles of a few rows each
+                I = run_tiles(IF(), [H, E], processes=processes,
+                              block_size=H.columns * 7)
+                assert nanallclose(I.get_data(), R)
+                assert (I.get_impact_summary() ==
+                        reference.get_impact_summary())
+
+            I = calculate_impact(layers=[H, E], impact_fcn=IF, processes=2)
+            assert nanallclose(I.get_data(), R)
+            assert I.get_impact_summary() == reference.get_impact_summary()
+
+    def test_tiled_point_exposure(self):
+        """Point exposure is split into tiles by the hazard grid
+        """
+
+        class PointImpactFunction:
+            """Sum of hazard values at points
+            """
+
+            def run_tile(self, layers, window):
+                I = assign_hazard_values_to_exposure_data(
+                    layers[0], layers[1], attribute_name='depth')
+                return I, {'depth': numpy.nansum(I.get_data('depth'))}
+
+            def make_impact_layer(self, layers, data, counts):
+                data.keywords['total'] = counts['depth']
+                return data
+
+        A = numpy.arange(60, dtype='d').reshape((6, 10))
+        geotransform = (100.0, 1.0, 0.0, 6.0, 0.0, -1.0)
+        H = Raster(data=A, geotransform=geotransform,
+                   keywords={'category': 'hazard'})
+
+        # Points inside and just outside the grid
+        points = generate_random_points_in_bbox(
+            numpy.array([[99.5, -0.5], [110.5, 6.5]]), 200, seed=5)
+        E = Vector(data=[{'id': i} for i in range(len(points))],
+                   geometry=points, keywords={'category': 'exposure'})
+
+        reference = assign_hazard_values_to_exposure_data(
+            H, E.copy(), attribute_name='depth')
+
+        windows = H.get_windows(block_size=20)
+        indices = split_features(E, H, windows)
+        assert len(indices) == 3
+        assert sorted(numpy.concatenate(indices)) == range(len(points))
+
+        for processes in [1, 2]:
+            I = run_tiles(PointImpactFunction(), [H, E],
+                          processes=processes, block_size=20)
+            assert I.get_data('id') == range(len(points))
+            assert numpy.allclose(I.get_geometry(), E.get_geometry())
+            depth = numpy.array(I.get_data('depth'))
+            assert nanallclose(depth,
+                               numpy.array(reference.get_data('depth')))
+            assert numpy.allclose(I.keywords['total'], numpy.nansum(depth))
+
+        # Exposure attributes are left alone
+        assert E.get_data()[0] == {'id': 0}
+
+    def test_interpolation_cache_in_calculate_impact(self):
+        """Interpolation is cached for layers read again from file
+        """
+
+        plugin_name = 'Padang Earthquake Building Damage Function'
+        IF = get_plugins(plugin_name)[0][plugin_name]
+        hazard_filename = join(HAZDATA, 'Shakemap_Padang_2009.asc')
+        exposure_filename = join(TESTDATA, 'Padang_WGS84.shp')
+
+        # Vectors read from file are hashed by file and attribute names
+        E = read_layer(exposure_filename)
+        assert E.file_stamp is not None
+        assert layer_hash(E) == layer_hash(read_layer(exposure_filename))
+        assert layer_hash(E) == layer_hash(E.copy(share_geometry=True))
+
+        # Adding attributes changes the hash
+        hash_before = layer_hash(E)
+        for row in E.get_data():
+            row['extra'] = 1
+        assert layer_hash(E) != hash_before
+
+        reference = calculate_impact(layers=[read_layer(hazard_filename),
+                                             read_layer(exposure_filename)],
+                                     impact_fcn=IF)
+
+        INTERPOLATION_CACHE.clear()
+        try:
+            for i in range(2):
+                I = calculate_impact(layers=[read_layer(hazard_filename),
+                                             read_layer(exposure_filename)],
+                                     impact_fcn=IF, use_cache=True)
+                assert I.get_data() == reference.get_data()
+
+            statistics = INTERPOLATION_CACHE.get_statistics()
+            assert statistics['hits'] == 1
+            assert statistics['misses'] == 1
+
+            # The cache is left disabled
+            assert not INTERPOLATION_CACHE.enabled
+            calculate_impact(layers=[read_layer(hazard_filename),
+                                     read_layer(exposure_filename)],
+                             impact_fcn=IF)
+            assert INTERPOLATION_CACHE.get_statistics()['hits'] == 1
+        finally:
+            INTERPOLATION_CACHE.clear()
+
+    def test_interpolate_raster_vector_points_by_window(self):
+        """Points can be interpolated from one window of a raster at a time
+        """
+
+        A = numpy.arange(37 * 23, dtype='d').reshape((37, 23)) % 17
+        A[5, 7] = numpy.nan
+        A[20:22, :] = numpy.nan
+        geotransform = (100.0, 0.5, 0.0, 10.0, 0.0, -0.25)
+        H = Raster(data=A, geotransform=geotransform)
+        longitudes, latitudes = H.get_geometry()
+
+        # Random points in and around the grid and points on grid lines
+        points = generate_random_points_in_bbox(
+            numpy.array([[99.5, 0.5], [112.5, 10.5]]), 1000, seed=17)
+        points = numpy.concatenate(
+            [points, [[longitudes[i % 23], latitudes[i]] for i in range(37)]])
+
+        for mode in ['linear', 'constant']:
+            reference = interpolate_raster(longitudes, latitudes, A, points,
+                                           mode=mode)
+            for block_size in [None, 1, 50, 23 * 36]:
+                for columnar in [False, True]:
+                    if columnar:
+                        data = {'id': numpy.arange(len(points))}
+                    else:
+                        data = [{'id': i} for i in range(len(points))]
+                    E = Vector(data=data, geometry=points)
+
+                    I = interpolate_raster_vector_points(
+                        H, E, attribute_name='value', mode=mode,
+                        block_size=block_size)
+                    assert I.is_columnar == columnar
+                    assert I.get_data('id') == range(len(points))
+                    values = numpy.array(I.get_data('value'))
+                    assert nanallclose(values, reference,
+                                       rtol=1.0e-12, atol=1.0e-12)
+
+        # Each point goes with exactly one window
+        windows = H.get_windows(block_size=50)
+        indices = split_points_by_windows(latitudes, points, windows)
+        assert len(indices) == len(windows)
+        assert sorted(numpy.concatenate(indices)) == range(len(points))
+
+    def test_interpolation_cache(self):
+        """Interpolation results are cached by contents of layers
+        """
+
+        A = numpy.arange(60, dtype='d').reshape((6, 10))
+        geotransform = (100.0, 1.0, 0.0, 6.0, 0.0, -1.0)
+        H = Raster(data=A, geotransform=geotransform,
+                   keywords={'category': 'hazard'})
+        points = generate_random_points_in_bbox(
+            numpy.array([[100.5, 0.5], [109.5, 5.5]]), 50, seed=7)
+        E = Vector(data=[{'id': i} for i in range(len(points))],
+                   geometry=points, keywords={'category': 'exposure'})
+
+        reference = assign_hazard_values_to_exposure_data(
+            H, E.copy(), attribute_name='depth', use_cache=False)
+
+        INTERPOLATION_CACHE.clear()
+        for i in range(3):
+            # Layers with the same contents are found in the cache
+            I = assign_hazard_values_to_exposure_data(
+                Raster(data=A.copy(), geotransform=geotransform,
+                       keywords={'category': 'hazard'}),
+                E.copy(), attribute_name='depth',
+                use_cache=True)
+            assert I == reference
+            I.get_data()[0]['depth'] = -1
+
+        statistics = INTERPOLATION_CACHE.get_statistics()
+        assert statistics['hits'] == 2
+        assert statistics['misses'] == 1
+        assert statistics['entries'] == 1
+
+        # Changing data, attribute name or mode makes a new entry
+        B = A.copy()
+        B[2, 3] = 1000
+        H2 = Raster(data=B, geotransform=geotransform,
+                    keywords={'category': 'hazard'})
+        assert layer_hash(H2) != layer_hash(H)
+        assert layer_hash(E) == layer_hash(E.copy())
+
+        # Rasters read from file are hashed without reading their data
+        filename = unique_filename(suffix='.tif')
+        H.write_to_file(filename)
+        F = read_layer(filename)
+        assert layer_hash(F) == layer_hash(read_layer(filename))
+        assert F._data_cache == {}
+        assign_hazard_values_to_exposure_data(H2, E, attribute_name='depth',
+                                              use_cache=True)
+        assign_hazard_values_to_exposure_data(H, E, attribute_name='level',
+                                              use_cache=True)
+        assign_hazard_values_to_exposure_data(H, E, attribute_name='depth',
+                                              mode='constant',
+                                              use_cache=True)
+        statistics = INTERPOLATION_CACHE.get_statistics()
+        assert statistics['misses'] == 4
+        assert statistics['entries'] == 4
+
+        # Least recently used entries are dropped
+        INTERPOLATION_CACHE.set_max_entries(2)
+        try:
+            assert len(INTERPOLATION_CACHE) == 2
+            assign_hazard_values_to_exposure_data(H, E,
+                                                  attribute_name='depth',
+                                                  mode='constant',
+                                                  use_cache=True)
+            assert INTERPOLATION_CACHE.get_statistics()['hits'] == 3
+            assign_hazard_values_to_exposure_data(H, E,
+                                                  attribute_name='depth',
+                                                  use_cache=True)
+            assert INTERPOLATION_CACHE.get_statistics()['misses'] == 5
+        finally:
+            INTERPOLATION_CACHE.set_max_entries(4)
+            INTERPOLATION_CACHE.clear()
+
+        # Exposure attributes are left alone
+        assert E.get_data()[0] == {'id': 0}
+
     def test_padang_building_examples(self):
         """Padang building impact calculation works through the API
         """
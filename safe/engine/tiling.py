@@ -0,0 +1,331 @@
+"""**Tiled execution of impact functions.**
+
+Impact functions providing run_tile and make_impact_layer (see class
+FunctionProvider in safe.impact_functions.core) calculate the impact in
+each part of the study area independently. This module splits the study
+area into tiles, runs the impact function on them one after the other or
+in a process pool and combines the results.
+"""
+
+import numpy
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+from safe.common.utilities import verify
+from safe.storage.vector import Vector, convert_polygons_to_centroids
+
+# Number of tiles per worker process so that all workers are kept busy
+# even when some tiles take longer than others
+TILES_PER_PROCESS = 4
+
+
+def is_tiled(impact_function):
+    """Check if impact function can be run tile by tile
+
+    Args:
+        * impact_function: Impact function class or instance
+
+    Returns:
+        * True if it provides run_tile and make_impact_layer
+    """
+
+    return (hasattr(impact_function, 'run_tile') and
+            hasattr(impact_function, 'make_impact_layer'))
+
+
+def run_tiles(impact_function, layers, processes=None, block_size=None):
+    """Run impact function one tile at a time
+
+    Args:
+        * impact_function: Impact function instance providing run_tile
+              and make_impact_layer
+        * layers: List of hazard and exposure layers
+        * processes: Number of worker processes. If None or 1 (default)
+              the tiles are run one after the other in this process.
+        * block_size: Approximate number of hazard grid points per tile.
+              See Raster.get_windows. By default tiles have 2**22 grid
+              points or fewer so each process gets TILES_PER_PROCESS tiles.
+
+    Returns:
+        * Impact layer made by make_impact_layer from the combined
+          results of run_tile (see combine_tiles)
+
+    Note:
+        Tiles are windows of the hazard grid (see Raster.get_windows).
+        A raster exposure layer is aligned with the hazard grid (see
+        check_data_integrity in safe.engine.core), so run_tile reads the
+        same window from both. Vector exposure is split instead and
+        run_tile gets the exposure features in the window (see
+        split_features).
+    """
+
+    msg = ('Impact function %s can not be run tile by tile'
+           % str(impact_function))
+    verify(is_tiled(impact_function), msg)
+
+    msg = ('Argument processes must be None or a positive integer. '
+           'I got %s' % str(processes))
+    verify(processes is None or (isinstance(processes, int) and
+                                 processes > 0), msg)
+    if processes is None:
+        processes = 1
+
+    # Imported here since impact functions import this module
+    from safe.impact_functions.core import (get_hazard_layer,
+                                            get_exposure_layer)
+    hazard = get_hazard_layer(layers)
+    exposure = get_exposure_layer(layers)
+
+    msg = ('Impact functions can only be run tile by tile on raster '
+           'hazard layers. I got %s' % str(hazard))
+    verify(hazard.is_raster, msg)
+
+    if block_size is None:
+        block_size = 2 ** 22
+        if processes > 1:
+            block_size = min(block_size,
+                             hazard.rows * hazard.columns //
+                             (TILES_PER_PROCESS * processes))
+    windows = hazard.get_windows(block_size=max(1, block_size))
+
+    if exposure.is_vector:
+        indices = split_features(exposure, hazard, windows)
+        grid = None
+    else:
+        indices = None
+        grid = numpy.zeros((hazard.rows, hazard.columns))
+
+    if processes == 1:
+        results = [_run_tile(impact_function, layers, exposure, windows,
+                             indices, grid, k)
+                   for k in range(len(windows))]
+    else:
+        if grid is not None:
+            # Impact grid shared with the workers, which each fill in
+            # their windows, so it is not passed back and forth
+            shared = RawArray('d', hazard.rows * hazard.columns)
+            grid = numpy.frombuffer(shared, dtype=numpy.float64)
+            grid = grid.reshape((hazard.rows, hazard.columns))
+
+        pool = multiprocessing.Pool(processes,
+                                    initializer=_initialise_tiles,
+                                    initargs=(impact_function, layers,
+                                              exposure, windows, indices,
+                                              grid))
+        try:
+            results = pool.map(_run_tile_in_worker, range(len(windows)))
+        finally:
+            pool.close()
+            pool.join()
+
+    data, counts = combine_tiles(exposure, indices, grid, results)
+    return impact_function.make_impact_layer(layers, data, counts)
+
+
+def split_features(exposure, hazard, windows):
+    """Split vector features by the windows of a grid they fall in
+
+    Args:
+        * exposure: Point or polygon vector layer
+        * hazard: Raster layer
+        * windows: Pixel windows (xoff, yoff, xsize, ysize) covering the
+              raster, e.g. from hazard.get_windows()
+
+    Returns:
+        * List of arrays of feature indices, one array for each window
+
+    Note:
+        Polygons are split by their centroids. Features outside the grid
+        go with the nearest window so every feature is in exactly one.
+    """
+
+    if exposure.is_point_data:
+        points = exposure.get_point_coordinates()
+    elif exposure.is_polygon_data:
+        points = convert_polygons_to_centroids(exposure)
+        points = points.get_point_coordinates()
+    else:
+        msg = ('Only point and polygon exposure layers can be split into '
+               'tiles. I got %s' % str(exposure))
+        verify(False, msg)
+
+    g = hazard.get_geotransform()
+    msg = ('Rotated grids can not be split into tiles. Geotransform of '
+           '%s was %s' % (hazard.get_name(), str(g)))
+    verify(g[2] == 0 and g[4] == 0, msg)
+
+    # Grid cell of each feature
+    columns = numpy.floor((points[:, 0] - g[0]) / g[1])
+    columns = numpy.clip(columns, 0, hazard.columns - 1)
+    rows = numpy.floor((points[:, 1] - g[3]) / g[5])
+    rows = numpy.clip(rows, 0, hazard.rows - 1)
+
+    indices = []
+    for xoff, yoff, xsize, ysize in windows:
+        inside = ((columns >= xoff) & (columns < xoff + xsize) &
+                  (rows >= yoff) & (rows < yoff + ysize))
+        indices.append(numpy.where(inside)[0])
+
+    return indices
+
+
+def combine_tiles(exposure, indices, grid, results):
+    """Combine results of run_tile for all tiles
+
+    Args:
+        * exposure: Exposure layer
+        * indices: Feature indices of each tile for vector exposure as
+              returned by split_features. None for raster exposure.
+        * grid: Impact grid filled in for raster exposure. None for
+              vector exposure.
+        * results: List of (data, counts) for each tile. For raster
+              exposure data is True if the tile was filled in in grid.
+
+    Returns:
+        * data: Impact grid for raster exposure or None if run_tile
+              returned no grids. For vector exposure the vector layers
+              returned by run_tile joined into one with features in the
+              order of the exposure layer.
+        * counts: Sum of the counts of all tiles (see add_counts)
+    """
+
+    counts = {}
+    for _, tile_counts in results:
+        counts = add_counts(counts, tile_counts)
+
+    if indices is None:
+        if any([data for data, _ in results]):
+            return grid, counts
+        else:
+            return None, counts
+
+    attributes = [None] * len(exposure)
+    geometry = [None] * len(exposure)
+    V = None
+    for idx, (data, _) in zip(indices, results):
+        if data is None:
+            continue
+        V = data
+
+        msg = ('Impact layer of tile must have one feature for each '
+               'exposure feature in it. I got %i features for %i'
+               % (len(V), len(idx)))
+        verify(len(V) == len(idx), msg)
+
+        if V.is_polygon_data:
+            tile_geometry = V.get_geometry(as_geometry_objects=True)
+        else:
+            tile_geometry = V.get_geometry()
+        for i, row, g in zip(idx, V.get_data(), tile_geometry):
+            attributes[i] = row
+            geometry[i] = g
+
+    if V is None:
+        return None, counts
+
+    msg = ('Impact function returned impact layers for some tiles only')
+    verify(all([g is not None for g in geometry]), msg)
+
+    data = Vector(data=attributes,
+                  geometry=geometry,
+                  geometry_type=V.geometry_type,
+                  projection=V.get_projection(),
+                  name=V.get_name(),
+                  keywords=V.get_keywords(),
+                  style_info=V.get_style_info())
+    return data, counts
+
+
+def add_counts(total, counts):
+    """Add counts of one tile to the total
+
+    Args:
+        * total: Dictionary of counts
+        * counts: Dictionary of counts with the same keys as total.
+              Either may be empty, e.g. for tiles without exposure.
+
+    Returns:
+        * Dictionary with the sum of total and counts for each key.
+          Values can be numbers, arrays or dictionaries of those which
+          are added recursively.
+    """
+
+    if not counts:
+        return dict(total)
+    if not total:
+        return dict(counts)
+
+    msg = ('Counts of tiles must have the same keys. I got %s and %s'
+           % (total.keys(), counts.keys()))
+    verify(set(total.keys()) == set(counts.keys()), msg)
+
+    result = {}
+    for key, value in total.items():
+        if isinstance(value, dict):
+            result[key] = add_counts(value, counts[key])
+        else:
+            result[key] = value + counts[key]
+    return result
+
+
+def _run_tile(impact_function, layers, exposure, windows, indices, grid,
+              k):
+    """Run impact function on tile number k
+
+    Returns:
+        * data, counts where data is True if the impact grid was filled
+          in for the tile (raster exposure) or a vector layer
+    """
+
+    window = windows[k]
+    if indices is not None:
+        if len(indices[k]) == 0:
+            # No exposure features in tile
+            return None, {}
+
+        tile_exposure = exposure.subset(indices[k])
+        layers = [tile_exposure if layer is exposure else layer
+                  for layer in layers]
+
+    data, counts = impact_function.run_tile(layers, window)
+    if indices is None:
+        if data is None:
+            return False, counts
+
+        xoff, yoff, xsize, ysize = window
+        grid[yoff:yoff + ysize, xoff:xoff + xsize] = data
+        return True, counts
+
+    return data, counts
+
+
+# Arguments of run_tiles in worker processes. They are inherited when the
+# workers are forked, so layers need not be picklable.
+_tiles = {}
+
+
+def _initialise_tiles(impact_function, layers, exposure, windows, indices,
+                      grid):
+    """Store arguments of run_tiles in worker process
+    """
+
+    # Don't share GDAL file handles with the parent process
+    for layer in layers:
+        if layer.is_raster:
+            layer.reopen()
+
+    _tiles['impact_function'] = impact_function
+    _tiles['layers'] = layers
+    _tiles['exposure'] = exposure
+    _tiles['windows'] = windows
+    _tiles['indices'] = indices
+    _tiles['grid'] = grid
+
+
+def _run_tile_in_worker(k):
+    """Run impact function on tile number k in worker process
+    """
+
+    return _run_tile(_tiles['impact_function'], _tiles['layers'],
+                     _tiles['exposure'], _tiles['windows'], _tiles['indices'],
+                     _tiles['grid'], k)
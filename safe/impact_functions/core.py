@@ -9,7 +9,7 @@ using it.
 import numpy
 import logging
 import keyword as python_keywords
-from safe.common.polygon import inside_polygon
+from safe.common.polygon import find_points_in_polygons
 from safe.common.utilities import ugettext as tr
 from safe.common.tables import Table, TableCell, TableRow
 from utilities import pretty_string, remove_double_spaces
@@ -48,6 +48,29 @@ class FunctionProvider:
     layers           A list of layers
     result           A list of layers
     ===============  =========================
+
+    Plugins on raster hazard layers whose impact in each part of the
+    study area can be calculated independently may in addition provide
+
+    run_tile(layers, window)
+    make_impact_layer(layers, data, counts)
+
+    ===============  =========================
+    window           Pixel window (xoff, yoff, xsize, ysize) of the
+                     hazard grid. Raster exposure layers are read in the
+                     same window whereas vector exposure layers only
+                     contain the features in it.
+    result           Tuple (data, counts) of impact data for the tile
+                     (grid of window shape for raster exposure, vector
+                     layer with one feature per exposure feature for
+                     vector exposure or None) and a dictionary of numbers
+                     or arrays which add up over tiles.
+    data, counts     Impact data and counts of all tiles combined
+    ===============  =========================
+
+    Their run method is then simply run_tiles(self, layers) and
+    calculate_impact can run the tiles in a process pool.
+    See safe.engine.tiling.
     """
     __metaclass__ = PluginMount
 
@@ -395,6 +418,8 @@ def aggregate_point_data(data=None, boundaries=None,
         'count': Dictionary with counts of occurences of each value
                  of attribute_name
 
+        Points in overlapping boundaries or on edges shared by boundaries
+        are aggregated in each of them.
     """
 
     msg = ('Input argument "data" must be point type. I got type: %s'
@@ -413,13 +438,9 @@ def aggregate_point_data(data=None, boundaries=None,
     points = data.get_geometry()
     attributes = data.get_data()
 
+    # Find all points in each boundary
     result = []
-    #for i, polygon in enumerate(polygon_geoms):
-    for polygon in polygon_geoms:
-        indices = inside_polygon(points, polygon)
-
-        #print 'Found %i points in polygon %i' % (len(indices), i)
-
+    for indices in find_points_in_polygons(points, polygon_geoms):
         # Aggregate numbers
         if aggregation_function == 'count':
             bins = {}
@@ -5,6 +5,7 @@ from safe.impact_functions.core import (FunctionProvider,
                                         get_exposure_layer,
                                         get_question)
 from safe.storage.raster import Raster
+from safe.engine.tiling import run_tiles
 from safe.common.utilities import (ugettext as tr,
                                    get_defaults,
                                    format_int,
@@ -177,23 +178,27 @@ class ITBFatalityFunction(FunctionProvider):
 
         """
 
-        displacement_rate = self.parameters['displacement_rate']
+        return run_tiles(self, layers)
 
-        # Tolerance for transparency
-        tolerance = self.parameters['tolerance']
+    def run_tile(self, layers, window):
+        """Displaced people and fatalities in one window of the grids
+
+        Input
+          layers: List of layers as for run
+          window: Pixel window (xoff, yoff, xsize, ysize) of the grids
+
+        Return
+          Number of people displaced in each cell of window and counts
+          of total population and people exposed, displaced and killed
+          for each MMI level
+        """
+
+        displacement_rate = self.parameters['displacement_rate']
 
         # Extract input layers
         intensity = get_hazard_layer(layers)
         population = get_exposure_layer(layers)
 
-        question = get_question(intensity.get_name(),
-                                population.get_name(),
-                                self)
-
-        # Extract data grids
-        H = intensity.get_data()   # Ground Shaking
-        P = population.get_data(scaling=True)  # Population Density
-
         # Calculate population affected by each MMI level
         # FIXME (Ole): this range is 2-9. Should 10 be included?
 
@@ -202,6 +207,12 @@ class ITBFatalityFunction(FunctionProvider):
         number_of_displaced = {}
         number_of_fatalities = {}
 
+        # Extract data grids. Tiles are small enough that the full
+        # population grid and its temporaries never have to be in memory
+        H = intensity.get_data(window=window)   # Ground Shaking
+        P = population.get_data(scaling=True,
+                                window=window)  # Population Density
+
         # Calculate fatality rates for observed Intensity values (H
         # based on ITB power model
         R = numpy.zeros(H.shape)
@@ -222,7 +233,8 @@ class ITBFatalityFunction(FunctionProvider):
             try:
                 D = displacement_rate[mmi] * I
             except KeyError, e:
-                msg = 'mmi = %i, I = %s, Error msg: %s' % (mmi, str(I), str(e))
+                msg = ('mmi = %i, I = %s, Error msg: %s'
+                       % (mmi, str(I), str(e)))
                 raise InaSAFEError(msg)
 
             # Adjust displaced people to disregard fatalities.
@@ -238,12 +250,45 @@ class ITBFatalityFunction(FunctionProvider):
             number_of_displaced[mmi] = numpy.nansum(D.flat)
             number_of_fatalities[mmi] = numpy.nansum(F.flat)
 
+        return R, {'exposed': number_of_exposed,
+                   'displaced': number_of_displaced,
+                   'fatalities': number_of_fatalities,
+                   'total': numpy.nansum(P.flat)}
+
+    def make_impact_layer(self, layers, R, counts):
+        """Impact layer and report from displaced people and fatalities
+
+        Input
+          layers: List of layers as for run
+          R: Number of people displaced in each cell
+          counts: Counts from run_tile for all windows
+
+        Return
+          Impact layer as for run
+        """
+
+        # Tolerance for transparency
+        tolerance = self.parameters['tolerance']
+
+        # Extract input layers
+        intensity = get_hazard_layer(layers)
+        population = get_exposure_layer(layers)
+
+        question = get_question(intensity.get_name(),
+                                population.get_name(),
+                                self)
+
+        number_of_exposed = counts['exposed']
+        number_of_displaced = counts['displaced']
+        number_of_fatalities = counts['fatalities']
+        total = counts['total']
+
         # Set resulting layer to NaN when less than a threshold. This is to
         # achieve transparency (see issue #126).
         R[R < tolerance] = numpy.nan
 
         # Total statistics
-        total = int(round(numpy.nansum(P.flat) / 1000) * 1000)
+        total = int(round(total / 1000) * 1000)
 
         # Compute number of fatalities
         fatalities = int(round(numpy.nansum(number_of_fatalities.values())
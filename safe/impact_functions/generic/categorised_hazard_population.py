@@ -6,6 +6,7 @@ from safe.impact_functions.core import (FunctionProvider,
                                         get_function_title)
 from safe.impact_functions.styles import flood_population_style as style_info
 from safe.storage.raster import Raster
+from safe.engine.tiling import run_tiles
 from safe.common.utilities import (ugettext as tr,
                                    format_int,
                                    get_defaults,
@@ -75,6 +76,20 @@ class CategorisedHazardPopulationImpactFunction(FunctionProvider):
           Table with number of people in each category
         """
 
+        return run_tiles(self, layers)
+
+    def run_tile(self, layers, window):
+        """Population exposed to each hazard category in one window
+
+        Input
+          layers: List of layers as for run
+          window: Pixel window (xoff, yoff, xsize, ysize) of the grids
+
+        Return
+          Population in high or medium hazard area in window and counts
+          of total population and people in each category
+        """
+
         # The 3 category
         high_t = 1
         medium_t = 0.66
@@ -84,24 +99,45 @@ class CategorisedHazardPopulationImpactFunction(FunctionProvider):
         my_hazard = get_hazard_layer(layers)    # Categorised Hazard
         my_exposure = get_exposure_layer(layers)  # Population Raster
 
-        question = get_question(my_hazard.get_name(),
-                                my_exposure.get_name(),
-                                self)
-
         # Extract data as numeric arrays
-        C = my_hazard.get_data(nan=0.0)  # Category
+        C = my_hazard.get_data(nan=0.0, window=window)  # Category
 
         # Calculate impact as population exposed to each category
-        P = my_exposure.get_data(nan=0.0, scaling=True)
+        P = my_exposure.get_data(nan=0.0, scaling=True, window=window)
         H = numpy.where(C == high_t, P, 0)
         M = numpy.where(C > medium_t, P, 0)
         L = numpy.where(C < low_t, P, 0)
 
+        return M, {'total': numpy.sum(P),
+                   'high': numpy.sum(H),
+                   'medium': numpy.sum(M),
+                   'low': numpy.sum(L)}
+
+    def make_impact_layer(self, layers, M, counts):
+        """Impact layer and report from population in hazard categories
+
+        Input
+          layers: List of layers as for run
+          M: Population in high or medium hazard area
+          counts: Counts from run_tile for all windows
+
+        Return
+          Impact layer as for run
+        """
+
+        # Identify hazard and exposure layers
+        my_hazard = get_hazard_layer(layers)    # Categorised Hazard
+        my_exposure = get_exposure_layer(layers)  # Population Raster
+
+        question = get_question(my_hazard.get_name(),
+                                my_exposure.get_name(),
+                                self)
+
         # Count totals
-        total = int(numpy.sum(P))
-        high = int(numpy.sum(H))
-        medium = int(numpy.sum(M)) - int(numpy.sum(H))
-        low = int(numpy.sum(L)) - int(numpy.sum(M))
+        total = int(counts['total'])
+        high = int(counts['high'])
+        medium = int(counts['medium']) - int(counts['high'])
+        low = int(counts['low']) - int(counts['medium'])
         total_impact = high + medium + low
 
         # Don't show digits less than a 1000
@@ -11,6 +11,7 @@ from safe.common.tables import Table, TableRow
 from safe.engine.interpolation import assign_hazard_values_to_exposure_data
 from third_party.odict import OrderedDict
 
+import numpy
 import logging
 LOGGER = logging.getLogger('InaSAFE')
 
@@ -112,15 +113,19 @@ class FloodBuildingImpactFunction(FunctionProvider):
         attribute_names = I.get_attribute_names()
         attributes = I.get_data()
         N = len(I)
+
+        if mode == 'grid':
+            # Classify all buildings by their interpolated depth at once
+            depth = numpy.array(I.get_column('depth'), dtype=numpy.float64)
+            flooded = (depth >= threshold).tolist()
+
         # Calculate building impact
         count = 0
         buildings = {}
         affected_buildings = {}
         for i in range(N):
             if mode == 'grid':
-                # Get the interpolated depth
-                x = float(attributes[i]['depth'])
-                x = x >= threshold
+                x = flooded[i]
             elif mode == 'regions':
                 # Use interpolated polygon attribute
                 atts = attributes[i]
@@ -7,6 +7,7 @@ from safe.impact_functions.core import (
     get_function_title)
 from safe.impact_functions.styles import flood_population_style as style_info
 from safe.storage.raster import Raster
+from safe.engine.tiling import run_tiles
 from safe.common.utilities import (
     ugettext as tr,
     get_defaults,
@@ -92,14 +93,25 @@ class FloodEvacuationFunction(FunctionProvider):
           Table with number of people evacuated and supplies required
         """
 
+        return run_tiles(self, layers)
+
+    def run_tile(self, layers, window):
+        """Population exposed to flood levels in one window of the grids
+
+        Input
+          layers: List of layers as for run
+          window: Pixel window (xoff, yoff, xsize, ysize) of the grids
+
+        Return
+          Population exposed to flood levels exceeding the largest
+          threshold in window and counts of total population and people
+          between consecutive thresholds
+        """
+
         # Identify hazard and exposure layers
         my_hazard = get_hazard_layer(layers)  # Flood inundation [m]
         my_exposure = get_exposure_layer(layers)
 
-        question = get_question(my_hazard.get_name(),
-                                my_exposure.get_name(),
-                                self)
-
         # Determine depths above which people are regarded affected [m]
         # Use thresholds from inundation layer if specified
         thresholds = self.parameters['thresholds [m]']
@@ -108,10 +120,10 @@ class FloodEvacuationFunction(FunctionProvider):
                'Expected thresholds to be a list. Got %s' % str(thresholds))
 
         # Extract data as numeric arrays
-        D = my_hazard.get_data(nan=0.0)  # Depth
+        D = my_hazard.get_data(nan=0.0, window=window)  # Depth
 
         # Calculate impact as population exposed to depths > max threshold
-        P = my_exposure.get_data(nan=0.0, scaling=True)
+        P = my_exposure.get_data(nan=0.0, scaling=True, window=window)
 
         # Calculate impact to intermediate thresholds
         counts = []
@@ -125,18 +137,43 @@ class FloodEvacuationFunction(FunctionProvider):
                 M = numpy.where((D >= lo) * (D < hi), P, 0)
 
             # Count
-            val = int(numpy.sum(M))
+            counts.append(numpy.sum(M))
+
+        return my_impact, {'affected': numpy.array(counts),
+                           'total': numpy.sum(P)}
 
-            # Don't show digits less than a 1000
-            val = round_thousand(val)
-            counts.append(val)
+    def make_impact_layer(self, layers, my_impact, counts):
+        """Impact layer and report from population exposed to flooding
+
+        Input
+          layers: List of layers as for run
+          my_impact: Population exposed to flood levels exceeding the
+                     largest threshold
+          counts: Counts from run_tile for all windows
+
+        Return
+          Impact layer as for run
+        """
+
+        # Identify hazard and exposure layers
+        my_hazard = get_hazard_layer(layers)  # Flood inundation [m]
+        my_exposure = get_exposure_layer(layers)
+
+        question = get_question(my_hazard.get_name(),
+                                my_exposure.get_name(),
+                                self)
+
+        thresholds = self.parameters['thresholds [m]']
 
         # Count totals
-        evacuated = counts[-1]
-        total = int(numpy.sum(P))
+        total = int(counts['total'])
         # Don't show digits less than a 1000
         total = round_thousand(total)
 
+        # Don't show digits less than a 1000
+        counts = [round_thousand(int(val)) for val in counts['affected']]
+        evacuated = counts[-1]
+
         # Calculate estimated needs based on BNPB Perka 7/2008 minimum bantuan
 
         # FIXME: Refactor and share
@@ -5,27 +5,43 @@
 """
 
 import os
+import json
+import numpy
 
-from vector import Vector
+from vector import Vector, rows_to_columns
 from raster import Raster
-from safe.common.utilities import verify, VerificationError
+from geometry import PackedGeometry
+from safe.common.utilities import verify, VerificationError, unique_filename
 from safe.common.exceptions import BoundingBoxError, ReadLayerError
+from safe.common.exceptions import WriteLayerError
+
+# Version of binary layer format written by write_binary_layer
+BINARY_LAYER_VERSION = 1
 
 # FIXME (Ole): make logging work again
 import logging
 logger = logging.getLogger('inasafe')
 
 
-def read_layer(filename):
+def read_layer(filename, memmap=False):
     """Read spatial layer from file.
     This can be either raster or vector data.
+
+    If memmap is True, raster files are memory mapped where possible
+    - see class Raster for details. Their data are still returned by
+    get_data in double precision.
+
+    Files with extension .npz are read as binary layers written by
+    write_binary_layer.
     """
 
     _, ext = os.path.splitext(filename)
     if ext in ['.asc', '.tif', '.nc']:
-        return Raster(filename)
-    elif ext in ['.shp', '.sqlite']:
+        return Raster(filename, memmap=memmap)
+    elif ext in ['.shp', '.sqlite', '.gpkg']:
         return Vector(filename)
+    elif ext == '.npz':
+        return read_binary_layer(filename)
     else:
         msg = ('Could not read %s. '
                'Extension "%s" has not been implemented' % (filename, ext))
@@ -82,6 +98,212 @@ def write_vector_data(data, projection, geometry, filename, keywords=None):
     V.write_to_file(filename)
 
 
+def write_binary_layer(layer, filename):
+    """Write layer to binary file for fast reading by InaSAFE
+
+    Args:
+        * layer: Raster or Vector instance
+        * filename: Output filename with extension .npz
+
+    Note:
+        The file is a numpy .npz archive. Raster data, packed vector
+        coordinates and numerical attributes are stored as arrays.
+        Keywords, style_info, projection and other attributes are stored
+        as JSON. Unlike shapefiles, attribute names are not truncated.
+        Read the file with read_layer or read_binary_layer and use
+        export_layer to write GeoTIFF or shapefiles.
+    """
+
+    msg = ('Binary layers must have extension .npz. I got %s' % filename)
+    verify(filename.endswith('.npz'), msg)
+
+    header = {'version': BINARY_LAYER_VERSION,
+              'name': layer.get_name(),
+              'projection': layer.get_projection(),
+              'keywords': layer.get_keywords(),
+              'style_info': layer.get_style_info()}
+    arrays = {}
+
+    if layer.is_raster:
+        header['layer_type'] = 'raster'
+        header['geotransform'] = layer.get_geotransform()
+        arrays['data'] = layer.get_data()
+    elif layer.is_vector:
+        header['layer_type'] = 'vector'
+        header['geometry_type'] = layer.geometry_type
+
+        # Geometry as flat arrays
+        geometry = layer.get_packed_geometry()
+        arrays['coordinates'] = geometry.coordinates
+        arrays['ring_offsets'] = geometry.ring_offsets
+        arrays['part_offsets'] = geometry.part_offsets
+        arrays['bboxes'] = geometry.bboxes
+
+        # Numerical attributes as arrays and others as JSON
+        if layer.is_columnar:
+            columns = layer.data
+        else:
+            columns = rows_to_columns(layer.get_data())
+        header['attribute_names'] = columns.keys()
+        header['object_columns'] = {}
+        for i, name in enumerate(columns.keys()):
+            if columns[name].dtype == object:
+                header['object_columns'][name] = columns[name].tolist()
+            else:
+                arrays['column_%i' % i] = columns[name]
+    else:
+        msg = 'Layer %s is neither raster nor vector' % str(layer)
+        raise WriteLayerError(msg)
+
+    # Store header as bytes to avoid pickling
+    text = json.dumps(_to_json(header), allow_nan=True)
+    arrays['header'] = numpy.frombuffer(text, dtype=numpy.uint8)
+
+    fid = open(filename, 'wb')
+    try:
+        numpy.savez(fid, **arrays)
+    finally:
+        fid.close()
+
+
+def read_binary_layer(filename):
+    """Read layer written by write_binary_layer
+
+    Args:
+        * filename: Binary layer file with extension .npz
+
+    Returns:
+        * Raster or Vector instance. Vector layers have packed geometry
+          and column wise attributes (see class Vector).
+    """
+
+    try:
+        archive = numpy.load(filename)
+        header = _from_json(json.loads(archive['header'].tostring()))
+    except Exception, e:
+        msg = 'Could not read binary layer %s: %s' % (filename, str(e))
+        raise ReadLayerError(msg)
+
+    msg = ('Binary layer %s has version %s but only version %i is '
+           'supported' % (filename, header.get('version'),
+                          BINARY_LAYER_VERSION))
+    verify(header.get('version') == BINARY_LAYER_VERSION, msg)
+
+    if header['layer_type'] == 'raster':
+        layer = Raster(data=archive['data'],
+                       projection=header['projection'],
+                       geotransform=tuple(header['geotransform']),
+                       name=header['name'],
+                       keywords=header['keywords'],
+                       style_info=header['style_info'])
+    else:
+        geometry = PackedGeometry(archive['coordinates'],
+                                  archive['ring_offsets'],
+                                  archive['part_offsets'],
+                                  bboxes=archive['bboxes'])
+
+        data = {}
+        for i, name in enumerate(header['attribute_names']):
+            if name in header['object_columns']:
+                values = header['object_columns'][name]
+                data[name] = numpy.empty(len(values), dtype=object)
+                data[name][:] = values
+            else:
+                data[name] = archive['column_%i' % i]
+
+        layer = Vector(data=data,
+                       projection=header['projection'],
+                       geometry=geometry,
+                       geometry_type=header['geometry_type'],
+                       name=header['name'],
+                       keywords=header['keywords'],
+                       style_info=header['style_info'])
+
+    archive.close()
+    layer.filename = filename
+    return layer
+
+
+def export_layer(layer, filename=None):
+    """Write layer to GeoTIFF or shapefile e.g. for use in QGIS
+
+    Args:
+        * layer: Raster or Vector instance
+        * filename: Optional output filename. If None, a unique filename
+              with extension .tif or .shp is used.
+
+    Returns:
+        * filename: The name of the file written. This also becomes the
+              filename of the layer.
+    """
+
+    if filename is None:
+        if layer.is_raster:
+            extension = '.tif'
+        else:
+            extension = '.shp'
+        filename = unique_filename(suffix=extension)
+
+    layer.write_to_file(filename)
+    layer.filename = filename
+    return filename
+
+
+def _to_json(value):
+    """Convert value to types that can be stored as JSON
+
+    Dictionaries with keys that are not strings (e.g. fatalities per
+    MMI) are stored as lists of items and numpy types as Python types.
+    """
+
+    if isinstance(value, dict):
+        if all([isinstance(key, basestring) for key in value]):
+            return dict([(key, _to_json(x)) for key, x in value.items()])
+        else:
+            return {'__items__': [[_to_json(key), _to_json(x)]
+                                  for key, x in value.items()]}
+    elif isinstance(value, (list, tuple)):
+        return [_to_json(x) for x in value]
+    elif isinstance(value, (numpy.ndarray, numpy.generic)):
+        return value.tolist()
+    else:
+        return value
+
+
+def _from_json(value):
+    """Reverse conversion done by _to_json
+
+    JSON strings are converted to str where possible as they would be
+    when read from keywords files.
+    """
+
+    if isinstance(value, dict):
+        if value.keys() == ['__items__']:
+            return dict([(_json_key(_from_json(key)), _from_json(x))
+                         for key, x in value['__items__']])
+        else:
+            return dict([(_from_json(key), _from_json(x))
+                         for key, x in value.items()])
+    elif isinstance(value, list):
+        return [_from_json(x) for x in value]
+    elif isinstance(value, unicode):
+        try:
+            return str(value)
+        except UnicodeEncodeError:
+            return value
+    else:
+        return value
+
+
+def _json_key(key):
+    """Make dictionary key hashable as tuples are stored as lists
+    """
+
+    if isinstance(key, list):
+        return tuple([_json_key(x) for x in key])
+    return key
+
+
 def get_bounding_box(filename):
     """Get bounding box for specified raster or vector file
 
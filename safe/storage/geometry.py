@@ -1,5 +1,7 @@
 # Geometry types
 
+import numpy
+
 
 class Geometry:
     """Common class for geometries
@@ -28,3 +30,258 @@ class Polygon(Geometry):
         s = 'Polygon(%s, inner_rings=%s' % (self.outer_ring,
                                             self.inner_rings)
         return s
+
+
+class PackedGeometry(Geometry):
+    """Point, line or polygon geometries packed into flat arrays
+
+    All vertices are held in one Mx2 array of coordinates (lon, lat).
+    Rings are contiguous slices of it and features are contiguous
+    slices of rings:
+
+    * Vertices of ring r are
+      coordinates[ring_offsets[r]:ring_offsets[r + 1]]
+    * Rings of feature i are
+      part_offsets[i], ..., part_offsets[i + 1] - 1
+      The first ring of a polygon is its outer ring, the rest are holes.
+      Lines have one ring and points one ring with a single vertex.
+    * bboxes[i] is the bounding box [minx, maxx, miny, maxy] of feature i
+      (the format used by polygon_bounding_boxes in safe.common.polygon)
+
+    Indexing returns features as views into coordinates, either as
+    Nx2 arrays or, for polygons with holes, as Polygon instances.
+    This makes a packed geometry usable wherever a list of polygons
+    or lines is expected.
+    """
+
+    def __init__(self, coordinates, ring_offsets, part_offsets,
+                 bboxes=None):
+        self.coordinates = numpy.asarray(coordinates,
+                                         dtype=numpy.float64).reshape(-1, 2)
+        self.ring_offsets = numpy.asarray(ring_offsets, dtype=numpy.int64)
+        self.part_offsets = numpy.asarray(part_offsets, dtype=numpy.int64)
+
+        if bboxes is None:
+            bboxes = feature_bounding_boxes(self.coordinates,
+                                            self.ring_offsets,
+                                            self.part_offsets)
+        self.bboxes = bboxes
+
+    def __len__(self):
+        return len(self.part_offsets) - 1
+
+    def __getitem__(self, i):
+        """Get feature i as Nx2 array or Polygon if it has holes
+        """
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Feature index %i out of range' % i)
+
+        rings = self.get_rings(i)
+        if len(rings) == 1:
+            return rings[0]
+        else:
+            return Polygon(outer_ring=rings[0], inner_rings=rings[1:])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return ('PackedGeometry(%i features, %i rings, %i vertices)'
+                % (len(self), self.number_of_rings,
+                   len(self.coordinates)))
+
+    @property
+    def number_of_rings(self):
+        return len(self.ring_offsets) - 1
+
+    def get_ring(self, r):
+        """Get vertices of ring r as a view into coordinates
+        """
+        return self.coordinates[self.ring_offsets[r]:
+                                self.ring_offsets[r + 1]]
+
+    def get_rings(self, i):
+        """Get list of rings of feature i, outer ring first
+        """
+        return [self.get_ring(r) for r in range(self.part_offsets[i],
+                                                self.part_offsets[i + 1])]
+
+    def get_outer_rings(self):
+        """Get list of first ring of all features as views
+        """
+        return [self.get_ring(r) for r in self.part_offsets[:-1]]
+
+    def get_polygons(self):
+        """Get list of Polygon instances with rings as views
+        """
+        polygons = []
+        for i in range(len(self)):
+            rings = self.get_rings(i)
+            polygons.append(Polygon(outer_ring=rings[0],
+                                    inner_rings=rings[1:]))
+        return polygons
+
+    def get_points(self):
+        """Get Nx2 array of the first vertex of each feature
+
+        For point geometries this is a view of all coordinates.
+        """
+        first_vertices = self.ring_offsets[self.part_offsets[:-1]]
+        if len(first_vertices) == len(self.coordinates):
+            return self.coordinates
+        return self.coordinates[first_vertices]
+
+    def copy(self):
+        """Return deep copy of packed geometry
+        """
+        return PackedGeometry(self.coordinates.copy(),
+                              self.ring_offsets.copy(),
+                              self.part_offsets.copy(),
+                              bboxes=self.bboxes.copy())
+
+    def select(self, indices):
+        """Return new packed geometry with selected features
+
+        Args:
+            * indices: Sequence of feature indices (in the order wanted)
+
+        Returns:
+            * PackedGeometry with copies of the selected features
+        """
+
+        indices = numpy.asarray(indices, dtype=numpy.int64).reshape(-1)
+        rings = _expand_ranges(self.part_offsets[indices],
+                               self.part_offsets[indices + 1])
+        vertices = _expand_ranges(self.ring_offsets[rings],
+                                  self.ring_offsets[rings + 1])
+
+        ring_lengths = (self.ring_offsets[rings + 1] -
+                        self.ring_offsets[rings])
+        part_lengths = (self.part_offsets[indices + 1] -
+                        self.part_offsets[indices])
+
+        return PackedGeometry(self.coordinates[vertices],
+                              _lengths_to_offsets(ring_lengths),
+                              _lengths_to_offsets(part_lengths),
+                              bboxes=self.bboxes[indices])
+
+
+def pack_geometry(geometry):
+    """Pack list of geometries into flat arrays
+
+    Args:
+        * geometry: PackedGeometry or list of either point coordinates
+              (x, y), Nx2 arrays of vertices (lines or polygons without
+              holes) or Polygon instances
+
+    Returns:
+        * PackedGeometry instance
+    """
+
+    if isinstance(geometry, PackedGeometry):
+        return geometry
+
+    if len(geometry) == 0:
+        return PackedGeometry(numpy.zeros((0, 2)), [0], [0],
+                              bboxes=numpy.zeros((0, 4)))
+
+    if (not isinstance(geometry[0], Polygon) and
+        numpy.asarray(geometry[0]).ndim == 1):
+        # Points - one ring with one vertex per feature
+        coordinates = numpy.array(geometry, dtype=numpy.float64)
+        offsets = numpy.arange(len(geometry) + 1)
+        return PackedGeometry(coordinates, offsets, offsets)
+
+    rings = []
+    part_lengths = numpy.ones(len(geometry), dtype=numpy.int64)
+    for i, feature in enumerate(geometry):
+        if isinstance(feature, Polygon):
+            rings.append(feature.outer_ring)
+            rings.extend(feature.inner_rings)
+            part_lengths[i] += len(feature.inner_rings)
+        else:
+            rings.append(feature)
+
+    return pack_rings(rings, part_lengths)
+
+
+def pack_rings(rings, part_lengths):
+    """Pack list of rings into flat arrays
+
+    Args:
+        * rings: List of Nx2 arrays of vertices, ordered by feature
+        * part_lengths: Number of rings in each feature
+
+    Returns:
+        * PackedGeometry instance
+    """
+
+    ring_lengths = numpy.array([len(ring) for ring in rings],
+                               dtype=numpy.int64)
+    if len(rings) == 0:
+        coordinates = numpy.zeros((0, 2))
+    else:
+        coordinates = numpy.concatenate([numpy.asarray(ring,
+                                                       dtype=numpy.float64)
+                                         for ring in rings])
+
+    return PackedGeometry(coordinates,
+                          _lengths_to_offsets(ring_lengths),
+                          _lengths_to_offsets(part_lengths))
+
+
+def feature_bounding_boxes(coordinates, ring_offsets, part_offsets):
+    """Compute bounding box of each feature in packed arrays
+
+    Args:
+        * coordinates, ring_offsets, part_offsets: See PackedGeometry
+
+    Returns:
+        * Nx4 array of bounding boxes [minx, maxx, miny, maxy] of
+          the vertices of each feature
+    """
+
+    N = len(part_offsets) - 1
+    bboxes = numpy.zeros((N, 4))
+    if N == 0 or len(coordinates) == 0:
+        return bboxes
+
+    # Vertex offset of each feature
+    starts = ring_offsets[part_offsets]
+
+    # Reduce over non empty features only as reduceat can't handle those
+    nonempty = starts[:-1] < starts[1:]
+    idx = starts[:-1][nonempty]
+    for k, column in [(0, 0), (2, 1)]:
+        x = coordinates[:, column]
+        bboxes[nonempty, k] = numpy.minimum.reduceat(x, idx)
+        bboxes[nonempty, k + 1] = numpy.maximum.reduceat(x, idx)
+
+    return bboxes
+
+
+def _lengths_to_offsets(lengths):
+    """Convert array of lengths to offsets starting at 0
+    """
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _expand_ranges(starts, stops):
+    """Concatenate ranges [starts[i], stops[i]) into one index array
+    """
+    lengths = stops - starts
+    total = int(numpy.sum(lengths))
+    if total == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    # Position within each range plus start of the range it belongs to
+    range_ids = numpy.repeat(numpy.arange(len(lengths)), lengths)
+    first = _lengths_to_offsets(lengths)[:-1]
+    return (numpy.arange(total) - first[range_ids] +
+            starts[range_ids])
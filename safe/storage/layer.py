@@ -1,9 +1,18 @@
 """**Class Layer**
 """
 
+import sys
+import Queue
+import threading
+
 from safe.common.utilities import verify
 from projection import Projection
 
+# Queue of deferred writes handled by one background writer thread
+_write_queue = Queue.Queue()
+_writer_lock = threading.Lock()
+_writer = None
+
 
 class Layer:
     """Common class for geospatial layers
@@ -48,6 +57,7 @@ class Layer:
         self.sublayer = sublayer
         self.filename = None
         self.data = None
+        self.pending_write = None
 
     def __ne__(self, other):
         """Override '!=' to allow comparison with other projection objecs
@@ -61,8 +71,48 @@ class Layer:
         self.name = name
 
     def get_filename(self):
+        """Return filename of layer
+
+        If writing of the layer was deferred (see defer_write) it is
+        completed first so the file exists when this returns.
+        """
+
+        self.finish_writing()
         return self.filename
 
+    def defer_write(self, filename, write, background=False):
+        """Write layer to file later rather than now
+
+        Args:
+            * filename: Name of file the layer will be written to. This
+                  becomes the filename of the layer straight away.
+            * write: Function that writes the layer when called with
+                  filename as argument, e.g. self.write_to_file
+            * background: If True, the layer is written as soon as possible
+                  by a background writer thread. Otherwise it is written
+                  when get_filename or finish_writing is called.
+
+        Note:
+            Layers must not be modified until they have been written.
+        """
+
+        self.filename = filename
+        self.pending_write = PendingWrite(write, filename)
+        if background:
+            self.pending_write.start()
+
+    def finish_writing(self):
+        """Complete deferred write of layer if any
+
+        Raises:
+            * Any exception raised while writing the layer
+        """
+
+        pending_write = getattr(self, 'pending_write', None)
+        if pending_write is not None:
+            pending_write.wait()
+            self.pending_write = None
+
     def get_projection(self, proj4=False):
         """Return projection of this layer as a string
         """
@@ -115,3 +165,97 @@ class Layer:
             return True
         else:
             return False
+
+
+class PendingWrite:
+    """Write of a layer to file that has been put off
+
+    See Layer.defer_write
+    """
+
+    def __init__(self, write, filename):
+        self.write = write
+        self.filename = filename
+        self.done = threading.Event()
+        self.queued = False
+        self.lock = threading.Lock()
+        self.error = None
+
+    def start(self):
+        """Queue write for the background writer thread
+        """
+
+        global _writer
+
+        if not self._take():
+            # Already being written by wait
+            return
+
+        _writer_lock.acquire()
+        try:
+            _write_queue.put(self)
+            if _writer is None:
+                _writer = threading.Thread(target=_write_queued_layers,
+                                           name='InaSAFE layer writer')
+                _writer.start()
+        finally:
+            _writer_lock.release()
+
+    def _take(self):
+        """Mark write as queued or running
+
+        Returns:
+            * True if it was neither before, so the caller must see to it
+              that the layer is written
+        """
+
+        self.lock.acquire()
+        try:
+            taken = not self.queued
+            self.queued = True
+        finally:
+            self.lock.release()
+        return taken
+
+    def run(self):
+        """Write layer recording any error for wait to raise
+        """
+
+        try:
+            self.write(self.filename)
+        except:
+            self.error = sys.exc_info()
+        self.done.set()
+
+    def wait(self):
+        """Write layer now unless it was queued and wait until it is written
+        """
+
+        if self._take():
+            self.run()
+        self.done.wait()
+
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+def _write_queued_layers():
+    """Write queued layers until there are no more
+
+    The thread is not a daemon so queued layers are written
+    before the interpreter exits.
+    """
+
+    global _writer
+
+    while True:
+        _writer_lock.acquire()
+        try:
+            if _write_queue.empty():
+                _writer = None
+                return
+            pending_write = _write_queue.get()
+        finally:
+            _writer_lock.release()
+
+        pending_write.run()
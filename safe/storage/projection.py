@@ -99,6 +99,19 @@ class Projection:
     def __repr__(self):
         return self.wkt
 
+    def __getstate__(self):
+        """Pickle projection as WKT
+
+        Spatial reference objects can't be pickled, so layers could
+        otherwise not be passed between processes.
+        """
+        return {'wkt': self.wkt}
+
+    def __setstate__(self, state):
+        """Recreate projection from pickled WKT
+        """
+        self.__init__(state['wkt'])
+
     def get_projection(self, proj4=False):
         """Return projection
 
@@ -23,6 +23,15 @@ from utilities import write_keywords
 from utilities import (geotransform2bbox, geotransform2resolution,
                        check_geotransform)
 
+# Numpy types of GDAL data types that can be memory mapped
+MEMMAP_TYPES = {'Byte': 'u1',
+                'UInt16': 'u2',
+                'Int16': 'i2',
+                'UInt32': 'u4',
+                'Int32': 'i4',
+                'Float32': 'f4',
+                'Float64': 'f8'}
+
 
 class Raster(Layer):
     """InaSAFE representation of raster data
@@ -30,7 +39,9 @@ class Raster(Layer):
     Args:
         * data: Can be either
               * a filename of a raster file format known to GDAL
-              * an MxN array of raster data
+              * an MxN array of raster data. A numpy.memmap
+                (e.g. from numpy.load(filename, mmap_mode='r')) is used
+                as is without reading it into memory.
               * None (FIXME (Ole): Don't think we need this option)
         * projection: Geospatial reference in WKT format.
                       Only used if data is provide as a numeric array,
@@ -51,6 +62,14 @@ class Raster(Layer):
         * style_info: Dictionary with information about how this layer
                       should be styled. See impact_functions/styles.py
                       for examples.
+        * memmap: Optional flag. If True and data is a filename of an
+                  uncompressed GeoTIFF, the file is memory mapped rather
+                  than read through GDAL. This allows rasters larger than
+                  available memory to be used one window at a time (see
+                  get_windows). Other files are read as usual. Data are
+                  still returned in double precision by get_data, which
+                  reads them into memory unless they are stored as
+                  float64.
 
     Returns:
         * InaSAFE raster layer instance
@@ -66,7 +85,7 @@ class Raster(Layer):
     """
 
     def __init__(self, data=None, projection=None, geotransform=None,
-                 name=None, keywords=None, style_info=None):
+                 name=None, keywords=None, style_info=None, memmap=False):
         """Initialise object with either data or filename
 
         NOTE: Doc strings in constructor are not harvested and exposed in
@@ -90,12 +109,16 @@ class Raster(Layer):
 
         # Initialisation
         if isinstance(data, basestring):
-            self.read_from_file(data)
+            self.read_from_file(data, memmap=memmap)
         else:
             # Assume that data is provided as a numpy array
             # with extra keyword arguments supplying metadata
 
-            self.data = numpy.array(data, dtype='d', copy=False)
+            if isinstance(data, numpy.memmap):
+                # Keep memory mapped data in its stored type
+                self.data = data
+            else:
+                self.data = numpy.array(data, dtype='d', copy=False)
 
             proj4 = self.get_projection(proj4=True)
             if 'longlat' in proj4 and 'WGS84' in proj4:
@@ -123,7 +146,7 @@ class Raster(Layer):
     def __len__(self):
         """Size of data set defined as total number of grid points
         """
-        return len(self.get_data().flat)
+        return self.rows * self.columns
 
     def __eq__(self, other, rtol=1.0e-5, atol=1.0e-8):
         """Override '==' to allow comparison with other raster objecs
@@ -161,8 +184,13 @@ class Raster(Layer):
         # Raster layers are identical up to the specified tolerance
         return True
 
-    def read_from_file(self, filename):
+    def read_from_file(self, filename, memmap=False):
         """Read and unpack raster data
+
+        Args:
+            * filename: Name of raster file
+            * memmap: Optional flag. If True, memory map file if possible.
+                      See class docstring.
         """
 
         # Open data file for reading
@@ -233,8 +261,86 @@ class Raster(Layer):
             msg = 'Could not read raster band from %s' % filename
             raise ReadLayerError(msg)
 
-        # FIXME (Ole): I think internal data array should be populated at
-        #              this point - then refactor get_data()
+        # Grid last read by get_data with cache=True keyed by nan and
+        # scaling values
+        self._data_cache = {}
+
+        if memmap:
+            self.data = self._memory_map()
+
+    def reopen(self):
+        """Open raster file again
+
+        GDAL file handles must not be shared between processes. Processes
+        forked while a raster read from file is open (see safe.engine.tiling)
+        call this before reading from it. Rasters held in memory are left
+        as they are.
+        """
+
+        if getattr(self, 'band', None) is None:
+            return
+
+        fid = self.fid = gdal.Open(self.filename, gdal.GA_ReadOnly)
+        if fid is None:
+            msg = 'Could not open file %s again' % self.filename
+            raise ReadLayerError(msg)
+        self.band = fid.GetRasterBand(1)
+
+    def _memory_map(self):
+        """Map raster band of uncompressed GeoTIFF file into memory
+
+        Returns:
+            * numpy.memmap of band with shape (rows, columns) in the type
+              it is stored in or None if the file layout doesn't allow it.
+              This requires an uncompressed GeoTIFF with strips spanning
+              entire rows stored one after the other.
+        """
+
+        if self.fid.GetDriver().ShortName != 'GTiff':
+            return None
+
+        if self.fid.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE'):
+            return None
+
+        typename = gdal.GetDataTypeName(self.band.DataType)
+        if typename not in MEMMAP_TYPES:
+            return None
+
+        # Byte order is given by the first two bytes of the TIFF header
+        fid = open(self.filename, 'rb')
+        try:
+            byteorder = fid.read(2)
+        finally:
+            fid.close()
+
+        if byteorder == 'II':
+            dtype = numpy.dtype('<' + MEMMAP_TYPES[typename])
+        elif byteorder == 'MM':
+            dtype = numpy.dtype('>' + MEMMAP_TYPES[typename])
+        else:
+            return None
+
+        # Strips must span entire rows and follow each other in the file
+        block_columns, block_rows = self.band.GetBlockSize()
+        if block_columns != self.columns:
+            return None
+
+        strip_size = block_rows * self.columns * dtype.itemsize
+        number_of_strips = (self.rows + block_rows - 1) // block_rows
+        offset = None
+        for i in range(number_of_strips):
+            value = self.band.GetMetadataItem('BLOCK_OFFSET_0_%i' % i,
+                                              'TIFF')
+            if value is None:
+                return None
+
+            if offset is None:
+                offset = int(value)
+            elif int(value) != offset + i * strip_size:
+                return None
+
+        return numpy.memmap(self.filename, dtype=dtype, mode='r',
+                            offset=offset, shape=(self.rows, self.columns))
 
     def write_to_file(self, filename):
         """Save raster data to file
@@ -284,7 +390,8 @@ class Raster(Layer):
         # Write keywords if any
         write_keywords(self.keywords, basename + '.keywords')
 
-    def get_data(self, nan=True, scaling=None, copy=False):
+    def get_data(self, nan=True, scaling=None, copy=False, window=None,
+                 out=None, cache=False):
         """Get raster data as numeric array
 
         Args:
@@ -308,20 +415,101 @@ class Raster(Layer):
                        scalar value: If scaling takes a numerical scalar value,
                                      that will be use to scale the data
         * copy (optional): If present and True return copy
+        * window (optional): Pixel window (xoff, yoff, xsize, ysize)
+                             If given, only this part of the grid is
+                             returned and, for layers read from file, read.
+                             See get_window and get_windows.
+        * out (optional): Float64 array with the shape of the requested
+                          data. If given, the result is written into it
+                          and returned rather than allocating a new array.
+        * cache (optional): If True, the full grid read from file is kept
+                            and returned read only (unless copy is True)
+                            by this and later calls with cache=True and
+                            the same nan and scaling values. Default False.
 
         Note:
             Scaling does not currently work with projected layers.
             See issue #123
+
+            Conversion to double precision, nodata replacement and scaling
+            are done in place in one array. With cache=True, the full grid
+            read from file is kept in the layer so repeated calls don't
+            read the file again. Only the grid of the latest combination
+            of nan and scaling is kept. Calls without cache=True get a new
+            writable array copied from a kept grid if there is one.
+
+            For memory mapped rasters (see class docstring) stored as
+            native double precision, a view of the mapped data is returned
+            if copy is False, out is not given and neither nodata values
+            nor scaling require changes. Otherwise the requested grid or
+            window is read into memory as double precision.
         """
 
-        if hasattr(self, 'data') and self.data is not None:
+        # Value replacing nodata (None if no change) and scaling factor
+        NAN = self._get_nan_value(nan)
+        sigma = self._get_scaling_factor(scaling)
+
+        if window is None:
+            xoff, yoff, xsize, ysize = 0, 0, self.columns, self.rows
+        else:
+            xoff, yoff, xsize, ysize = self._check_window(window)
+
+        if out is not None:
+            msg = ('Output array must be float64 with shape %s. I got %s '
+                   'with shape %s' % (str((ysize, xsize)), str(out.dtype),
+                                      str(out.shape)))
+            verify(out.shape == (ysize, xsize) and
+                   out.dtype == numpy.float64, msg)
+
+        in_memory = hasattr(self, 'data') and self.data is not None
+
+        # Use cached data if this grid has already been read from file.
+        # Note that False can't be used in the key as it equals 0.
+        if NAN is None:
+            key = (None, sigma)
+        elif NAN != NAN:
+            key = ('nan', sigma)
+        else:
+            key = (NAN, sigma)
+
+        data_cache = getattr(self, '_data_cache', {})
+        if not in_memory and key in data_cache:
+            A = data_cache[key]
+            if window is not None:
+                A = A[yoff:yoff + ysize, xoff:xoff + xsize]
+
+            if out is not None:
+                out[:] = A
+                return out
+            elif copy or not cache:
+                return A.copy()
+            else:
+                return A
+
+        if in_memory:
             # Return internal data grid
-            if copy:
+            verify(self.data.shape[0] == self.rows and
+                   self.data.shape[1] == self.columns)
 
-                A = copy_module.deepcopy(self.data)
+            if window is None:
+                source = self.data
+            else:
+                source = self.data[yoff:yoff + ysize, xoff:xoff + xsize]
+
+            # Memory mapped double precision data is returned as is if
+            # possible. Other types are converted below (issue #75).
+            if (isinstance(self.data, numpy.memmap) and
+                self.data.dtype == numpy.float64 and
+                not copy and out is None and sigma == 1 and
+                (NAN is None or not self._contains_nodata(source))):
+                return source
+
+            # Internal data is never modified so work on a copy
+            if out is None:
+                A = numpy.array(source, dtype=numpy.float64)
             else:
-                A = self.data
-            verify(A.shape[0] == self.rows and A.shape[1] == self.columns)
+                A = out
+                A[:] = source
 
         else:
             # Force garbage collection to free up any memory we can (TS)
@@ -329,47 +517,115 @@ class Raster(Layer):
 
             # Read from raster file
             # FIXME: This can be slow so should be moved to read_from_file
-            A = self.band.ReadAsArray()
-
-            # Convert to double precision (issue #75)
-            A = numpy.array(A, dtype=numpy.float64)
+            if window is None:
+                source = self.band.ReadAsArray()
+            else:
+                source = self.band.ReadAsArray(xoff, yoff, xsize, ysize)
 
             # Self check
-            M, N = A.shape
+            M, N = source.shape
             msg = ('Dimensions of raster array do not match those of '
                    'raster file %s' % self.filename)
-            verify(M == self.rows, msg)
-            verify(N == self.columns, msg)
+            verify(M == ysize, msg)
+            verify(N == xsize, msg)
+
+            # Convert to double precision (issue #75)
+            # This only copies if data is stored with another type
+            if out is None:
+                A = numpy.asarray(source, dtype=numpy.float64)
+            else:
+                A = out
+                A[:] = source
+            del source
 
         # Handle no data value
         # FIXME (Ole): This only pertains to data read from file
         # and should be moved to read_from_file.
+        if NAN is not None:
+            # Replace NODATA_VALUE with NaN
+            numpy.putmask(A, A == self.get_nodata_value(), NAN)
+
+        # Take care of possible scaling
+        if sigma != 1:
+            A *= sigma
+
+        # Keep full grid read from file if asked to
+        if cache and not in_memory and window is None and out is None:
+            A.flags.writeable = False
+            self._data_cache = {key: A}
+            if copy:
+                return A.copy()
+
+        # Return possibly scaled data
+        return A
+
+    def _contains_nodata(self, A, block_size=2 ** 22):
+        """Check if grid contains nodata values
+
+        Args:
+            * A: Grid of this layer e.g. memory mapped data
+            * block_size: Approximate number of grid points checked at once
+
+        Returns:
+            * True if any grid point equals the nodata value
+        """
+
         nodata = self.get_nodata_value()
+        if nodata != nodata:
+            # NaN equals nothing so replacing it never changes anything
+            return False
+
+        rows = max(1, block_size // max(1, A.shape[1]))
+        for i in range(0, A.shape[0], rows):
+            if numpy.any(A[i:i + rows] == nodata):
+                return True
+
+        return False
+
+    def _get_nan_value(self, nan):
+        """Get value to replace nodata with
+
+        Args:
+            * nan: See get_data
+
+        Returns:
+            * numpy.nan, number or None if nodata is to be left unchanged
+
+        Raises:
+            * InaSAFEError if nan is not True, False or a number
+        """
 
         # Must explicit comparison to False and True as nan can be a number
         # so 0 would evaluate to False and e.g. 1 to True.
         if nan is False:
             # No change
-            pass
-        else:
-            # Nan value should be changed
-            if nan is True:
-                NAN = numpy.nan  # Use numpy's nan value
-            else:
-                try:
-                    # Use user specified number
-                    NAN = float(nan)
-                except (ValueError, TypeError):
-                    msg = ('Argument nan must be either True, False or a '
-                           'number. I got "nan=%s"' % str(nan))
-                    raise InaSAFEError(msg)
-
-            # Replace NODATA_VALUE with NaN array
-            #print 'Replacing', nodata, 'with', NAN
-            NaN = numpy.ones(A.shape, A.dtype) * NAN
-            A = numpy.where(A == nodata, NaN, A)
+            return None
+
+        # Nan value should be changed
+        if nan is True:
+            return numpy.nan  # Use numpy's nan value
+
+        try:
+            # Use user specified number
+            return float(nan)
+        except (ValueError, TypeError):
+            msg = ('Argument nan must be either True, False or a '
+                   'number. I got "nan=%s"' % str(nan))
+            raise InaSAFEError(msg)
+
+    def _get_scaling_factor(self, scaling):
+        """Get factor to scale data with
+
+        Args:
+            * scaling: See get_data
+
+        Returns:
+            * sigma: Scaling factor
+
+        Raises:
+            * GetDataError if scaling is not True, False, None or a number
+        """
 
-        # Take care of possible scaling
         if scaling is None:
             # Redefine scaling from density keyword if possible
             kw = self.get_keywords()
@@ -383,14 +639,9 @@ class Raster(Layer):
             sigma = 1
         elif scaling is True:
             # Calculate scaling based on resolution change
-
             actual_res = self.get_resolution(isotropic=True)
             native_res = self.get_resolution(isotropic=True, native=True)
-            #print
-            #print 'Actual res', actual_res
-            #print 'Native res', native_res
             sigma = (actual_res / native_res) ** 2
-            #print 'Scaling', sigma
         else:
             # See if scaling can work as a scalar value
             try:
@@ -401,8 +652,142 @@ class Raster(Layer):
                        'number: %s' % (scaling, str(e)))
                 raise GetDataError(msg)
 
-        # Return possibly scaled data
-        return sigma * A
+        return sigma
+
+    def _check_window(self, window):
+        """Verify that pixel window is inside raster
+
+        Args:
+            * window: Pixel window (xoff, yoff, xsize, ysize)
+
+        Returns:
+            * window as a tuple of integers
+
+        Raises:
+            * GetDataError if window is not inside raster
+        """
+
+        try:
+            xoff, yoff, xsize, ysize = [int(x) for x in window]
+        except (ValueError, TypeError), e:
+            msg = ('Window must be a sequence of four integers '
+                   '(xoff, yoff, xsize, ysize). I got %s: %s'
+                   % (str(window), str(e)))
+            raise GetDataError(msg)
+
+        if (xoff < 0 or yoff < 0 or xsize < 1 or ysize < 1 or
+            xoff + xsize > self.columns or yoff + ysize > self.rows):
+            msg = ('Window %s is not inside raster %s with %i columns '
+                   'and %i rows' % (str(window), self.get_name(),
+                                    self.columns, self.rows))
+            raise GetDataError(msg)
+
+        return xoff, yoff, xsize, ysize
+
+    def get_window(self, bbox):
+        """Get pixel window covering bounding box
+
+        Args:
+            * bbox: Bounding box [West, South, East, North] in the
+                    coordinates of this layer
+
+        Returns:
+            * window: (xoff, yoff, xsize, ysize) of the smallest block of
+                      whole pixels covering bbox, clipped to the raster.
+                      Suitable for get_data(window=...).
+                      None if bbox does not overlap the raster.
+        """
+
+        g = self.get_geotransform()
+        west, south, east, north = bbox
+
+        # Pixel coordinates of bbox corners (rows count downwards)
+        x0 = (west - g[0]) / g[1]
+        x1 = (east - g[0]) / g[1]
+        y0 = (north - g[3]) / g[5]
+        y1 = (south - g[3]) / g[5]
+
+        xmin = max(0, int(numpy.floor(min(x0, x1))))
+        xmax = min(self.columns, int(numpy.ceil(max(x0, x1))))
+        ymin = max(0, int(numpy.floor(min(y0, y1))))
+        ymax = min(self.rows, int(numpy.ceil(max(y0, y1))))
+
+        if xmax <= xmin or ymax <= ymin:
+            return None
+
+        return xmin, ymin, xmax - xmin, ymax - ymin
+
+    def get_window_geotransform(self, window):
+        """Get geotransform for pixel window
+
+        Args:
+            * window: Pixel window (xoff, yoff, xsize, ysize)
+
+        Returns:
+            * geotransform with its origin at the top left corner of window
+        """
+
+        xoff, yoff, _, _ = self._check_window(window)
+        g = self.get_geotransform()
+
+        return (g[0] + xoff * g[1] + yoff * g[2], g[1], g[2],
+                g[3] + xoff * g[4] + yoff * g[5], g[4], g[5])
+
+    def get_windows(self, block_size=None):
+        """Split raster into pixel windows covering it
+
+        Args:
+            * block_size: Optional approximate number of grid points per
+                          window. Windows span entire rows and follow the
+                          block layout of the raster file if any.
+                          Default is 2**22 grid points (32MB as float64).
+
+        Returns:
+            * list of pixel windows (xoff, yoff, xsize, ysize) in row order
+        """
+
+        if block_size is None:
+            block_size = 2 ** 22
+
+        # Rows in a native block of the raster file (e.g. GeoTIFF tiles
+        # or strips) so that no block is read more than once.
+        block_rows = 1
+        if hasattr(self, 'band') and self.band is not None:
+            block_rows = max(1, self.band.GetBlockSize()[1])
+
+        rows = max(1, block_size // max(1, self.columns))
+        rows = max(block_rows, rows // block_rows * block_rows)
+
+        windows = []
+        for yoff in range(0, self.rows, rows):
+            windows.append((0, yoff, self.columns,
+                            min(rows, self.rows - yoff)))
+
+        return windows
+
+    def get_blocks(self, nan=True, scaling=None, block_size=None):
+        """Iterate through raster data one window at a time
+
+        Args:
+            * nan, scaling: See get_data
+            * block_size: See get_windows
+
+        Returns:
+            * generator of (window, A) pairs where A is the data in window
+              as returned by get_data(window=window).
+
+        Note:
+            This allows large rasters to be processed without holding the
+            entire grid in memory. E.g. to count population
+
+            total = 0
+            for window, P in raster.get_blocks(nan=0.0):
+                total += numpy.sum(P)
+        """
+
+        for window in self.get_windows(block_size=block_size):
+            yield window, self.get_data(nan=nan, scaling=scaling,
+                                        window=window)
 
     def get_geotransform(self, copy=False):
         """Return geotransform for this raster layer
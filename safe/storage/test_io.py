@@ -2,16 +2,21 @@ import unittest
 import numpy
 import sys
 import os
+import struct
+import time
+import threading
 
-from osgeo import gdal
+from osgeo import gdal, ogr
 
 from raster import Raster
+import vector
 from vector import Vector
 from vector import convert_polygons_to_centroids
 from projection import Projection
 from projection import DEFAULT_PROJECTION
 from core import read_layer
 from core import write_raster_data
+from core import write_binary_layer
 from utilities import write_keywords
 from utilities import read_keywords
 from utilities import bbox_intersection
@@ -20,7 +25,10 @@ from utilities import buffered_bounding_box
 from utilities import array2wkt
 from utilities import calculate_polygon_area
 from utilities import calculate_polygon_centroid
+from utilities import calculate_polygon_areas
+from utilities import calculate_polygon_centroids
 from utilities import points_along_line
+from utilities import wkb2rings, rings2wkb, get_polygondata
 from utilities import geotransform2bbox
 from utilities import geotransform2resolution
 from utilities import raster_geometry2geotransform
@@ -28,15 +36,19 @@ from core import get_bounding_box
 from core import bboxlist2string, bboxstring2list
 from core import check_bbox_string
 from utilities_test import same_API
-from geometry import Polygon
+from geometry import Polygon, PackedGeometry
 from safe.common.numerics import nanallclose
 from safe.common.testing import TESTDATA, HAZDATA, DATADIR
 from safe.common.testing import FEATURE_COUNTS
 from safe.common.testing import GEOTRANSFORMS
 from safe.common.utilities import ugettext as tr, unique_filename
 from safe.common.polygon import is_inside_polygon
+from safe.common.polygon import polygon_bounding_boxes
+from safe.common.polygon import classify_points_by_polygons
+from safe.common.polygon import clip_lines_by_polygon
 from safe.common.exceptions import BoundingBoxError, ReadLayerError
 from safe.common.exceptions import VerificationError, InaSAFEError
+from safe.common.exceptions import WriteLayerError
 
 
 # Auxiliary function for raster test
@@ -250,6 +262,155 @@ class Test_IO(unittest.TestCase):
 
     test_donut_polygons.slow = True
 
+    def test_writing_in_transactions(self):
+        """Vector data can be written to SQLite and GeoPackage in batches
+        """
+
+        filename = '%s/%s' % (TESTDATA, 'donut.shp')
+        L = read_layer(filename)
+
+        # Commit after every other feature to exercise transactions
+        features_per_transaction = vector.FEATURES_PER_TRANSACTION
+        vector.FEATURES_PER_TRANSACTION = 2
+        try:
+            for extension in ['.shp', '.sqlite', '.gpkg']:
+                tmp_filename = unique_filename(suffix=extension)
+                L.write_to_file(tmp_filename)
+
+                R = read_layer(tmp_filename)
+                msg = 'Layer was not preserved when written to %s' % extension
+                assert R == L, msg
+        finally:
+            vector.FEATURES_PER_TRANSACTION = features_per_transaction
+
+    test_writing_in_transactions.slow = True
+
+    def test_binary_layers(self):
+        """Layers can be written to and read from binary files
+        """
+
+        # Vector layer with holes, long attribute names, strings and None
+        outer_ring = numpy.array([[106.0, -6.0], [106.1, -6.0],
+                                  [106.1, -6.1]])
+        hole = numpy.array([[106.05, -6.01], [106.06, -6.01],
+                            [106.06, -6.02]])
+        geometry = [Polygon(outer_ring, inner_rings=[hole]),
+                    Polygon(outer_ring + 1)]
+        data = [{'AFFECTED_PEOPLE': 10, 'TYPE': 'school', 'DEPTH': 0.5},
+                {'AFFECTED_PEOPLE': 20, 'TYPE': None, 'DEPTH': 1.5}]
+        keywords = {'category': 'impact',
+                    'fatalities_per_mmi': {2: 0.0, 7.5: 1.5},
+                    'impact_summary': 'Summary'}
+        V = Vector(data=data, geometry=geometry,
+                   projection=DEFAULT_PROJECTION, keywords=keywords,
+                   name='Buildings', style_info={'target_field': 'DEPTH'})
+
+        filename = unique_filename(suffix='.npz')
+        write_binary_layer(V, filename)
+        R = read_layer(filename)
+
+        assert R.is_vector
+        assert R.get_filename() == filename
+        assert R.get_name() == 'Buildings'
+        assert R.get_keywords() == keywords
+        assert R.get_style_info() == {'target_field': 'DEPTH'}
+        assert R.is_polygon_data
+        assert R == V
+        assert R.get_data('AFFECTED_PEOPLE') == [10, 20]
+        assert R.get_data('TYPE') == ['school', None]
+
+        # Lines
+        lines = [numpy.array([[0, 0], [1, 1], [2, 0]])]
+        V = Vector(geometry=lines, geometry_type='line',
+                   projection=DEFAULT_PROJECTION)
+        write_binary_layer(V, filename)
+        R = read_layer(filename)
+        assert R.is_line_data
+        assert R == V
+
+        # Raster with NaN
+        A = numpy.array([[1.0, numpy.nan], [3.0, 4.0]])
+        geotransform = (106.0, 0.5, 0, -6.0, 0, -0.5)
+        V = Raster(data=A, projection=DEFAULT_PROJECTION,
+                   geotransform=geotransform, keywords={'category': 'impact'})
+        write_binary_layer(V, filename)
+        R = read_layer(filename)
+        assert R.is_raster
+        assert R == V
+        assert R.get_geotransform() == geotransform
+
+        # Extension must be .npz
+        try:
+            write_binary_layer(V, unique_filename(suffix='.tif'))
+        except VerificationError:
+            pass
+        else:
+            msg = 'Wrong extension should have raised an exception'
+            raise Exception(msg)
+
+    def test_deferred_writing(self):
+        """Writing of layers can be deferred or done in the background
+        """
+
+        A = numpy.array([[1.0, 2.0], [3.0, 4.0]])
+        geotransform = (106.0, 0.5, 0, -6.0, 0, -0.5)
+        R = Raster(data=A, projection=DEFAULT_PROJECTION,
+                   geotransform=geotransform, keywords={'category': 'impact'})
+
+        # Deferred write happens when filename is asked for
+        filename = unique_filename(suffix='.npz')
+        R.defer_write(filename, lambda x: write_binary_layer(R, x))
+        assert R.filename == filename
+        assert not os.path.exists(filename)
+        assert R.get_filename() == filename
+        assert os.path.exists(filename)
+        assert read_layer(filename) == R
+
+        # Background writes of several layers
+        layers = []
+        for i in range(5):
+            L = Raster(data=A * i, projection=DEFAULT_PROJECTION,
+                       geotransform=geotransform)
+            L.defer_write(unique_filename(suffix='.npz'),
+                          lambda x, L=L: write_binary_layer(L, x),
+                          background=True)
+            layers.append(L)
+
+        for i, L in enumerate(layers):
+            assert numpy.allclose(read_layer(L.get_filename()).get_data(),
+                                  A * i)
+
+        # Errors are raised when the write is waited for
+        def write(filename):
+            raise WriteLayerError('Disk full')
+
+        for background in [False, True]:
+            R.defer_write(unique_filename(suffix='.npz'), write,
+                          background=background)
+            try:
+                R.get_filename()
+            except WriteLayerError:
+                pass
+            else:
+                msg = 'Failed write should have raised an exception'
+                raise Exception(msg)
+
+        # Layers waited for by several threads at once are written once
+        written = []
+
+        def slow_write(filename):
+            written.append(filename)
+            time.sleep(0.1)
+
+        R.defer_write(unique_filename(suffix='.npz'), slow_write)
+        threads = [threading.Thread(target=R.finish_writing)
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert written == [R.filename]
+
     def test_3d_polygon(self):
         """3D polygons can be read correctly with z component dismissed
 
@@ -328,6 +489,158 @@ class Test_IO(unittest.TestCase):
                 else:
                     raise Exception
 
+    def test_columnar_vector_attributes(self):
+        """Vector attributes can be stored column wise
+        """
+
+        geometry = [[106.1, -6.1], [106.2, -6.2], [106.3, -6.3],
+                    [106.4, -6.4]]
+        depth = numpy.array([0.5, 1.5, 0.0, 3.0])
+        columns = {'depth': depth,
+                   'id': [3, 1, 4, 2],
+                   'type': ['school', None, 'house', 'house']}
+        V = Vector(data=columns, geometry=geometry)
+        assert V.is_columnar
+        assert len(V) == 4
+        assert sorted(V.get_attribute_names()) == ['depth', 'id', 'type']
+
+        # Columns are returned without copying
+        assert V.get_column('depth') is depth
+        assert V.get_column('id').dtype.kind == 'i'
+        assert V.get_column('type').dtype == object
+        flooded = V.get_column('depth') >= 1.0
+        assert flooded.tolist() == [False, True, False, True]
+
+        # Attributes are also available feature by feature
+        assert V.get_data('id') == [3, 1, 4, 2]
+        assert V.get_data('type', 1) is None
+        attributes = V.get_data()
+        assert len(attributes) == 4
+        assert attributes[2]['type'] == 'house'
+        assert attributes[0]['id'] == 3
+
+        # Same layer with attributes stored as rows
+        R = Vector(data=attributes, geometry=geometry)
+        assert not R.is_columnar
+        assert V == R
+        assert numpy.allclose(R.get_column('id'), V.get_column('id'))
+
+        # Copies are independent
+        C = V.copy()
+        assert C.is_columnar
+        assert C == V
+        C.get_column('id')[0] = 10
+        assert V.get_column('id')[0] == 3
+
+        # Top N
+        for N in [1, 2, 4]:
+            assert V.get_topN('id', N=N) == R.get_topN('id', N=N)
+
+        # Columns must match geometry
+        try:
+            Vector(data={'id': [1, 2]}, geometry=geometry)
+        except VerificationError:
+            pass
+        else:
+            msg = 'Columns of wrong length should have raised exception'
+            raise Exception(msg)
+
+        # Reading and writing
+        filename = os.path.join(TESTDATA, 'test_buildings.shp')
+        R = read_layer(filename)
+        V = Vector(filename, columnar=True)
+        assert V.is_columnar
+        assert V == R
+        assert numpy.allclose(V.get_column('FLOOR_AREA'),
+                              R.get_data('FLOOR_AREA'))
+
+        tmp_filename = unique_filename(suffix='.shp')
+        V.write_to_file(tmp_filename)
+        assert read_layer(tmp_filename) == R
+
+    def test_packed_vector_geometry(self):
+        """Vector geometry can be packed into flat coordinate arrays
+        """
+
+        outer_ring = numpy.array([[0, 0], [4, 0], [4, 4], [0, 4]])
+        hole = numpy.array([[1, 1], [2, 1], [2, 2]])
+        polygons = [Polygon(outer_ring),
+                    Polygon(outer_ring + 5, inner_rings=[hole + 5]),
+                    Polygon(outer_ring - 5)]
+        data = [{'ID': 0}, {'ID': 2}, {'ID': 1}]
+
+        V = Vector(data=data, geometry=polygons, packed=True)
+        R = Vector(data=data, geometry=polygons)
+        assert V.is_packed
+        assert not R.is_packed
+        assert V == R
+        assert numpy.allclose(V.get_bounding_box(), R.get_bounding_box())
+
+        # Packed store
+        P = V.get_packed_geometry()
+        assert isinstance(P, PackedGeometry)
+        assert len(P) == 3
+        assert P.number_of_rings == 4
+        assert P.coordinates.shape == (15, 2)
+        assert numpy.all(P.part_offsets == [0, 1, 3, 4])
+        assert numpy.allclose(P.bboxes[1], [5, 9, 5, 9])
+        assert numpy.allclose(P.bboxes, polygon_bounding_boxes(polygons))
+
+        # Geometries are views into the packed coordinates
+        geometry = V.get_geometry()
+        assert numpy.allclose(geometry[2], outer_ring - 5)
+        assert numpy.may_share_memory(geometry[2], P.coordinates)
+        objects = V.get_geometry(as_geometry_objects=True)
+        assert numpy.allclose(objects[1].inner_rings[0], hole + 5)
+        assert numpy.allclose(V.get_geometry(copy=True)[0], outer_ring)
+        assert not numpy.may_share_memory(V.get_geometry(copy=True)[0],
+                                          P.coordinates)
+
+        # Copying and selecting
+        W = V.copy()
+        assert W.is_packed
+        assert W == R
+        W.get_packed_geometry().coordinates[:] = 0
+        assert V == R
+
+        assert V.get_topN('ID', 2) == R.get_topN('ID', 2)
+        assert V.get_topN('ID', 2).is_packed
+
+        # Packed polygons and lines can be used by the polygon module
+        points = numpy.array([[1.5, 1.5], [6.5, 6.5], [-3, -3], [20, 20]])
+        assert numpy.all(classify_points_by_polygons(points, P) ==
+                         classify_points_by_polygons(points, polygons))
+
+        lines = [numpy.array([[-1, 2], [10, 2]]),
+                 numpy.array([[6, 7], [7, 8], [8, 9]])]
+        L = Vector(geometry=lines, geometry_type='line', packed=True)
+        assert L.is_line_data
+        assert L.copy().is_line_data
+        assert L == Vector(geometry=lines, geometry_type='line')
+        inside, outside = clip_lines_by_polygon(L.get_packed_geometry(),
+                                                outer_ring)
+        assert numpy.allclose(inside[0], [[[0, 2], [4, 2]]])
+        assert inside[1] == []
+        assert len(outside[0]) == 2
+        assert numpy.allclose(outside[1], [lines[1]])
+
+        # Points
+        V = Vector(geometry=[[1, 2], [3, 4]], packed=True)
+        assert V.is_point_data
+        assert V.get_geometry() == [[1, 2], [3, 4]]
+        assert V == Vector(geometry=[[1, 2], [3, 4]])
+
+        # Reading from file
+        filename = '%s/%s' % (TESTDATA, 'test_polygon.shp')
+        R = read_layer(filename)
+        V = Vector(filename, packed=True)
+        assert V.is_packed
+        assert V == R
+
+        tmp_filename = unique_filename(suffix='.shp')
+        V.write_to_file(tmp_filename)
+        assert read_layer(tmp_filename) == R
+
     def test_vector_class(self):
         """Consistency of vector class for point data
         """
@@ -1353,6 +1666,205 @@ class Test_IO(unittest.TestCase):
 
     test_nodata_value.slow = True
 
+    def test_raster_windows(self):
+        """Parts of raster data can be read through pixel windows
+        """
+
+        # In memory raster with nodata and known geotransform
+        A = numpy.arange(60, dtype='d').reshape((6, 10))
+        A[2, 3] = numpy.nan
+        geotransform = (100, 0.5, 0, 10, 0, -0.5)
+        R = Raster(A, geotransform=geotransform,
+                   keywords={'datatype': 'density'})
+
+        # Windows given as pixel offsets and sizes
+        B = R.get_data(window=(2, 1, 4, 3))
+        assert B.shape == (3, 4)
+        assert nanallclose(B, A[1:4, 2:6])
+
+        B = R.get_data(scaling=4, window=(2, 1, 4, 3))
+        assert nanallclose(B, 4 * A[1:4, 2:6])
+
+        # Windows must be inside raster
+        for window in [(-1, 0, 2, 2), (0, 0, 11, 1), (9, 5, 2, 1),
+                       (0, 0, 0, 1), (0, 0, 1), 'abcd']:
+            try:
+                R.get_data(window=window)
+            except InaSAFEError:
+                pass
+            else:
+                msg = 'Illegal window %s should have raised' % str(window)
+                raise Exception(msg)
+
+        # Windows from bounding boxes [W, S, E, N]
+        assert R.get_window([100, 7, 105, 10]) == (0, 0, 10, 6)
+        assert R.get_window([101.2, 8.1, 102.0, 9.4]) == (2, 1, 2, 3)
+        assert R.get_window([90, 0, 120, 20]) == (0, 0, 10, 6)
+        assert R.get_window([110, 0, 120, 20]) is None
+
+        window = R.get_window([101.2, 8.1, 102.0, 9.4])
+        assert numpy.allclose(R.get_window_geotransform(window),
+                              (101, 0.5, 0, 9.5, 0, -0.5))
+
+        # Blocks cover the raster exactly once
+        for block_size in [1, 10, 25, 60, 1000]:
+            windows = R.get_windows(block_size=block_size)
+            assert sum([w[3] for w in windows]) == R.rows
+
+            C = numpy.zeros(A.shape)
+            for window, B in R.get_blocks(nan=-1, scaling=False,
+                                          block_size=block_size):
+                xoff, yoff, xsize, ysize = window
+                C[yoff:yoff + ysize, xoff:xoff + xsize] += B
+            assert nanallclose(C, R.get_data(nan=-1, scaling=False))
+
+        # Windows of raster read from file are read from file
+        R = read_layer(os.path.join(TESTDATA, 'Population_2010_clip.tif'))
+        A = R.get_data()
+        window = (10, 20, 30, 40)
+        B = R.get_data(window=window)
+        assert nanallclose(B, A[20:60, 10:40])
+
+        C = numpy.zeros(A.shape)
+        for window, B in R.get_blocks(block_size=1000):
+            xoff, yoff, xsize, ysize = window
+            C[yoff:yoff + ysize, xoff:xoff + xsize] = B
+        assert nanallclose(C, A)
+
+    def test_get_data_buffers_and_cache(self):
+        """Raster data can be written into buffers and is cached
+        """
+
+        # In memory raster
+        A = numpy.arange(12, dtype='d').reshape((3, 4))
+        R = Raster(A, geotransform=(100, 0.5, 0, 10, 0, -0.5))
+
+        # Internal data is never returned or modified
+        B = R.get_data(scaling=3)
+        assert numpy.allclose(B, 3 * A)
+        assert numpy.allclose(R.data, A)
+        assert R.get_data() is not R.get_data()
+
+        # Output buffers
+        out = numpy.zeros((3, 4))
+        B = R.get_data(scaling=2, out=out)
+        assert B is out
+        assert numpy.allclose(out, 2 * A)
+
+        out = numpy.zeros((2, 2))
+        B = R.get_data(scaling=2, out=out, window=(1, 1, 2, 2))
+        assert B is out
+        assert numpy.allclose(out, 2 * A[1:3, 1:3])
+
+        for out in [numpy.zeros((4, 3)), numpy.zeros((3, 4), dtype='f')]:
+            try:
+                R.get_data(out=out)
+            except VerificationError:
+                pass
+            else:
+                msg = 'Wrong output buffer should have raised exception'
+                raise Exception(msg)
+
+        # Raster read from file
+        filename = os.path.join(TESTDATA, 'Population_2010_clip.tif')
+        R = read_layer(filename)
+
+        # Grids are fresh writable arrays unless cache is asked for
+        A = R.get_data(nan=0.0, scaling=False)
+        assert A.flags.writeable
+        assert R._data_cache == {}
+        A[0, 0] = -1
+        assert R.get_data(nan=0.0, scaling=False)[0, 0] != -1
+
+        # The latest grid read with cache=True is kept
+        A = R.get_data(nan=0.0, scaling=False, cache=True)
+        assert R.get_data(nan=0.0, scaling=False, cache=True) is A
+        assert R.get_data(nan=0.0, cache=True) is not A
+        assert len(R._data_cache) == 1
+        A = R.get_data(nan=0.0, scaling=False, cache=True)
+        assert R.get_data(nan=-1, scaling=False, cache=True) is not A
+
+        # Cached grids are read only unless copied
+        assert not A.flags.writeable
+        B = R.get_data(nan=-1, scaling=False, cache=True, copy=True)
+        assert B.flags.writeable
+        B = R.get_data(nan=-1, scaling=False)
+        assert B.flags.writeable
+        assert nanallclose(B, R.get_data(nan=-1, scaling=False,
+                                         cache=True))
+
+        # Results are the same as for a fresh read
+        for nan in [True, False, 0.0]:
+            for scaling in [True, False, 2]:
+                C = read_layer(filename).get_data(nan=nan, scaling=scaling)
+                assert nanallclose(R.get_data(nan=nan, scaling=scaling,
+                                              cache=True), C)
+
+        # Windows are served from cache
+        A = R.get_data(nan=0.0, scaling=False, cache=True)
+        B = R.get_data(nan=0.0, scaling=False, window=(10, 20, 30, 40))
+        assert numpy.allclose(B, A[20:60, 10:40])
+
+    def test_memory_mapped_rasters(self):
+        """Rasters can be backed by memory mapped files
+        """
+
+        # Raw float64 array stored as .npy file
+        A = numpy.arange(60, dtype='d').reshape((6, 10))
+        A[2, 3] = numpy.nan
+        filename = unique_filename(suffix='.npy')
+        numpy.save(filename, A)
+
+        M = numpy.load(filename, mmap_mode='r')
+        R = Raster(M, geotransform=(100, 0.5, 0, 10, 0, -0.5))
+        assert R.rows == 6
+        assert R.columns == 10
+        assert len(R) == 60
+
+        # Unmodified data is returned as a view without reading it
+        B = R.get_data(copy=False)
+        assert isinstance(B, numpy.memmap)
+        assert B.dtype == numpy.float64
+        assert nanallclose(B, A)
+
+        B = R.get_data(window=(2, 1, 4, 3))
+        assert isinstance(B, numpy.memmap)
+        assert nanallclose(B, A[1:4, 2:6])
+
+        # Copies and scaled data are double precision arrays in memory
+        for B in [R.get_data(copy=True), R.get_data(scaling=2)]:
+            assert not isinstance(B, numpy.memmap)
+            assert B.dtype == numpy.float64
+
+        assert nanallclose(R.get_data(scaling=2), 2 * A)
+
+        # Other types are returned in double precision too
+        filename = unique_filename(suffix='.npy')
+        numpy.save(filename, A.astype('f'))
+        R = Raster(numpy.load(filename, mmap_mode='r'),
+                   geotransform=(100, 0.5, 0, 10, 0, -0.5))
+        B = R.get_data(window=(2, 1, 4, 3))
+        assert not isinstance(B, numpy.memmap)
+        assert B.dtype == numpy.float64
+        assert nanallclose(B, A[1:4, 2:6])
+
+        # Uncompressed GeoTIFF is mapped directly
+        filename = os.path.join(TESTDATA, 'Population_2010_clip.tif')
+        R = read_layer(filename)
+        A = R.get_data(nan=False)
+        nodata = R.get_nodata_value()
+        assert numpy.any(A == nodata)
+
+        R_mapped = read_layer(filename, memmap=True)
+        assert isinstance(R_mapped.data, numpy.memmap)
+        assert numpy.allclose(R_mapped.get_data(nan=False), A)
+        assert R_mapped.get_data(nan=False).dtype == numpy.float64
+
+        # Nodata is replaced in a copy
+        B = R_mapped.get_data(nan=True)
+        assert not isinstance(B, numpy.memmap)
+        assert nanallclose(B, R.get_data(nan=True))
+
     def test_vector_extrema(self):
         """Vector extremum calculation works
         """
@@ -2148,6 +2660,93 @@ class Test_IO(unittest.TestCase):
             x, y = field.split()
             assert numpy.allclose(A[i, :], [float(x), float(y)])
 
+    def test_wkb2rings(self):
+        """Coordinates are extracted from well known binary geometries
+        """
+
+        def ring_wkb(ring, byte_order='<'):
+            ring = numpy.array(ring, dtype='d')
+            return (struct.pack(byte_order + 'I', len(ring)) +
+                    ring.astype(byte_order + 'f8').tostring())
+
+        outer_ring = [[106.0, -6.0], [107.0, -6.0], [107.0, -7.0],
+                      [106.0, -6.0]]
+        inner_ring = [[106.2, -6.2], [106.4, -6.2], [106.4, -6.4],
+                      [106.2, -6.2]]
+
+        # Little endian polygon with a hole
+        wkb = (struct.pack('<BII', 1, ogr.wkbPolygon, 2) +
+               ring_wkb(outer_ring) + ring_wkb(inner_ring))
+        rings = wkb2rings(wkb)
+        assert len(rings) == 2
+        assert numpy.allclose(rings[0], outer_ring)
+        assert numpy.allclose(rings[1], inner_ring)
+
+        # Big endian line
+        wkb = struct.pack('>BI', 0, ogr.wkbLineString) + ring_wkb(
+            outer_ring, byte_order='>')
+        rings = wkb2rings(wkb)
+        assert len(rings) == 1
+        assert numpy.allclose(rings[0], outer_ring)
+
+        # Point with Z coordinate in ISO format
+        wkb = struct.pack('<BIddd', 1, 1001, 106.5, -6.5, 10.0)
+        assert numpy.allclose(wkb2rings(wkb), [[[106.5, -6.5]]])
+
+        # Multipolygon with 2.5D parts gives all rings in order
+        ring_3d = numpy.zeros((4, 3))
+        ring_3d[:, :2] = outer_ring
+        part = (struct.pack('<BII', 1, 0x80000003, 1) +
+                ring_wkb(ring_3d))
+        wkb = struct.pack('<BII', 1, ogr.wkbMultiPolygon, 2) + part + part
+        rings = wkb2rings(wkb)
+        assert len(rings) == 2
+        for ring in rings:
+            assert ring.shape == (4, 2)
+            assert numpy.allclose(ring, outer_ring)
+
+        # Conversion back to well known binary
+        rings = [numpy.array(outer_ring), numpy.array(inner_ring)]
+        wkb = rings2wkb(rings)
+        for r0, r1 in zip(rings, wkb2rings(wkb)):
+            assert numpy.all(r0 == r1)
+        wkb = rings2wkb(rings[:1], geometry_type=ogr.wkbLineString)
+        assert numpy.all(wkb2rings(wkb)[0] == rings[0])
+
+        # Compare with vertex by vertex reading of layer
+        filename = '%s/%s' % (TESTDATA, 'test_polygon.shp')
+        fid = ogr.Open(filename)
+        layer = fid.GetLayerByIndex(0)
+        for feature in layer:
+            G = feature.GetGeometryRef()
+            polygon = get_polygondata(G)
+            rings = wkb2rings(G.ExportToWkb())
+            assert numpy.allclose(rings[0], polygon.outer_ring)
+            assert len(rings) == len(polygon.inner_rings) + 1
+
+    def test_read_selected_attributes(self):
+        """Only attributes asked for are read from vector layers
+        """
+
+        filename = '%s/%s' % (TESTDATA, 'test_buildings.shp')
+        R = read_layer(filename)
+        V = Vector(filename, attribute_names=['FLOOR_AREA'])
+        assert V.get_attribute_names() == ['FLOOR_AREA']
+        assert V.get_data('FLOOR_AREA') == R.get_data('FLOOR_AREA')
+        assert V.get_geometry() == R.get_geometry()
+
+        V = Vector(filename, attribute_names=[])
+        assert len(V) == len(R)
+        assert V.get_data()[0] == {}
+
+        try:
+            Vector(filename, attribute_names=['NONEXISTING'])
+        except ReadLayerError:
+            pass
+        else:
+            msg = 'Non existing attribute should have raised exception'
+            raise Exception(msg)
+
     def test_polygon_area(self):
         """Polygon areas are computed correctly
         """
@@ -2267,6 +2866,67 @@ class Test_IO(unittest.TestCase):
                    name='Test centroid')
         V.write_to_file(out_filename)
 
+    def test_polygon_centroids_and_areas_of_layer(self):
+        """Centroids and areas of all polygons in a layer are computed
+        """
+
+        # Polygons with holes, in both orientations and not closed
+        numpy.random.seed(11)
+        polygons = []
+        for i in range(300):
+            n = numpy.random.randint(3, 12)
+            angles = numpy.sort(numpy.random.random(n)) * 2 * numpy.pi
+            radii = numpy.random.random(n) * 0.001 + 0.0005
+            x0, y0 = numpy.random.random(2) * [10, 5] + [106, -7]
+            ring = numpy.transpose([x0 + radii * numpy.cos(angles),
+                                    y0 + radii * numpy.sin(angles)])
+            closed = numpy.concatenate([ring, ring[:1]])
+            if i % 3 == 0:
+                hole = [x0, y0] + 1.0e-4 * numpy.array([[0, 0], [1, 0],
+                                                        [1, 1], [0, 0]])
+                polygons.append(Polygon(outer_ring=closed,
+                                        inner_rings=[hole]))
+            elif i % 3 == 1:
+                polygons.append(Polygon(outer_ring=closed[::-1]))
+            else:
+                polygons.append(Polygon(outer_ring=ring))
+
+        # Reference values from closed outer rings
+        rings = []
+        for polygon in polygons:
+            ring = polygon.outer_ring
+            if not numpy.all(ring[0] == ring[-1]):
+                ring = numpy.concatenate([ring, ring[:1]])
+            rings.append(ring)
+        ref_centroids = [calculate_polygon_centroid(P) for P in rings]
+        ref_areas = [calculate_polygon_area(P, signed=True) for P in rings]
+
+        for packed in [False, True]:
+            V = Vector(geometry=polygons, packed=packed)
+
+            C = calculate_polygon_centroids(V)
+            assert C.shape == (len(polygons), 2)
+            assert numpy.allclose(C, ref_centroids, rtol=0, atol=1.0e-12)
+
+            A = calculate_polygon_areas(V, signed=True)
+            assert numpy.allclose(A, ref_areas, rtol=1.0e-12, atol=0)
+            A = calculate_polygon_areas(V)
+            assert numpy.allclose(A, numpy.abs(ref_areas),
+                                  rtol=1.0e-12, atol=0)
+
+            # Centroid layers use the same centroids
+            P = convert_polygons_to_centroids(V)
+            assert numpy.allclose(P.get_geometry(), C, rtol=0, atol=0)
+
+        # Simple squares
+        squares = [numpy.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]),
+                   numpy.array([[168, -2], [169, -2], [169, -1],
+                                [168, -1], [168, -2]])]
+        V = Vector(geometry=squares)
+        assert numpy.allclose(calculate_polygon_centroids(V),
+                              [[0.5, 0.5], [168.5, -1.5]])
+        assert numpy.allclose(calculate_polygon_areas(V), [1, 1])
+
     def test_line_to_points(self):
         """Points along line are computed correctly
         """
@@ -6,10 +6,11 @@ import re
 import copy
 import numpy
 import math
+import struct
 from ast import literal_eval
 from osgeo import ogr
 
-from geometry import Polygon
+from geometry import Polygon, PackedGeometry
 
 from safe.common.numerics import ensure_numeric
 from safe.common.utilities import verify
@@ -25,6 +26,7 @@ LAYER_TYPES = ['.shp', '.asc', '.tif', '.tiff', '.geotif', '.geotiff']
 
 # Map between extensions and ORG drivers
 DRIVER_MAP = {'.sqlite': 'SQLITE',
+              '.gpkg': 'GPKG',
               '.shp': 'ESRI Shapefile',
               '.gml': 'GML',
               '.tif': 'GTiff',
@@ -911,6 +913,10 @@ def calculate_polygon_area(polygon, signed=False):
            'I got second dimension %i instead of 2' % P.shape[1])
     verify(P.shape[1] == 2, msg)
 
+    # Normalise to ensure numerical accuracy (see
+    # calculate_polygon_centroid)
+    P = P - numpy.amin(P, axis=0)
+
     x = P[:, 0]
     y = P[:, 1]
 
@@ -950,8 +956,9 @@ def calculate_polygon_centroid(polygon):
     P = P - P_origin
 
     # Get area. This calculation could be incorporated to save time
-    # if necessary as the two formulas are very similar.
-    A = calculate_polygon_area(polygon, signed=True)
+    # if necessary as the two formulas are very similar. It is done on
+    # the normalised polygon as well for the same reason.
+    A = calculate_polygon_area(P, signed=True)
 
     x = P[:, 0]
     y = P[:, 1]
@@ -973,6 +980,136 @@ def calculate_polygon_centroid(polygon):
     return C
 
 
+def calculate_polygon_areas(V, signed=False):
+    """Calculate areas of all polygons in a layer
+
+    Args:
+        * V: Polygon vector layer or PackedGeometry instance
+        * signed: Optional flag deciding whether returned areas retain
+                  their sign. See calculate_polygon_area.
+
+    Returns:
+        * Array of areas of the outer rings of the polygons
+
+    Note:
+        This gives the same results as calculate_polygon_area applied to
+        the outer ring of each polygon, but works on all polygons at once
+        (see _outer_ring_moments). Rings need not be closed.
+    """
+
+    A, _, _ = _outer_ring_moments(V)
+    if signed:
+        return A
+    else:
+        return numpy.abs(A)
+
+
+def calculate_polygon_centroids(V):
+    """Calculate centroids of all polygons in a layer
+
+    Args:
+        * V: Polygon vector layer or PackedGeometry instance
+
+    Returns:
+        * Nx2 array of centroids of the outer rings of the polygons
+
+    Note:
+        This gives the same results as calculate_polygon_centroid applied
+        to the outer ring of each polygon, but works on all polygons at
+        once (see _outer_ring_moments). Rings need not be closed.
+    """
+
+    A, C, origin = _outer_ring_moments(V)
+
+    oldset = numpy.seterr(invalid='ignore', divide='ignore')
+    C = C / (6. * A[:, numpy.newaxis])
+    numpy.seterr(**oldset)
+
+    # Translate back to real location
+    return C + origin
+
+
+def _outer_ring_moments(V):
+    """Shoelace sums over the outer ring of every polygon
+
+    Args:
+        * V: Polygon vector layer or PackedGeometry instance
+
+    Returns:
+        * A: Array of signed areas
+        * C: Nx2 array of the sums
+             sum_{i=0}^{N-1} (x_i + x_{i+1})(x_i y_{i+1} - x_{i+1} y_i)
+             and the same with y_i + y_{i+1} (see
+             calculate_polygon_centroid)
+        * origin: Nx2 array of the smallest coordinates of each ring.
+             C is calculated relative to these for numerical accuracy.
+
+    Note:
+        The terms for consecutive vertices of all rings are computed in
+        one go on the packed coordinates and summed for each ring with
+        numpy.add.reduceat. Areas are calculated relative to origin too.
+    """
+
+    if isinstance(V, PackedGeometry):
+        geometry = V
+    else:
+        msg = 'Input data %s must be polygon vector data' % V
+        verify(V.is_polygon_data, msg)
+        geometry = V.get_packed_geometry()
+
+    # First and one past last vertex of each outer ring
+    outer = geometry.part_offsets[:-1]
+    starts = geometry.ring_offsets[outer]
+    ends = geometry.ring_offsets[outer + 1]
+    lengths = ends - starts
+
+    N = len(outer)
+    if N == 0:
+        return numpy.zeros(0), numpy.zeros((0, 2)), numpy.zeros((0, 2))
+
+    msg = 'Polygons must have at least one vertex'
+    verify(numpy.all(lengths > 0), msg)
+
+    # Vertices of outer rings only, one ring after the other
+    if len(outer) == len(geometry.ring_offsets) - 1:
+        P = geometry.coordinates
+    else:
+        index = (numpy.arange(lengths.sum()) -
+                 numpy.repeat(numpy.cumsum(lengths) - lengths - starts,
+                              lengths))
+        P = geometry.coordinates[index]
+    offsets = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]])
+
+    # Normalise each ring to ensure numerical accuracy
+    # (see calculate_polygon_centroid)
+    origin = numpy.minimum.reduceat(P, offsets, axis=0)
+    P = P - numpy.repeat(origin, lengths, axis=0)
+
+    x = P[:, 0]
+    y = P[:, 1]
+
+    # Terms for each vertex and the next. The last vertex of each ring
+    # is paired with the first of the same ring, which adds nothing for
+    # closed rings and closes those that aren't.
+    x1 = numpy.empty(len(P))
+    x1[:-1] = x[1:]
+    y1 = numpy.empty(len(P))
+    y1[:-1] = y[1:]
+    last = offsets + lengths - 1
+    x1[last] = x[offsets]
+    y1[last] = y[offsets]
+
+    t = x * y1 - y * x1
+    cx = (x + x1) * t
+    cy = (y + y1) * t
+
+    A = numpy.add.reduceat(t, offsets) / 2.
+    C = numpy.column_stack([numpy.add.reduceat(cx, offsets),
+                            numpy.add.reduceat(cy, offsets)])
+
+    return A, C, origin
+
+
 def points_between_points(point1, point2, delta):
     """Creates an array of points between two points given a delta
 
@@ -1089,3 +1226,134 @@ def get_polygondata(G):
     # Return Polygon instance
     return Polygon(outer_ring=outer_ring,
                    inner_rings=inner_rings)
+
+
+def wkb2rings(wkb):
+    """Extract coordinates from geometry in well known binary format
+
+    Args:
+        * wkb: Geometry as well known binary string, e.g. as returned by
+               OGR's ExportToWkb
+
+    Returns:
+        * List of Nx2 numpy arrays of vertex coordinates (lon, lat).
+          A point gives one array with one vertex, a line one array and
+          a polygon its outer ring followed by its inner rings.
+          The rings of all parts of multipart geometries are returned
+          in order, which is the same as OGR's ForceToPolygon.
+
+    Note:
+        Each ring is read in one go rather than one vertex at a time as
+        in get_ringdata. The arrays are read only views into wkb and
+        Z or M coordinates are dropped.
+    """
+
+    rings = []
+    _read_wkb(wkb, 0, rings)
+    return rings
+
+
+def _read_wkb(wkb, offset, rings):
+    """Read rings of one geometry from well known binary string
+
+    Args:
+        * wkb: Well known binary string
+        * offset: Byte offset of geometry in wkb
+        * rings: List that rings are appended to
+
+    Returns:
+        * Byte offset of the end of the geometry
+    """
+
+    byte_order = '<' if struct.unpack_from('B', wkb, offset)[0] else '>'
+    uint = byte_order + 'I'
+    wkb_type = struct.unpack_from(uint, wkb, offset + 1)[0]
+    offset += 5
+
+    # Dimension from flags for 2.5D (OGR) and measured (EWKB) geometries
+    # or from the thousands of the ISO type codes
+    dimension = 2
+    if wkb_type & 0x80000000:
+        dimension += 1
+    if wkb_type & 0x40000000:
+        dimension += 1
+    wkb_type &= 0x0FFFFFFF
+    dimension += [0, 1, 1, 2][wkb_type // 1000]
+    wkb_type %= 1000
+
+    def read_ring(offset, N):
+        if N == 0:
+            return numpy.zeros((0, 2)), offset
+        A = numpy.frombuffer(wkb, dtype=byte_order + 'f8',
+                             count=N * dimension, offset=offset)
+        return A.reshape(N, dimension)[:, :2], offset + 8 * N * dimension
+
+    if wkb_type == ogr.wkbPoint:
+        ring, offset = read_ring(offset, 1)
+        rings.append(ring)
+    elif wkb_type == ogr.wkbLineString:
+        N = struct.unpack_from(uint, wkb, offset)[0]
+        ring, offset = read_ring(offset + 4, N)
+        rings.append(ring)
+    elif wkb_type == ogr.wkbPolygon:
+        number_of_rings = struct.unpack_from(uint, wkb, offset)[0]
+        offset += 4
+        for i in range(number_of_rings):
+            N = struct.unpack_from(uint, wkb, offset)[0]
+            ring, offset = read_ring(offset + 4, N)
+            rings.append(ring)
+    elif wkb_type in [ogr.wkbMultiPoint, ogr.wkbMultiLineString,
+                      ogr.wkbMultiPolygon, ogr.wkbGeometryCollection]:
+        number_of_parts = struct.unpack_from(uint, wkb, offset)[0]
+        offset += 4
+        for i in range(number_of_parts):
+            offset = _read_wkb(wkb, offset, rings)
+    else:
+        msg = 'WKB geometry type %i is not supported' % wkb_type
+        raise InaSAFEError(msg)
+
+    return offset
+
+
+def rings2wkb(rings, geometry_type=ogr.wkbPolygon):
+    """Convert coordinates to geometry in well known binary format
+
+    Args:
+        * rings: List of Nx2 arrays of coordinates. For polygons the outer
+                 ring followed by any inner rings and for lines one array.
+        * geometry_type: Either ogr.wkbPolygon (default) or
+                 ogr.wkbLineString
+
+    Returns:
+        * Little endian well known binary string which can be passed to
+          ogr.CreateGeometryFromWkb
+
+    Note:
+        This is the inverse of wkb2rings and avoids adding vertices one
+        at a time as in array2line.
+    """
+
+    msg = ('Geometry type must be ogr.wkbPolygon or ogr.wkbLineString. '
+           'I got %s' % geometry_type)
+    verify(geometry_type in [ogr.wkbPolygon, ogr.wkbLineString], msg)
+
+    if geometry_type == ogr.wkbLineString:
+        msg = 'Lines must have exactly one ring. I got %i' % len(rings)
+        verify(len(rings) == 1, msg)
+        parts = [struct.pack('<BI', 1, geometry_type)]
+    else:
+        parts = [struct.pack('<BII', 1, geometry_type, len(rings))]
+
+    for ring in rings:
+        A = numpy.asarray(ring, dtype='<f8')
+
+        msg = 'Array must be a 2d array of vertices. I got %s' % str(A.shape)
+        verify(len(A.shape) == 2, msg)
+
+        msg = 'Array must have two columns. I got %s' % str(A.shape[1])
+        verify(A.shape[1] == 2, msg)
+
+        parts.append(struct.pack('<I', A.shape[0]))
+        parts.append(A.tostring())
+
+    return b''.join(parts)
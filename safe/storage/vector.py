@@ -31,22 +31,27 @@ from safe.common.exceptions import GetDataError, InaSAFEError
 
 from layer import Layer
 from projection import Projection
-from geometry import Polygon
+from geometry import Polygon, PackedGeometry
+from geometry import pack_geometry, pack_rings
 from utilities import DRIVER_MAP, TYPE_MAP
 from utilities import read_keywords
 from utilities import write_keywords
 from utilities import get_geometry_type
 from utilities import is_sequence
 from utilities import array2line
-from utilities import calculate_polygon_centroid
+from utilities import calculate_polygon_centroids
 from utilities import points_along_line
 from utilities import geometrytype2string
-from utilities import get_ringdata, get_polygondata
+from utilities import wkb2rings, rings2wkb
 from utilities import rings_equal
+from safe.common.polygon import PointGridIndex
 
 LOGGER = logging.getLogger('InaSAFE')
 _pseudo_inf = float(99999999)
 
+# Number of features written to file in each OGR transaction
+FEATURES_PER_TRANSACTION = 100000
+
 
 class Vector(Layer):
     """InaSAFE representation of vector data.
@@ -57,12 +62,15 @@ class Vector(Layer):
                 * A filename of a vector file format known to GDAL.
                 * List of dictionaries of field names and attribute values
                   associated with each point coordinate.
+                * Dictionary of field names and arrays (or sequences) of
+                  attribute values with one entry per feature. Attributes
+                  are then stored column wise (see get_column).
                 * None
             * projection: Geospatial reference in WKT format.
                 Only used if geometry is provided as a numeric array,
                 if None, WGS84 geographic is assumed.
             * geometry: A list of either point coordinates or polygons/lines
-                (see note below).
+                (see note below) or a PackedGeometry instance.
             * geometry_type: Desired interpretation of geometry.
                 Valid options are 'point', 'line', 'polygon' or
                 the ogr types: 1, 2, 3.
@@ -82,6 +90,12 @@ class Vector(Layer):
                   table name in case of sqlite etc.) to load. Only applicable
                   to those dataformats supporting more than one layer in the
                   data file.
+            * columnar: Optional flag. If True and data is a filename,
+                  attributes are read into column wise storage.
+            * packed: Optional flag. If True, geometries are stored packed
+                  into flat coordinate arrays (see get_packed_geometry).
+            * attribute_names: Optional list of attributes to read if data
+                  is a filename. If None, all attributes are read.
 
         Returns:
             * InaSAFE vector layer instance
@@ -111,11 +125,25 @@ class Vector(Layer):
             list of polygon geometry objects
             (as defined in module geometry.py)
 
+            Column wise attributes are held as one numpy array per field.
+            Numerical fields are stored as numerical arrays and all others
+            as arrays of Python objects. Use get_column to get an array
+            without copying it and to write array expressions over all
+            features. get_data still returns a list of dictionaries, but
+            for column wise layers this is a new list so modifying it
+            does not change the layer.
+
+            Packed layers hold all vertices in one array (see class
+            PackedGeometry in geometry.py) rather than one array or
+            Polygon instance per feature. get_geometry returns views
+            into this array, so modifying them changes the layer.
+
     """
 
     def __init__(self, data=None, projection=None, geometry=None,
                  geometry_type=None, name=None, keywords=None,
-                 style_info=None, sublayer=None):
+                 style_info=None, sublayer=None, columnar=False,
+                 packed=False, attribute_names=None):
         """Initialise object with either geometry or filename
 
         NOTE: Doc strings in constructor are not harvested and exposed in
@@ -131,6 +159,9 @@ class Vector(Layer):
                        style_info=style_info,
                        sublayer=sublayer)
 
+        # File the layer was read from (see read_from_file)
+        self.file_stamp = None
+
         # Input checks
         if data is None and geometry is None:
             # Instantiate empty object
@@ -139,7 +170,8 @@ class Vector(Layer):
             return
 
         if isinstance(data, basestring):
-            self.read_from_file(data)
+            self.read_from_file(data, columnar=columnar, packed=packed,
+                                attribute_names=attribute_names)
         else:
             # Assume that data is provided as sequences provided as
             # arguments to the Vector constructor
@@ -151,7 +183,17 @@ class Vector(Layer):
             msg = 'Geometry must be a sequence'
             verify(is_sequence(geometry), msg)
 
-            if len(geometry) > 0 and isinstance(geometry[0], Polygon):
+            if isinstance(geometry, PackedGeometry):
+                if geometry_type is None:
+                    # Infer type from the number of vertices and rings
+                    if len(geometry.coordinates) == len(geometry):
+                        geometry_type = 'point'
+                    else:
+                        geometry_type = 'polygon'
+                self.geometry_type = get_geometry_type(geometry,
+                                                       geometry_type)
+                self.geometry = geometry
+            elif len(geometry) > 0 and isinstance(geometry[0], Polygon):
                 self.geometry_type = ogr.wkbPolygon
                 self.geometry = geometry
             else:
@@ -167,6 +209,9 @@ class Vector(Layer):
                     else:
                         self.geometry = geometry
 
+            if packed:
+                self.geometry = pack_geometry(self.geometry)
+
             if data is None:
                 # Generate default attribute as OGR will do that anyway
                 # when writing
@@ -175,8 +220,18 @@ class Vector(Layer):
                     data.append({'ID': i})
 
             # Check data
+            if isinstance(data, dict):
+                # Store attributes column wise
+                data = dict([(name, as_column(values))
+                             for name, values in data.items()])
+
+                for name in data:
+                    msg = ('The number of entries in geometry and attribute '
+                           '%s must be the same' % name)
+                    verify(len(geometry) == len(data[name]), msg)
+
             self.data = data
-            if data is not None:
+            if data is not None and not self.is_columnar:
                 msg = 'Data must be a sequence'
                 verify(is_sequence(data), msg)
 
@@ -193,7 +248,13 @@ class Vector(Layer):
             # Compute bounding box for each geometry type
             minx = miny = sys.maxint
             maxx = maxy = -minx
-            if self.is_point_data:
+            if self.is_packed:
+                bboxes = self.geometry.bboxes
+                minx = min(bboxes[:, 0])
+                maxx = max(bboxes[:, 1])
+                miny = min(bboxes[:, 2])
+                maxy = max(bboxes[:, 3])
+            elif self.is_point_data:
                 A = numpy.array(self.get_geometry())
                 minx = min(A[:, 0])
                 maxx = max(A[:, 0])
@@ -361,7 +422,8 @@ class Vector(Layer):
         # Vector layers are identical up to the specified tolerance
         return True
 
-    def read_from_file(self, filename):
+    def read_from_file(self, filename, columnar=False, packed=False,
+                       attribute_names=None):
         """Read and unpack vector data.
 
         It is assumed that the file contains only one layer with the
@@ -386,6 +448,16 @@ class Vector(Layer):
         http://resources.esri.com/help/9.3/ArcGISDesktop/com/Gp_ToolRef/
         geoprocessing_tool_reference/
         geoprocessing_considerations_for_shapefile_output.htm
+
+        If columnar is True, attributes are stored column wise and if
+        packed is True geometries are packed into flat arrays.
+        See class docstring.
+
+        If attribute_names is given, only those attributes are read.
+
+        Coordinates are read one ring at a time from the well known binary
+        representation of each geometry and attributes are read column
+        by column.
         """
 
         basename = os.path.splitext(filename)[0]
@@ -410,6 +482,7 @@ class Vector(Layer):
         if self.name is None:
             self.name = vectorname
         self.filename = filename
+        self.file_stamp = file_stamp(filename)
         self.geometry_type = None  # In case there are no features
 
         fid = ogr.Open(filename)
@@ -441,11 +514,38 @@ class Vector(Layer):
         p = layer.GetSpatialRef()
         self.projection = Projection(p)
 
+        # Find fields to read
+        layer_definition = layer.GetLayerDefn()
+        field_names = []
+        for j in range(layer_definition.GetFieldCount()):
+            field_names.append(layer_definition.GetFieldDefn(j).GetName())
+
+        if attribute_names is None:
+            attribute_names = field_names
+        else:
+            for name in attribute_names:
+                if name not in field_names:
+                    msg = ('Attribute %s was not found in %s. Available '
+                           'attributes are %s' % (name, filename,
+                                                  field_names))
+                    raise ReadLayerError(msg)
+
+            # Let OGR skip all other fields
+            ignored_fields = [name for name in field_names
+                              if name not in attribute_names]
+            if len(ignored_fields) > 0:
+                layer.SetIgnoredFields(ignored_fields)
+        field_indices = [field_names.index(name) for name in attribute_names]
+
         layer.ResetReading()
 
-        # Extract coordinates and attributes for all features
+        # Extract coordinates and attributes for all features.
+        # Attribute values are collected column wise.
         geometry = []
-        data = []
+        rings = []
+        part_lengths = []
+        columns = [[] for name in attribute_names]
+
         # Use feature iterator
         for feature in layer:
             # Record coordinates ordered as Longitude, Latitude
@@ -457,30 +557,34 @@ class Vector(Layer):
                 self.geometry_type = G.GetGeometryType()
                 if self.is_point_data:
                     geometry.append((G.GetX(), G.GetY()))
-                elif self.is_line_data:
-                    ring = get_ringdata(G)
-                    geometry.append(ring)
-                elif self.is_polygon_data:
-                    polygon = get_polygondata(G)
-                    geometry.append(polygon)
-                elif self.is_multi_polygon_data:
-                    try:
-                        G = ogr.ForceToPolygon(G)
-                    except:
-                        msg = ('Got geometry type Multipolygon (%s) for '
-                               'filename %s and could not convert it to '
-                               'singlepart. However, you can use QGIS '
-                               'functionality to convert multipart vector '
-                               'data to singlepart (Vector -> Geometry Tools '
-                               '-> Multipart to Singleparts and use the '
-                               'resulting dataset.'
-                               % (ogr.wkbMultiPolygon, filename))
+                elif (self.is_line_data or self.is_polygon_data or
+                      self.is_multi_polygon_data):
+                    # Get all rings of feature at once from its well
+                    # known binary representation
+                    feature_rings = wkb2rings(G.ExportToWkb(ogr.wkbNDR))
+                    if len(feature_rings) == 0:
+                        msg = ('Geometry without coordinates in filename '
+                               '%s' % filename)
                         raise ReadLayerError(msg)
-                    else:
-                        # Read polygon data as single part
+
+                    if self.is_multi_polygon_data:
+                        # Read polygon data as single part. Rings of all
+                        # parts are used as by OGR's ForceToPolygon.
                         self.geometry_type = ogr.wkbPolygon
-                        polygon = get_polygondata(G)
-                        geometry.append(polygon)
+
+                    if packed:
+                        # Rings are copied once when packing
+                        rings.extend(feature_rings)
+                        part_lengths.append(len(feature_rings))
+                    elif self.is_line_data:
+                        geometry.append(numpy.array(feature_rings[0],
+                                                    dtype='d'))
+                    else:
+                        feature_rings = [numpy.array(ring, dtype='d')
+                                         for ring in feature_rings]
+                        geometry.append(Polygon(
+                            outer_ring=feature_rings[0],
+                            inner_rings=feature_rings[1:]))
                 else:
                     msg = ('Only point, line and polygon geometries are '
                            'supported. '
@@ -489,44 +593,55 @@ class Vector(Layer):
                                         self.geometry_type))
                     raise ReadLayerError(msg)
 
-            # Record attributes by name
-            number_of_fields = feature.GetFieldCount()
-            fields = {}
-            for j in range(number_of_fields):
-                name = feature.GetFieldDefnRef(j).GetName()
-
-                # FIXME (Ole): Ascertain the type of each field?
-                #              We need to cast each appropriately?
-                #              This is issue #66
-                #              (https://github.com/AIFDR/riab/issues/66)
-                #feature_type = feature.GetFieldDefnRef(j).GetType()
-                fields[name] = feature.GetField(j)
-
-                    # We do this because there is NaN problem on windows
-                    # NaN value must be converted to _pseudo_in to solve the
-                    # problem. But, when InaSAFE read the file, it'll be
-                    # converted back to NaN value, so that NaN in InaSAFE is a
-                    # numpy.nan
-                    # please check https://github.com/AIFDR/inasafe/issues/269
-                    # for more information
-                if fields[name] == _pseudo_inf:
-                    fields[name] = float('nan')
-                #print 'Field', name, feature_type, j, fields[name]
-
-            data.append(fields)
+            # Record attributes
+            # FIXME (Ole): Ascertain the type of each field?
+            #              We need to cast each appropriately?
+            #              This is issue #66
+            #              (https://github.com/AIFDR/riab/issues/66)
+            for column, j in zip(columns, field_indices):
+                column.append(feature.GetField(j))
+
+        # We do this because there is NaN problem on windows
+        # NaN value must be converted to _pseudo_in to solve the
+        # problem. But, when InaSAFE read the file, it'll be
+        # converted back to NaN value, so that NaN in InaSAFE is a
+        # numpy.nan
+        # please check https://github.com/AIFDR/inasafe/issues/269
+        # for more information
+        nan = float('nan')
+        for column in columns:
+            if _pseudo_inf in column:
+                column[:] = [nan if x == _pseudo_inf else x for x in column]
+
         # Store geometry coordinates as a compact numeric array
-        self.geometry = geometry
-        self.data = data
+        if packed and len(rings) > 0:
+            self.geometry = pack_rings(rings, part_lengths)
+        elif packed:
+            self.geometry = pack_geometry(geometry)
+        else:
+            self.geometry = geometry
+
+        data = dict(zip(attribute_names, columns))
+        if columnar:
+            self.data = dict([(name, as_column(values))
+                              for name, values in data.items()])
+        else:
+            self.data = columns_to_rows(data, len(self.geometry))
 
     def write_to_file(self, filename, sublayer=None):
         """Save vector data to file
 
         Args:
-            * filename: filename with extension .shp or .gml
+            * filename: filename with extension .shp, .sqlite or .gpkg
             * sublayer: Optional string for writing a sublayer. Ignored
                   unless we are writing to an sqlite file.
 
         Note:
+            Features are written in transactions of
+            FEATURES_PER_TRANSACTION features, which is what makes writing
+            to SQLite and GeoPackage fast. Attribute values are prepared
+            column by column before any features are created.
+
             Shp limitation, if attribute names are longer than 10
             characters they will be truncated. This is due to limitations in
             the shp file driver and has to be done here since gdal v1.7 onwards
@@ -534,15 +649,14 @@ class Vector(Layer):
             http://www.gdal.org/ogr/drv_shapefile.html
 
             **For this reason we recommend writing to spatialite.**
-
         """
 
         # Check file format
         basename, extension = os.path.splitext(filename)
 
         msg = ('Invalid file type for file %s. Only extensions '
-               'sqlite, shp or gml allowed.' % filename)
-        verify(extension in ['.sqlite', '.shp', '.gml'], msg)
+               'sqlite, gpkg, shp or gml allowed.' % filename)
+        verify(extension in ['.sqlite', '.gpkg', '.shp', '.gml'], msg)
         driver = DRIVER_MAP[extension]
 
         # FIXME (Ole): Tempory flagging of GML issue (ticket #18)
@@ -563,7 +677,12 @@ class Vector(Layer):
             geometry = self.get_geometry(as_geometry_objects=True)
         else:
             geometry = self.get_geometry()
-        data = self.get_data()
+        if self.is_columnar:
+            columns = self.data
+            data = None
+        else:
+            columns = None
+            data = self.get_data()
 
         N = len(geometry)
 
@@ -579,7 +698,13 @@ class Vector(Layer):
             msg = 'OGR driver %s not available' % driver
             raise WriteLayerError(msg)
 
-        ds = drv.CreateDataSource(filename)
+        # Don't wait for SQLite to sync every transaction to disk
+        synchronous = gdal.GetConfigOption('OGR_SQLITE_SYNCHRONOUS')
+        gdal.SetConfigOption('OGR_SQLITE_SYNCHRONOUS', 'OFF')
+        try:
+            ds = drv.CreateDataSource(filename)
+        finally:
+            gdal.SetConfigOption('OGR_SQLITE_SYNCHRONOUS', synchronous)
         if ds is None:
             msg = 'Creation of output file %s failed' % filename
             raise WriteLayerError(msg)
@@ -594,21 +719,31 @@ class Vector(Layer):
         # Define attributes if any
         store_attributes = False
         fields = []
-        if data is not None:
-            if len(data) > 0:
+        if data is not None or columns is not None:
+            # Field names and types are taken from the first feature
+            first_row = None
+            if columns is not None:
+                if N > 0:
+                    # Convert to Python types as done for all values
+                    first_row = dict([(name, columns[name][:1].tolist()[0])
+                                      for name in columns])
+            elif len(data) > 0:
+                first_row = data[0]
+
+            if first_row is not None:
                 try:
-                    fields = data[0].keys()
+                    fields = first_row.keys()
                 except:
                     msg = ('Input parameter "attributes" was specified '
                            'but it does not contain list of dictionaries '
                            'with field information as expected. The first '
-                           'element is %s' % data[0])
+                           'element is %s' % first_row)
                     raise WriteLayerError(msg)
                 else:
                     # Establish OGR types for each element
                     ogrtypes = {}
                     for name in fields:
-                        att = data[0][name]
+                        att = first_row[name]
                         py_type = type(att)
                         msg = ('Unknown type for storing vector '
                                'data: %s, %s' % (name, str(py_type)[1:-1]))
@@ -643,108 +778,166 @@ class Vector(Layer):
                 # Restore error handler
                 gdal.PopErrorHandler()
 
+        # Prepare values of each field. Fields were created in order so
+        # field j is set by index rather than by its (laundered) name.
+        field_map = []
+        if store_attributes:
+            for j, name in enumerate(fields):
+                if columns is None:
+                    values = [x[name] for x in data]
+                else:
+                    values = columns[name]
+                field_map.append((j, field_values(values)))
+
         # Store geometry
         geom = ogr.Geometry(self.geometry_type)
         layer_def = lyr.GetLayerDefn()
-        for i in range(N):
-            # Create new feature instance
-            feature = ogr.Feature(layer_def)
+        lyr.StartTransaction()
+        try:
+            for i in range(N):
+                # Create new feature instance
+                feature = ogr.Feature(layer_def)
 
-            # Store geometry and check
-            if self.is_point_data:
-                x = float(geometry[i][0])
-                y = float(geometry[i][1])
-                geom.SetPoint_2D(0, x, y)
-            elif self.is_line_data:
-                geom = array2line(geometry[i],
-                                  geometry_type=ogr.wkbLineString)
-            elif self.is_polygon_data:
-                # Create polygon geometry
-                geom = ogr.Geometry(ogr.wkbPolygon)
-
-                # Add outer ring
-                linear_ring = array2line(geometry[i].outer_ring,
-                                         geometry_type=ogr.wkbLinearRing)
-                geom.AddGeometry(linear_ring)
-
-                # Add inner rings if any
-                for A in geometry[i].inner_rings:
-                    geom.AddGeometry(array2line(A,
-                                     geometry_type=ogr.wkbLinearRing))
-            else:
-                msg = 'Geometry type %s not implemented' % self.geometry_type
-                raise WriteLayerError(msg)
+                # Store geometry and check
+                if self.is_point_data:
+                    x = float(geometry[i][0])
+                    y = float(geometry[i][1])
+                    geom.SetPoint_2D(0, x, y)
+                    feature.SetGeometry(geom)
+                elif self.is_line_data or self.is_polygon_data:
+                    # Create geometry from all coordinates at once
+                    if self.is_line_data:
+                        wkb = rings2wkb([geometry[i]],
+                                        geometry_type=ogr.wkbLineString)
+                    else:
+                        wkb = rings2wkb([geometry[i].outer_ring] +
+                                        list(geometry[i].inner_rings),
+                                        geometry_type=ogr.wkbPolygon)
+                    feature.SetGeometryDirectly(
+                        ogr.CreateGeometryFromWkb(wkb))
+                else:
+                    msg = ('Geometry type %s not implemented'
+                           % self.geometry_type)
+                    raise WriteLayerError(msg)
 
-            feature.SetGeometry(geom)
+                G = feature.GetGeometryRef()
+                if G is None:
+                    msg = ('Could not create GeometryRef for file %s'
+                           % filename)
+                    raise WriteLayerError(msg)
 
-            G = feature.GetGeometryRef()
-            if G is None:
-                msg = 'Could not create GeometryRef for file %s' % filename
-                raise WriteLayerError(msg)
-
-            # Store attributes
-            if store_attributes:
-                for j, name in enumerate(fields):
-                    actual_field_name = layer_def.GetFieldDefn(j).GetNameRef()
-
-                    val = data[i][name]
-
-                    if type(val) == numpy.ndarray:
-                        # A singleton of type <type 'numpy.ndarray'> works
-                        # for gdal version 1.6 but fails for version 1.8
-                        # in SetField with error: NotImplementedError:
-                        # Wrong number of arguments for overloaded function
-                        val = float(val)
-                    elif val is None:
-                        val = ''
-
-                    # We do this because there is NaN problem on windows
-                    # NaN value must be converted to _pseudo_in to solve the
-                    # problem. But, when InaSAFE read the file, it'll be
-                    # converted back to NaN value, so that NaN in InaSAFE is a
-                    # numpy.nan
-                    # please check https://github.com/AIFDR/inasafe/issues/269
-                    # for more information
-                    if val != val:
-                        val = _pseudo_inf
-
-                    feature.SetField(actual_field_name, val)
-
-            # Save this feature
-            if lyr.CreateFeature(feature) != 0:
-                msg = 'Failed to create feature %i in file %s' % (i, filename)
-                raise WriteLayerError(msg)
-
-            feature.Destroy()
+                # Store attributes
+                for j, values in field_map:
+                    feature.SetField(j, values[i])
+
+                # Save this feature
+                if lyr.CreateFeature(feature) != 0:
+                    msg = ('Failed to create feature %i in file %s'
+                           % (i, filename))
+                    raise WriteLayerError(msg)
+
+                feature.Destroy()
+
+                # Commit regularly to keep transactions small
+                if (i + 1) % FEATURES_PER_TRANSACTION == 0:
+                    lyr.CommitTransaction()
+                    lyr.StartTransaction()
+        except:
+            lyr.RollbackTransaction()
+            raise
+        else:
+            lyr.CommitTransaction()
 
         # Write keywords if any
         write_keywords(self.keywords, basename + '.keywords')
 
         # FIXME (Ole): Maybe store style_info
 
-    def copy(self):
+    def copy(self, share_geometry=False):
         """Return copy of vector layer
 
         This copy will be equal to self in the sense defined by __eq__
+
+        Args:
+            * share_geometry: If True the copy refers to the same geometry
+                  and arrays derived from it (see get_point_coordinates)
+                  as this layer and only the attributes are copied.
+                  This is much cheaper for large layers and meant for
+                  running several analyses on one layer where each may
+                  modify the attributes it gets. The geometry must then
+                  not be modified through either layer.
         """
 
-        if self.is_polygon_data:
+        if share_geometry:
+            geometry = self.geometry
+        elif self.is_packed:
+            geometry = self.geometry.copy()
+        elif self.is_polygon_data:
             geometry = self.get_geometry(copy=True, as_geometry_objects=True)
         else:
             geometry = self.get_geometry(copy=True)
 
-        return Vector(data=self.get_data(copy=True),
-                      geometry=geometry,
+        if self.is_columnar:
+            data = dict([(name, values.copy())
+                         for name, values in self.data.items()])
+        elif share_geometry:
+            # Attribute values are scalars so copying each row will do
+            data = [dict(x) for x in self.data]
+        else:
+            data = self.get_data(copy=True)
+
+        V = Vector(data=data,
+                   geometry=geometry,
+                   geometry_type=self._packed_geometry_type(),
+                   projection=self.get_projection(),
+                   keywords=self.get_keywords(),
+                   name=self.get_name())
+        if share_geometry:
+            V._geometry_cache = self._get_geometry_cache()
+        V.file_stamp = self.file_stamp
+        return V
+
+    def subset(self, indices):
+        """Return layer with selected features
+
+        Args:
+            * indices: Sequence of feature indices
+
+        Returns:
+            * New vector layer with the features at indices in that order.
+              Its attributes are copied so they can be modified without
+              changing this layer whereas geometry is shared with it.
+        """
+
+        idx = numpy.asarray(indices, dtype=numpy.int)
+        if self.is_columnar:
+            data = dict([(name, values[idx])
+                         for name, values in self.data.items()])
+        else:
+            data = [dict(self.data[i]) for i in idx]
+
+        if self.is_packed:
+            geometry = self.geometry.select(idx)
+        else:
+            geometry = [self.geometry[i] for i in idx]
+
+        return Vector(data=data,
                       projection=self.get_projection(),
+                      geometry=geometry,
+                      geometry_type=self._packed_geometry_type(),
+                      name=self.get_name(),
                       keywords=self.get_keywords())
 
     def get_attribute_names(self):
         """Get available attribute names
 
-        These are the ones that can be used with get_data
+        These are the ones that can be used with get_data and get_column
         """
 
-        return self.data[0].keys()
+        if self.is_columnar:
+            return self.data.keys()
+        else:
+            return self.data[0].keys()
 
     def get_data(self, attribute=None, index=None, copy=False):
         """Get vector attributes
@@ -763,19 +956,36 @@ class Vector(Layer):
             If optional argument copy is True and all attributes are requested,
             a copy will be returned. Otherwise a pointer to the data is
             returned.
+
+            For column wise layers a new list is always returned.
         """
 
         if hasattr(self, 'data'):
             if attribute is None:
-                if copy:
+                if self.is_columnar:
+                    return columns_to_rows(self.data, len(self))
+                elif copy:
                     return copy_module.deepcopy(self.data)
                 else:
                     return self.data
             else:
+                names = self.get_attribute_names()
                 msg = ('Specified attribute %s does not exist in '
                        'vector layer %s. Valid names are %s'
-                       '' % (attribute, self, self.data[0].keys()))
-                verify(attribute in self.data[0], msg)
+                       '' % (attribute, self, names))
+                verify(attribute in names, msg)
+
+                if self.is_columnar:
+                    values = self.data[attribute]
+                    if index is None:
+                        return values.tolist()
+                    else:
+                        msg = ('Specified index must lie within the bounds '
+                               'of vector layer %s which is [%i, %i]'
+                               '' % (self, 0, len(self) - 1))
+                        verify(isinstance(index, int) and
+                               0 <= index < len(self), msg)
+                        return values[index:index + 1].tolist()[0]
 
                 if index is None:
                     # Return all values for specified attribute
@@ -796,6 +1006,30 @@ class Vector(Layer):
             msg = 'Vector data instance does not have any attributes'
             raise GetDataError(msg)
 
+    def get_column(self, attribute):
+        """Get values of one attribute for all features as an array
+
+        Args:
+            * attribute: Name of attribute
+
+        Returns:
+            * numpy array with one value per feature. For column wise layers
+              this is the stored array itself (not a copy) so it can be
+              used in array expressions and modified in place.
+              For other layers a new array is created.
+        """
+
+        names = self.get_attribute_names()
+        msg = ('Specified attribute %s does not exist in '
+               'vector layer %s. Valid names are %s'
+               '' % (attribute, self, names))
+        verify(attribute in names, msg)
+
+        if self.is_columnar:
+            return self.data[attribute]
+        else:
+            return as_column([x[attribute] for x in self.data])
+
     def get_geometry_type(self):
         """Return geometry type for vector layer
         """
@@ -820,15 +1054,30 @@ class Vector(Layer):
         Optional boolean argument as_geometry_objects will change the return
         value to a list of geometry objects rather than a list of arrays.
         This currently only applies to polygon geometries
+
+        For packed layers the arrays returned are views into the packed
+        coordinates unless copy is True.
         """
 
-        if copy:
+        if self.is_packed:
+            if copy:
+                geometry = self.geometry.copy()
+            else:
+                geometry = self.geometry
+
+            if self.is_point_data:
+                geometry = geometry.coordinates.tolist()
+            elif self.is_polygon_data and as_geometry_objects:
+                geometry = geometry.get_polygons()
+            else:
+                geometry = geometry.get_outer_rings()
+        elif copy:
             geometry = copy_module.deepcopy(self.geometry)
         else:
             geometry = self.geometry
 
         if self.is_polygon_data:
-            if not as_geometry_objects:
+            if not as_geometry_objects and not self.is_packed:
                 geometry = [p.outer_ring for p in geometry]
         else:
             if as_geometry_objects:
@@ -838,6 +1087,86 @@ class Vector(Layer):
 
         return geometry
 
+    def get_packed_geometry(self):
+        """Return geometry packed into flat coordinate arrays
+
+        Returns:
+            * PackedGeometry instance. For packed layers this is the
+              stored geometry, otherwise it is packed from the geometry
+              on every call.
+
+        The result can be passed directly to the point in polygon and
+        clipping functions in safe.common.polygon which then use its
+        precomputed bounding boxes.
+        """
+
+        if self.is_packed:
+            return self.geometry
+        elif self.is_polygon_data:
+            return pack_geometry(self.get_geometry(as_geometry_objects=True))
+        else:
+            return pack_geometry(self.get_geometry())
+
+    def get_point_coordinates(self):
+        """Return point geometry as one array
+
+        Returns:
+            * Nx2 array of longitudes and latitudes, one row per feature.
+              The array is computed on the first call and the same
+              read only array is returned on later calls. For packed
+              layers it is the stored coordinate array.
+        """
+
+        msg = ('Point coordinates can only be obtained for point data. '
+               'Layer %s has geometry type %s'
+               % (self.name, geometrytype2string(self.geometry_type)))
+        verify(self.is_point_data, msg)
+
+        if self.is_packed:
+            return self.geometry.coordinates
+
+        cache = self._get_geometry_cache()
+        if 'points' not in cache:
+            A = numpy.array(self.geometry, dtype='d')
+            A = numpy.reshape(A, (len(self), 2))
+            A.flags.writeable = False
+            cache['points'] = A
+        return cache['points']
+
+    def get_point_index(self):
+        """Return grid index over point geometry
+
+        Returns:
+            * PointGridIndex over get_point_coordinates(). It is built on
+              the first call and reused afterwards, so classifying these
+              points by several polygon layers only builds it once.
+        """
+
+        cache = self._get_geometry_cache()
+        if 'index' not in cache:
+            cache['index'] = PointGridIndex(self.get_point_coordinates())
+        return cache['index']
+
+    def _get_geometry_cache(self):
+        """Arrays derived from the geometry of this layer
+
+        Layers created with copy(share_geometry=True) share the cache.
+        """
+
+        if getattr(self, '_geometry_cache', None) is None:
+            self._geometry_cache = {}
+        return self._geometry_cache
+
+    def _packed_geometry_type(self):
+        """Geometry type to pass on when creating layers from this one
+
+        Packed lines and polygons can't be told apart from their arrays.
+        """
+
+        if self.is_packed:
+            return self.geometry_type
+        return None
+
     def get_bounding_box(self):
         """Get bounding box coordinates for vector layer.
 
@@ -884,6 +1213,27 @@ class Vector(Layer):
         msg = 'N must be a positive number. I got %i' % N
         verify(N > 0, msg)
 
+        if self.is_columnar or self.is_packed:
+            # Select indices of N largest values keeping their order
+            idx = numpy.argsort(self.get_column(attribute),
+                                kind='mergesort')[-N:]
+            if self.is_columnar:
+                data = dict([(name, values[idx])
+                             for name, values in self.data.items()])
+            else:
+                data = [self.data[i] for i in idx]
+
+            if self.is_packed:
+                geometry = self.geometry.select(idx)
+            else:
+                geometry = [self.geometry[i] for i in idx]
+
+            return Vector(data=data,
+                          projection=self.get_projection(),
+                          geometry=geometry,
+                          geometry_type=self._packed_geometry_type(),
+                          keywords=self.get_keywords())
+
         # Create list of values for specified attribute
         values = self.get_data(attribute)
 
@@ -919,10 +1269,163 @@ class Vector(Layer):
     def is_multi_polygon_data(self):
         return self.is_vector and self.geometry_type == ogr.wkbMultiPolygon
 
+    @property
+    def is_packed(self):
+        return isinstance(getattr(self, 'geometry', None), PackedGeometry)
+
+    @property
+    def is_columnar(self):
+        return isinstance(getattr(self, 'data', None), dict)
+
 
 #----------------------------------
 # Helper functions for class Vector
 #----------------------------------
+def file_stamp(filename):
+    """Identify contents of a vector file without reading them
+
+    Args:
+        * filename: Name of vector file
+
+    Returns:
+        * Tuple of absolute file name, size and modification time of the
+          file and, for shapefiles, of the attribute table next to it
+    """
+
+    filenames = [filename]
+    dbf_filename = os.path.splitext(filename)[0] + '.dbf'
+    if os.path.isfile(dbf_filename):
+        filenames.append(dbf_filename)
+
+    stamp = []
+    for name in filenames:
+        status = os.stat(name)
+        stamp.append((os.path.abspath(name), status.st_size,
+                      status.st_mtime))
+    return tuple(stamp)
+
+
+def as_column(values):
+    """Convert attribute values to a column array
+
+    Args:
+        * values: Sequence of attribute values, one per feature
+
+    Returns:
+        * 1D numpy array. Numerical and boolean values give arrays of that
+          type while all other values (e.g. strings or None) are kept as
+          Python objects.
+    """
+
+    if isinstance(values, numpy.ndarray) and values.ndim == 1:
+        if values.dtype.kind in 'biuf' or values.dtype == object:
+            return values
+
+    A = numpy.array(values)
+    if A.ndim != 1 or A.dtype.kind not in 'biuf':
+        A = numpy.empty(len(values), dtype=object)
+        A[:] = list(values)
+
+    return A
+
+
+def rows_to_columns(data):
+    """Convert list of attribute dictionaries to dictionary of columns
+
+    Args:
+        * data: List of dictionaries, one per feature, with the same keys
+
+    Returns:
+        * Dictionary of 1D arrays, one per attribute name
+    """
+
+    if len(data) == 0:
+        return {}
+
+    return dict([(name, as_column([x[name] for x in data]))
+                 for name in data[0]])
+
+
+def columns_to_rows(columns, number_of_rows=0):
+    """Convert dictionary of columns to list of attribute dictionaries
+
+    Args:
+        * columns: Dictionary of arrays or lists of equal length
+        * number_of_rows: Number of features. Only used if there are
+                          no columns.
+
+    Returns:
+        * List of dictionaries, one per feature, with values as Python types
+    """
+
+    names = columns.keys()
+    if len(names) == 0:
+        return [{} for _ in range(number_of_rows)]
+
+    values = [as_list(columns[name]) for name in names]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def field_values(values):
+    """Convert attribute values to values that can be stored by OGR
+
+    Args:
+        * values: Array or sequence of values of one attribute
+
+    Returns:
+        * List of values where None is replaced by '', NaN by
+          _pseudo_inf and numpy types by Python types
+    """
+
+    if isinstance(values, numpy.ndarray) and values.dtype.kind in 'biu':
+        return values.tolist()
+
+    if isinstance(values, numpy.ndarray) and values.dtype.kind == 'f':
+        # We do this because there is NaN problem on windows
+        # NaN value must be converted to _pseudo_in to solve the
+        # problem. But, when InaSAFE read the file, it'll be
+        # converted back to NaN value, so that NaN in InaSAFE is a
+        # numpy.nan
+        # please check https://github.com/AIFDR/inasafe/issues/269
+        # for more information
+        values = numpy.where(numpy.isnan(values), _pseudo_inf, values)
+        return values.tolist()
+
+    return [field_value(val) for val in values]
+
+
+def field_value(val):
+    """Convert one attribute value to a value that can be stored by OGR
+
+    See field_values
+    """
+
+    if type(val) == numpy.ndarray:
+        # A singleton of type <type 'numpy.ndarray'> works
+        # for gdal version 1.6 but fails for version 1.8
+        # in SetField with error: NotImplementedError:
+        # Wrong number of arguments for overloaded function
+        val = float(val)
+    elif val is None:
+        val = ''
+
+    # NaN is stored as _pseudo_inf (see field_values)
+    if val != val:
+        val = _pseudo_inf
+
+    return val
+
+
+def as_list(values):
+    """Convert array or sequence to list of Python values
+    """
+
+    if isinstance(values, numpy.ndarray):
+        return values.tolist()
+    else:
+        return list(values)
+
+
 def convert_line_to_points(V, delta):
     """Convert line vector data to point vector data
 
@@ -974,19 +1477,20 @@ def convert_polygons_to_centroids(V):
     msg = 'Input data %s must be polygon vector data' % V
     verify(V.is_polygon_data, msg)
 
-    geometry = V.get_geometry()
-    N = len(V)
-
-    # Calculate points for each polygon
-    centroids = []
-    for i in range(N):
-        c = calculate_polygon_centroid(geometry[i])
-        centroids.append(c)
+    # Centroids are computed once per layer and shared between the point
+    # layers returned for it, along with any index built over them.
+    cache = V._get_geometry_cache().setdefault('centroids', {})
+    if 'points' not in cache:
+        centroids = calculate_polygon_centroids(V)
+        centroids.flags.writeable = False
+        cache['points'] = centroids
+    centroids = cache['points']
 
     # Create new point vector layer with same attributes and return
-    V = Vector(data=V.get_data(),
+    P = Vector(data=V.get_data(),
                projection=V.get_projection(),
                geometry=centroids,
                name='%s_centroid_data' % V.get_name(),
                keywords=V.get_keywords())
-    return V
+    P._geometry_cache = cache
+    return P
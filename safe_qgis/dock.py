@@ -75,10 +75,11 @@ from safe_qgis.safe_interface import (
     get_version,
     temp_dir,
     safe_read_layer,
+    safe_export_layer,
     get_free_memory,
     ReadLayerError,
     points_in_and_outside_polygon,
-    calculate_polygon_centroid,
+    calculate_polygon_centroids,
     unique_filename,
     get_postprocessors,
     get_postprocessor_human_name)
@@ -867,8 +868,13 @@ class Dock(QtGui.QDockWidget, Ui_DockBase):
         if not myEngineImpactLayer.is_inasafe_spatial_object:
             raise Exception(myMessage)
 
-        # Get associated filename and symbolic name
-        myFilename = myEngineImpactLayer.get_filename()
+        # Get associated filename and symbolic name. Impact layers not
+        # yet written as GeoTIFF or shapefile are exported the first time
+        # they are read so QGIS can load them.
+        myFilename = myEngineImpactLayer.filename
+        if (myFilename is None or
+                os.path.splitext(myFilename)[1] == '.npz'):
+            myFilename = safe_export_layer(myEngineImpactLayer)
         myName = myEngineImpactLayer.get_name()
 
         myQGISLayer = None
@@ -1985,16 +1991,8 @@ class Dock(QtGui.QDockWidget, Ui_DockBase):
                     # one aggregation polygon
 
                     # Calculate points for each polygon
-                    myCentroids = []
-                    for myPolygon in myImpactGeoms:
-                        if hasattr(myPolygon, 'outer_ring'):
-                            outer_ring = myPolygon.outer_ring
-                        else:
-                            # Assume it is an array
-                            outer_ring = myPolygon
-                        c = calculate_polygon_centroid(outer_ring)
-                        myCentroids.append(c)
-                    myRemainingPoints = myCentroids
+                    myRemainingPoints = calculate_polygon_centroids(
+                        mySafeImpactLayer)
 
                 else:
                     myRemainingPoints = myImpactGeoms
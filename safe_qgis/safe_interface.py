@@ -34,6 +34,7 @@ from safe.api import (get_admissible_plugins,
                       read_keywords, bbox_intersection,
                       write_keywords as safe_write_keywords,
                       read_layer as safe_read_layer,
+                      export_layer as safe_export_layer,
                       buffered_bounding_box,
                       verify as verify_util,
                       VerificationError,
@@ -49,6 +50,7 @@ from safe.api import (get_admissible_plugins,
                       get_plugins, get_version,
                       in_and_outside_polygon as points_in_and_outside_polygon,
                       calculate_polygon_centroid,
+                      calculate_polygon_centroids,
                       get_postprocessors,
                       get_postprocessor_human_name,
                       convert_mmi_data,
@@ -454,6 +456,11 @@ def calculateSafeImpact(theLayers, theFunction):
         Any exceptions are propogated
     """
     try:
-        return safe_calculate_impact(theLayers, theFunction)
+        # The impact layer is kept in memory until the dock exports it
+        # for QGIS (see Dock.readImpactLayer). Interpolation results are
+        # cached as analyses are often rerun on the same layers with
+        # other parameters.
+        return safe_calculate_impact(theLayers, theFunction,
+                                     write_mode='deferred', use_cache=True)
     except:
         raise
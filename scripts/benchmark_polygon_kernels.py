@@ -0,0 +1,115 @@
+"""Benchmark point in polygon kernels in safe.common.polygon
+
+Compares the default kernel, which loops over all polygon edges, with the
+slab decomposition enabled by use_slabs=True in separate_points_by_polygon.
+
+Rings are either taken from polygon layers given on the command line
+(e.g. administrative boundaries) or generated synthetically with the
+requested number of vertices.
+"""
+
+import time
+import argparse
+import numpy
+
+from safe.common.polygon import separate_points_by_polygon
+from safe.storage.core import read_layer
+
+
+def synthetic_ring(number_of_vertices, seed=13):
+    """Generate a ring resembling an administrative boundary
+
+    Args:
+        * number_of_vertices: Number of vertices in ring
+        * seed: Seed for random number generator
+
+    Returns:
+        * Nx2 array of vertices of a star shaped ring with a ragged
+          boundary around the unit circle
+    """
+
+    numpy.random.seed(seed)
+    N = number_of_vertices
+    angles = numpy.linspace(0, 2 * numpy.pi, N, endpoint=False)
+
+    # Closed random walk for large scale wiggles plus small scale noise
+    walk = numpy.cumsum(numpy.random.randn(N))
+    walk -= numpy.linspace(0, walk[-1], N)
+    radii = (1 + 0.2 * walk / max(numpy.abs(walk).max(), 1) +
+             0.01 * numpy.random.randn(N))
+
+    return numpy.array([radii * numpy.cos(angles),
+                        radii * numpy.sin(angles)]).T
+
+
+def benchmark_ring(ring, number_of_points, closed=None):
+    """Time both kernels on one ring
+
+    Args:
+        * ring: Nx2 array of vertices
+        * number_of_points: Number of random points in ring bounding box
+        * closed: Passed on to separate_points_by_polygon
+
+    Returns:
+        * Time taken using edge loop, time taken using slabs
+    """
+
+    minx, miny = numpy.min(ring, axis=0)
+    maxx, maxy = numpy.max(ring, axis=0)
+    points = numpy.random.rand(number_of_points, 2)
+    points[:, 0] = minx + points[:, 0] * (maxx - minx)
+    points[:, 1] = miny + points[:, 1] * (maxy - miny)
+
+    t0 = time.time()
+    inside0, _ = separate_points_by_polygon(points, ring, closed=closed)
+    t1 = time.time()
+    inside1, _ = separate_points_by_polygon(points, ring, closed=closed,
+                                            use_slabs=True)
+    t2 = time.time()
+
+    msg = 'Kernels disagree for ring with %i vertices' % len(ring)
+    assert numpy.all(inside0 == inside1), msg
+
+    return t1 - t0, t2 - t1
+
+
+if __name__ == '__main__':
+
+    doc = 'Benchmark point in polygon kernels on large rings'
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('filenames', type=str, nargs='*',
+                        help=('Polygon layers (e.g. administrative '
+                              'boundaries) whose outer rings will be used'))
+    parser.add_argument('--sizes', metavar='N', type=int, nargs='+',
+                        default=[100, 1000, 10000, 50000],
+                        help=('Number of vertices in synthetic rings. '
+                              'Used if no filenames are given'))
+    parser.add_argument('--points', metavar='M', type=int, default=100000,
+                        help='Number of points to classify against each ring')
+    parser.add_argument('--min_vertices', metavar='N', type=int,
+                        default=1000,
+                        help='Skip rings with fewer vertices than this')
+    parser.add_argument('--closed', action='store_true',
+                        help='Also resolve points on the boundary')
+
+    args = parser.parse_args()
+
+    rings = []
+    if args.filenames:
+        for filename in args.filenames:
+            layer = read_layer(filename)
+            for ring in layer.get_geometry():
+                if len(ring) >= args.min_vertices:
+                    rings.append(numpy.array(ring))
+    else:
+        for size in args.sizes:
+            rings.append(synthetic_ring(size))
+
+    closed = True if args.closed else None
+
+    print '%10s %12s %12s %8s' % ('vertices', 'edges [s]', 'slabs [s]',
+                                  'speedup')
+    for ring in rings:
+        t_edges, t_slabs = benchmark_ring(ring, args.points, closed=closed)
+        print '%10i %12.3f %12.3f %8.1f' % (len(ring), t_edges, t_slabs,
+                                            t_edges / t_slabs)
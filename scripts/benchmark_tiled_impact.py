@@ -0,0 +1,65 @@
+"""Benchmark impact functions run tile by tile in a process pool
+
+Times an impact function providing run_tile (see safe.engine.tiling) on
+a hazard and an exposure layer with different numbers of worker
+processes and checks that the impact summary does not change.
+"""
+
+import time
+import argparse
+
+from safe.storage.core import read_layer
+from safe.impact_functions import get_plugin
+from safe.engine.tiling import run_tiles
+
+
+def benchmark_impact_function(plugin_name, hazard, exposure, processes):
+    """Time impact function for each number of processes
+
+    Args:
+        * plugin_name: Name of impact function
+        * hazard, exposure: Filenames of hazard and exposure layers
+        * processes: List of numbers of worker processes
+
+    Returns:
+        * List of times taken
+    """
+
+    layers = [read_layer(hazard), read_layer(exposure)]
+    IF = get_plugin(plugin_name)
+
+    times = []
+    summary = None
+    for n in processes:
+        t0 = time.time()
+        impact = run_tiles(IF(), layers, processes=n)
+        times.append(time.time() - t0)
+
+        if summary is None:
+            summary = impact.get_impact_summary()
+        msg = 'Impact summary with %i processes differs' % n
+        assert impact.get_impact_summary() == summary, msg
+
+    return times
+
+
+if __name__ == '__main__':
+
+    doc = 'Benchmark impact functions run tile by tile'
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('plugin', type=str,
+                        help='Impact function, e.g. ITBFatalityFunction')
+    parser.add_argument('hazard', type=str, help='Hazard raster layer')
+    parser.add_argument('exposure', type=str, help='Exposure layer')
+    parser.add_argument('--processes', metavar='N', type=int, nargs='*',
+                        default=[1, 2, 4, 8, 16],
+                        help='Numbers of worker processes to time')
+
+    args = parser.parse_args()
+
+    times = benchmark_impact_function(args.plugin, args.hazard,
+                                      args.exposure, args.processes)
+
+    print '%9s %10s %8s' % ('processes', 'time [s]', 'speedup')
+    for n, t in zip(args.processes, times):
+        print '%9i %10.3f %8.2f' % (n, t, times[0] / t)
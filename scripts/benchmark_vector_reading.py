@@ -0,0 +1,142 @@
+"""Benchmark reading of vector layers in safe.storage.vector
+
+Compares the previous reader, which got coordinates one vertex at a time
+with get_ringdata and attributes one field at a time for each feature,
+with Vector.read_from_file which parses the well known binary
+representation of each geometry and reads attributes column wise.
+
+Layers are either given on the command line (e.g. OSM buildings for a
+city) or taken to be all shapefiles in the test data directory.
+"""
+
+import os
+import glob
+import time
+import argparse
+import numpy
+
+from osgeo import ogr
+
+from safe.common.testing import TESTDATA
+from safe.storage.vector import Vector
+from safe.storage.utilities import get_ringdata, get_polygondata
+
+
+def read_features_by_vertex(filename):
+    """Read geometries and attributes the way Vector used to
+
+    Args:
+        * filename: Vector layer to read
+
+    Returns:
+        * geometry: List of points, line arrays or Polygon instances
+        * data: List of dictionaries of attributes, one per feature
+    """
+
+    fid = ogr.Open(filename)
+    layer = fid.GetLayerByIndex(0)
+    layer.ResetReading()
+
+    geometry = []
+    data = []
+    for feature in layer:
+        G = feature.GetGeometryRef()
+        geometry_type = G.GetGeometryType()
+        if geometry_type in [ogr.wkbPoint, ogr.wkbPoint25D]:
+            geometry.append((G.GetX(), G.GetY()))
+        elif geometry_type in [ogr.wkbLineString, ogr.wkbLineString25D]:
+            geometry.append(get_ringdata(G))
+        else:
+            if geometry_type == ogr.wkbMultiPolygon:
+                G = ogr.ForceToPolygon(G)
+            geometry.append(get_polygondata(G))
+
+        fields = {}
+        for j in range(feature.GetFieldCount()):
+            name = feature.GetFieldDefnRef(j).GetName()
+            fields[name] = feature.GetField(j)
+        data.append(fields)
+
+    return geometry, data
+
+
+def check_geometry(reference, layer):
+    """Verify that layer has the same coordinates as reference geometry
+    """
+
+    if layer.is_polygon_data:
+        geometry = layer.get_geometry(as_geometry_objects=True)
+        for p0, p1 in zip(reference, geometry):
+            assert numpy.all(p0.outer_ring == p1.outer_ring)
+            assert len(p0.inner_rings) == len(p1.inner_rings)
+            for r0, r1 in zip(p0.inner_rings, p1.inner_rings):
+                assert numpy.all(r0 == r1)
+    else:
+        assert numpy.allclose(numpy.concatenate(reference),
+                              numpy.concatenate(layer.get_geometry()))
+
+
+def benchmark_layer(filename, attribute_names=None):
+    """Time readers on one layer
+
+    Args:
+        * filename: Vector layer to read
+        * attribute_names: Attributes to read in the last timing
+
+    Returns:
+        * Number of features and times taken by the vertex by vertex
+          reader, by Vector, by Vector with packed geometries and
+          column wise attributes and by the latter reading only
+          the given attributes
+    """
+
+    t0 = time.time()
+    geometry, _ = read_features_by_vertex(filename)
+    t1 = time.time()
+    V = Vector(filename)
+    t2 = time.time()
+    Vector(filename, packed=True, columnar=True)
+    t3 = time.time()
+    Vector(filename, packed=True, columnar=True,
+           attribute_names=attribute_names)
+    t4 = time.time()
+
+    msg = 'Readers disagree for layer %s' % filename
+    assert len(geometry) == len(V), msg
+    check_geometry(geometry, V)
+
+    return len(V), t1 - t0, t2 - t1, t3 - t2, t4 - t3
+
+
+if __name__ == '__main__':
+
+    doc = 'Benchmark reading of vector layers'
+    parser = argparse.ArgumentParser(description=doc)
+    parser.add_argument('filenames', type=str, nargs='*',
+                        help=('Vector layers to read. Default is all '
+                              'shapefiles in the test data directory'))
+    parser.add_argument('--attributes', metavar='NAME', type=str,
+                        nargs='*', default=[],
+                        help=('Attributes to read in the last timing. '
+                              'Attributes missing from a layer are '
+                              'skipped'))
+
+    args = parser.parse_args()
+
+    filenames = args.filenames
+    if not filenames:
+        filenames = sorted(glob.glob(os.path.join(TESTDATA, '*.shp')))
+
+    print '%-40s %9s %10s %10s %10s %10s' % ('layer', 'features',
+                                             'vertex [s]', 'wkb [s]',
+                                             'packed [s]', 'select [s]')
+    for filename in filenames:
+        fid = ogr.Open(filename)
+        definition = fid.GetLayerByIndex(0).GetLayerDefn()
+        available = [definition.GetFieldDefn(j).GetName()
+                     for j in range(definition.GetFieldCount())]
+        attribute_names = [x for x in args.attributes if x in available]
+
+        result = benchmark_layer(filename, attribute_names=attribute_names)
+        print '%-40s %9i %10.3f %10.3f %10.3f %10.3f' % (
+            (os.path.basename(filename)[:40],) + result)
@@ -0,0 +1,23 @@
+#!/bin/bash
+
+export QGIS_DEBUG=0
+export QGIS_LOG_FILE=/tmp/inasafe/realtime/logs/qgis.log
+export QGIS_DEBUG_FILE=/tmp/inasafe/realtime/logs/qgis-debug.log
+
+export QGIS_PREFIX_PATH=/usr/local/qgis-master/
+export PYTHONPATH=${QGIS_PREFIX_PATH}/share/qgis/python/:`pwd`
+export LD_LIBRARY_PATH=${QGIS_PREFIX_PATH}/lib
+
+export INASAFE_WORK_DIR=/home/web/quake
+export INASAFE_POPULATION_PATH=`pwd`/realtime/fixtures/exposure/population.tif
+export INASAFE_LOCALE=id
+# Seconds between listings of the shakemap server
+export INASAFE_POLL_INTERVAL=30
+# Restart the worker after this many events to bound memory leaks
+export INASAFE_DAEMON_MAX_EVENTS=50
+
+while true
+do
+  xvfb-run -a --server-args="-screen 0, 1024x768x24" python realtime/make_map.py --daemon
+  sleep 5
+done